@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Compare two benchmark result files written by run.py, case by case.
+"""
+
+import argparse
+import json
+
+
+def _load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return data, {(r['stage'], r['case']): r for r in data['results']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('before', help='Results of the baseline run')
+    parser.add_argument('after', help='Results of the run to compare with it')
+    args = parser.parse_args(argv)
+
+    before_data, before = _load(args.before)
+    after_data, after = _load(args.after)
+    print('{} ({}) -> {} ({})'.format(args.before, before_data['version'], args.after, after_data['version']))
+    print('{:8} {:48} {:>10} {:>10} {:>8} {:>10}'.format('stage', 'case', 'before', 'after', 'ratio', 'rss ratio'))
+    for key in [k for k in before if k in after]:
+        b, a = before[key], after[key]
+        if not b.get('median') or not a.get('median'):
+            continue
+        print('{:8} {:48} {:>9.3f}s {:>9.3f}s {:>8.2f} {:>10.2f}'.format(
+            key[0], key[1], b['median'], a['median'], a['median'] / b['median'],
+            a['peak_rss_bytes'] / b['peak_rss_bytes']))
+    for key in [k for k in before if k not in after]:
+        print('{:8} {:48} only in {}'.format(key[0], key[1], args.before))
+    for key in [k for k in after if k not in before]:
+        print('{:8} {:48} only in {}'.format(key[0], key[1], args.after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Deterministic synthetic fixtures for the benchmarks: additive mixes of a chord progression rendered to sound files of
+various lengths, formats and sample rates, and the same progression as midi.
+"""
+
+from typing import List, NamedTuple, Tuple
+import os
+import struct
+import numpy as np
+import soundfile as sf
+
+# I - V - vi - IV in C, as midi note numbers
+PROGRESSION: List[Tuple[str, Tuple[int, ...]]] = [
+    ('C', (48, 60, 64, 67)),
+    ('G', (43, 59, 62, 67)),
+    ('Am', (45, 60, 64, 69)),
+    ('F', (41, 60, 65, 69)),
+]
+CHORD_SECONDS = 2.0
+
+# soundfile format and subtype for each file extension
+_formats = {
+    '.wav': ('WAV', 'PCM_16'),
+    '.flac': ('FLAC', 'PCM_16'),
+    '.ogg': ('OGG', 'VORBIS'),
+    '.mp3': ('MP3', 'MPEG_LAYER_III'),
+}
+
+
+class Fixture(NamedTuple):
+    """A generated file, with the duration of the audio it holds"""
+    path: str
+    seconds: float
+
+
+def _frequency(note: int) -> float:
+    return 440.0 * 2 ** ((note - 69) / 12)
+
+
+def synthesize(seconds: float, sr: int, channels: int = 2) -> np.ndarray:
+    """
+    Render the progression, repeated to fill the given length, as an additive mix of the first few harmonics of each
+    chord note with a short fade at each chord change. The output depends only on the arguments.
+
+    :param seconds: Length of the signal
+    :param sr: Sample rate
+    :param channels: Number of (identical) channels
+    :return: Signal of shape (frames, channels)
+    """
+    chord_frames = int(CHORD_SECONDS * sr)
+    t = np.arange(chord_frames) / sr
+    fade = np.minimum(1, np.minimum(t, t[::-1]) / 0.01)
+    chords = []
+    for _, notes in PROGRESSION:
+        mix = np.zeros(chord_frames)
+        for note in notes:
+            for harmonic in range(1, 5):
+                mix += np.sin(2 * np.pi * _frequency(note) * harmonic * t) / harmonic ** 2
+        chords.append(mix * fade / (2 * len(notes)))
+    cycle = np.concatenate(chords)
+    frames = int(seconds * sr)
+    signal = np.tile(cycle, frames // len(cycle) + 1)[:frames].astype(np.float32)
+    return np.repeat(signal[:, None], channels, axis=1)
+
+
+def write_audio(directory: str, seconds: float, sr: int, extension: str) -> Fixture:
+    """
+    Write the progression to a sound file, unless an identical fixture already exists.
+
+    :param directory: Directory to write to
+    :param seconds: Length of the audio
+    :param sr: Sample rate
+    :param extension: One of .wav, .flac, .ogg or .mp3
+    :return: The fixture
+    :raises soundfile.LibsndfileError: If the installed libsndfile cannot write the format
+    """
+    path = os.path.join(directory, 'progression-{:g}s-{}hz{}'.format(seconds, sr, extension))
+    if not os.path.exists(path):
+        fmt, subtype = _formats[extension]
+        tmp = path + '.tmp'
+        try:
+            sf.write(tmp, synthesize(seconds, sr), sr, format=fmt, subtype=subtype)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return Fixture(path=path, seconds=seconds)
+
+
+def _var_len(value: int) -> bytes:
+    out = [value & 0x7f]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def midi_bytes(seconds: float) -> bytes:
+    """
+    The progression, repeated to fill the given length, as a format 0 standard midi file played on a piano at 120bpm.
+
+    :param seconds: Length of the music
+    :return: Contents of the midi file
+    """
+    division = 480
+    chord_ticks = int(CHORD_SECONDS * 2 * division)
+    track = bytearray()
+    track += b'\x00\xff\x51\x03' + (500000).to_bytes(3, 'big')
+    track += b'\x00\xc0\x00'
+    for i in range(int(seconds / CHORD_SECONDS)):
+        _, notes = PROGRESSION[i % len(PROGRESSION)]
+        for note in notes:
+            track += b'\x00' + bytes((0x90, note, 80))
+        for j, note in enumerate(notes):
+            track += _var_len(chord_ticks if j == 0 else 0) + bytes((0x80, note, 0))
+    track += b'\x00\xff\x2f\x00'
+    return b'MThd' + struct.pack('>IHHH', 6, 0, 1, division) + b'MTrk' + struct.pack('>I', len(track)) + track
+
+
+def write_midi(directory: str, seconds: float) -> Fixture:
+    """
+    Write the progression to a midi file (see midi_bytes).
+
+    :param directory: Directory to write to
+    :param seconds: Length of the music
+    :return: The fixture
+    """
+    path = os.path.join(directory, 'progression-{:g}s.mid'.format(seconds))
+    with open(path, 'wb') as f:
+        f.write(midi_bytes(seconds))
+    return Fixture(path=path, seconds=seconds)
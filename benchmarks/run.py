@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Benchmarks for each stage of the extraction pipeline, run on synthetic fixtures (see fixtures.py). Each case runs in a
+fresh process so that its peak resident memory can be measured on its own, and the results are written as JSON, which
+compare.py compares between runs, e.g. of two versions of the package::
+
+    python benchmarks/run.py --output before.json
+    # ... upgrade or check out another version ...
+    python benchmarks/run.py --output after.json
+    python benchmarks/compare.py before.json after.json
+"""
+
+from typing import Any, Callable, Dict, List, Tuple
+import argparse
+import datetime
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import Fixture, write_audio, write_midi  # noqa: E402
+import chord_extractor  # noqa: E402
+from chord_extractor import converters  # noqa: E402
+from chord_extractor.extractors import Chordino  # noqa: E402
+from chord_extractor.version import __version__  # noqa: E402
+import librosa  # noqa: E402
+import soundfile as sf  # noqa: E402
+import vamp  # noqa: E402
+
+# The benchmarks compare versions of the package, so APIs added over time are only used where present, and cases
+# needing one that is missing are skipped
+try:
+    from chord_extractor import decoders  # noqa: E402
+except ImportError:
+    decoders = None
+try:
+    from chord_extractor.memory import Audio  # noqa: E402
+except ImportError:
+    Audio = None
+
+STAGES = ['decode', 'plugin', 'midi', 'pool']
+
+
+def _peak_rss() -> Tuple[int, int]:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def _time_case(conn, fn: Callable[[], Any], repeat: int, warmup: int):
+    try:
+        # Untimed runs first, so that one-off costs such as lazy imports and JIT compilation are not counted
+        for _ in range(warmup):
+            fn()
+        seconds = []
+        for _ in range(repeat):
+            start = default_timer()
+            fn()
+            seconds.append(default_timer() - start)
+        conn.send((seconds, _peak_rss(), None))
+    except Exception as e:
+        conn.send((None, _peak_rss(), '{}: {}'.format(type(e).__name__, e)))
+
+
+# Untimed runs of each case before timing it
+warmup = 1
+
+
+def run_case(stage: str, case: str, fn: Callable[[], Any], repeat: int, **info) -> Dict[str, Any]:
+    """
+    Time a benchmark case in a fresh process.
+
+    :param stage: Pipeline stage being measured
+    :param case: Name of the case within the stage
+    :param fn: Function running the case once
+    :param repeat: Number of times to run it
+    :param info: Anything else to record with the result
+    :return: Result record
+    """
+    parent, child = mp.Pipe(duplex=False)
+    process = mp.get_context('fork').Process(target=_time_case, args=(child, fn, repeat, warmup))
+    process.start()
+    seconds, (rss, children_rss), error = parent.recv()
+    process.join()
+    record = {'stage': stage, 'case': case, **info, 'seconds': seconds, 'peak_rss_bytes': rss,
+              'children_peak_rss_bytes': children_rss, 'error': error}
+    if seconds:
+        record.update(min=min(seconds), median=statistics.median(seconds), mean=statistics.mean(seconds))
+    print('{:8} {:48} {}'.format(stage, case, error or '{:.3f}s'.format(record['median'])), file=sys.stderr)
+    return record
+
+
+def _skipped(case: str, missing: str):
+    print('{} not available, skipping {} benchmarks'.format(missing, case), file=sys.stderr)
+
+
+def bench_decode(fixtures: List[Fixture], repeat: int) -> List[Dict[str, Any]]:
+    cases = [('librosa', lambda f: librosa.load(f, sr=22050))]
+    if decoders is None:
+        _skipped('soundfile and ffmpeg decoding', 'chord_extractor.decoders')
+    else:
+        cases += [('soundfile', lambda f: decoders.load_soundfile(f, 22050)),
+                  ('soundfile-qq', lambda f: decoders.load_soundfile(f, 22050, quality='QQ'))]
+        if shutil.which('ffmpeg'):
+            cases.append(('ffmpeg', lambda f: decoders.load_ffmpeg(f, 22050)))
+    return [run_case('decode', '{}:{}'.format(name, os.path.basename(f.path)), lambda d=decode, p=f.path: d(p),
+                     repeat, audio_seconds=f.seconds, file_bytes=os.path.getsize(f.path))
+            for f in fixtures for name, decode in cases]
+
+
+def bench_plugin(fixtures: List[Fixture], repeat: int) -> List[Dict[str, Any]]:
+    if Audio is None:
+        _skipped('extraction from decoded audio', 'chord_extractor.memory.Audio')
+    res = []
+    for f in fixtures:
+        data, rate = librosa.load(f.path, sr=22050)
+        res.append(run_case('plugin', 'vamp.collect:{:g}s'.format(f.seconds),
+                            lambda d=data, r=rate: vamp.collect(d, r, 'nnls-chroma:chordino'), repeat,
+                            audio_seconds=f.seconds))
+        if Audio is not None:
+            # Through one Chordino, which keeps the plugin loaded between runs by default
+            res.append(run_case('plugin', 'reused:{:g}s'.format(f.seconds),
+                                lambda c=Chordino(), a=Audio(data, rate): c.extract(a), repeat,
+                                audio_seconds=f.seconds))
+    return res
+
+
+def bench_midi(fixtures: List[Fixture], repeat: int, directory: str) -> List[Dict[str, Any]]:
+    if not shutil.which('timidity'):
+        print('timidity not found, skipping midi benchmarks', file=sys.stderr)
+        return []
+
+    def to_wav(path):
+        # midi_to_wav wrote into a directory before conversion caches were added
+        output = tempfile.mkdtemp(dir=directory)
+        cache = chord_extractor.ConversionCache(output) if hasattr(chord_extractor, 'ConversionCache') else None
+        try:
+            converters.midi_to_wav(path, output if cache is None else cache)
+        finally:
+            if cache is not None:
+                cache.close()
+            shutil.rmtree(output)
+
+    to_pcm = getattr(converters, 'midi_to_pcm', None)
+    if to_pcm is None:
+        _skipped('midi_to_pcm', 'chord_extractor.converters.midi_to_pcm')
+    res = []
+    for f in fixtures:
+        res.append(run_case('midi', 'midi_to_wav:{:g}s'.format(f.seconds), lambda p=f.path: to_wav(p), repeat,
+                            audio_seconds=f.seconds))
+        if to_pcm is not None:
+            res.append(run_case('midi', 'midi_to_pcm:{:g}s'.format(f.seconds), lambda p=f.path: to_pcm(p), repeat,
+                                audio_seconds=f.seconds))
+    return res
+
+
+def bench_pool(fixtures: List[Fixture], repeat: int, workers: List[Tuple[int, int]]) -> List[Dict[str, Any]]:
+    files = [f.path for f in fixtures]
+    audio_seconds = sum(f.seconds for f in fixtures)
+
+    def serial():
+        # Preprocess and extract each file in turn in this process, as extract_many does across its workers
+        c = Chordino()
+        cache = getattr(c, 'conversion_cache', None)
+        for path in files:
+            conversion = c.preprocess(path)
+            c.extract(conversion or path)
+            if conversion and cache is not None:
+                cache.remove(conversion)
+            elif conversion:
+                os.remove(conversion)
+
+    serial = run_case('pool', 'serial', serial, repeat, audio_seconds=audio_seconds)
+    res = [serial]
+    for num_extractors, num_preprocessors in workers:
+        record = run_case('pool', 'extract_many:{}x{}'.format(num_extractors, num_preprocessors),
+                          lambda e=num_extractors, p=num_preprocessors:
+                          Chordino().extract_many(files, num_extractors=e, num_preprocessors=p),
+                          repeat, audio_seconds=audio_seconds, num_extractors=num_extractors,
+                          num_preprocessors=num_preprocessors, num_files=len(files))
+        if record['seconds'] and serial['seconds']:
+            # Time beyond a perfect split of the serial work between the extraction processes
+            ideal = serial['median'] / min(num_extractors, len(files))
+            record['overhead_seconds'] = record['median'] - ideal
+        res.append(record)
+    return res
+
+
+def _write_audio(args, directory: str) -> List[Fixture]:
+    audio = []
+    for seconds in args.lengths:
+        for sr in args.rates:
+            for extension in args.formats:
+                try:
+                    audio.append(write_audio(directory, seconds, sr, extension))
+                except (sf.LibsndfileError, TypeError, ValueError) as e:
+                    print('Unable to write {} fixture: {}'.format(extension, e), file=sys.stderr)
+    return audio
+
+
+def _run_stages(args, audio: List[Fixture], directory: str) -> List[Dict[str, Any]]:
+    midi = [write_midi(directory, seconds) for seconds in args.lengths]
+    reference = [f for f in audio if f.path.endswith('-22050hz.wav')] or audio[:len(args.lengths)]
+    shortest = min(args.lengths)
+    batch = [f for f in audio if f.seconds == shortest] + [f for f in midi if f.seconds == shortest]
+    if not shutil.which('timidity'):
+        batch = [f for f in batch if not f.path.endswith('.mid')]
+
+    results = []
+    if 'decode' in args.stages:
+        results += bench_decode(audio, args.repeat)
+    if 'plugin' in args.stages:
+        results += bench_plugin(reference, args.repeat)
+    if 'midi' in args.stages:
+        results += bench_midi(midi, args.repeat, directory)
+    if 'pool' in args.stages:
+        workers = [tuple(int(n) for n in w.split('x')) for w in args.workers]
+        results += bench_pool(batch, args.repeat, workers)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+    parser.add_argument('--fixtures', help='Directory to keep generated fixtures in, by default a temporary one')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--lengths', nargs='+', type=float, default=[30, 180], help='Fixture lengths in seconds')
+    parser.add_argument('--rates', nargs='+', type=int, default=[22050, 44100, 48000], help='Fixture sample rates')
+    parser.add_argument('--formats', nargs='+', default=['.wav', '.flac', '.ogg', '.mp3'])
+    parser.add_argument('--workers', nargs='+', default=['1x1', '2x1', '4x2'],
+                        help='extract_many configurations as num_extractors x num_preprocessors')
+    parser.add_argument('--repeat', type=int, default=3, help='Times to run each case')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed runs of each case before timing it')
+    args = parser.parse_args(argv)
+    global warmup
+    warmup = args.warmup
+
+    directory = args.fixtures or tempfile.mkdtemp(prefix='chord-extractor-bench-')
+    os.makedirs(directory, exist_ok=True)
+    try:
+        results = _run_stages(args, _write_audio(args, directory), directory)
+    finally:
+        if not args.fixtures:
+            shutil.rmtree(directory)
+
+    with open(args.output, 'w') as f:
+        json.dump({'version': __version__,
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'cpu_count': os.cpu_count(),
+                   'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                   'args': vars(args),
+                   'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -60,13 +60,58 @@ Extract from many files with multiprocessing::
     res = chordino.extract_many(files_to_extract_from, callback=save_to_db_cb, num_extractors=2,
                                 num_preprocessors=2, max_files_in_cache=10, stop_on_error=False)
     # => LabelledChordSequence(
-    #	    id='/tmp/extractor/d8b8ab2f719e8cf40e7ec01abd116d3a',
+    #	    id='/path/file1.mid',
     #	    sequence=[ChordChange(chord='N', timestamp=0.371519274),
     #	        ChordChange(chord='C', timestamp=0.743038548),
     #	        ChordChange(chord='Am7b5', timestamp=8.54494331),...])
+
+Reuse results across runs with a persistent cache, keyed by file contents and extractor settings::
+
+    from chord_extractor import ResultCache
+
+    chordino = Chordino(roll_on=1, result_cache=ResultCache('/path/results.sqlite', max_size_bytes=2 ** 30))
+    res = chordino.extract_many(files_to_extract_from)
+    chordino.result_cache.stats()
+    # => CacheStats(hits=3, misses=1, entries=4, size_bytes=5120)
+
+Keep large batches of results compact in memory, and save them to a single file::
+
+    from chord_extractor import save_sequences, load_sequences
+
+    res = Chordino(compact_results=True).extract_many(files_to_extract_from, num_extractors=4)
+    save_sequences('/path/results.npz', res)
+    res = load_sequences('/path/results.npz')
 """
 
-from .base import ChordExtractor, clear_conversion_cache
-from .outputs import ChordChange, LabelledChordSequence
+import importlib
+
+# Public names and the submodule each is defined in. They are imported on first access rather than with the package,
+# so that importing chord_extractor (and so every command line run and spawned worker) does not pay for numpy, sqlite3,
+# the process pools or asyncio unless they are used
+_exports = {
+    'ChordExtractor': 'base', 'clear_conversion_cache': 'base',
+    'ResultCache': 'cache', 'ConversionCache': 'cache', 'AudioCache': 'cache', 'CacheStats': 'cache',
+    'ChordChange': 'outputs', 'ChordSequence': 'outputs', 'ChordVocabulary': 'outputs',
+    'LabelledChordSequence': 'outputs', 'ExtractionError': 'outputs', 'ChordFeatures': 'outputs',
+    'save_sequences': 'outputs', 'load_sequences': 'outputs',
+    'MetricsCollector': 'metrics', 'MetricsSink': 'metrics', 'FileMetrics': 'metrics', 'JsonLinesSink': 'metrics',
+    'PrometheusTextfileSink': 'metrics',
+    'ExtractorPool': 'pool',
+    'JobQueue': 'distributed', 'SQLiteJobQueue': 'distributed', 'DistributedWorker': 'distributed',
+    'AsyncExtractorPool': 'aio', 'Overloaded': 'aio',
+    'Audio': 'memory',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module('.' + _exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
 
-__all__ = ['ChordExtractor', 'clear_conversion_cache', 'ChordChange', 'LabelledChordSequence']
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
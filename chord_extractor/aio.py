@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Extraction from asyncio code, e.g. a web service, on process pools that are shared between requests, so that the event
+loop is never blocked and the number of files being worked on is bounded.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+import asyncio
+import copy
+import logging
+import os
+import threading
+import weakref
+from .memory import SharedAudio, _share_tracker
+from .outputs import ChordChange, LabelledChordSequence, ExtractionError
+from .pool import _init_worker, _preprocess, _consume, _extract
+
+_log = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a file is submitted to an AsyncExtractorPool whose admission queue is full."""
+
+
+class AsyncExtractorPool:
+    """
+    Pool of worker processes for extracting with a particular extractor from asyncio code. As in ExtractorPool, files
+    needing preprocessing are converted in one set of processes and extracted from in another, and the extractor is
+    sent to each process once when it starts.
+
+    At most max_concurrency files are worked on at once, which keeps the processes busy without files queueing
+    inside them, so that the time taken for a file is predictable. Files submitted beyond that wait their turn in an
+    admission queue, and once max_queued files are waiting, extract raises Overloaded rather than letting the wait grow
+    without bound, e.g. so that a service can turn requests away.
+
+    Cancelling a call that is waiting for its turn, or whose file has not yet been picked up by a process, withdraws
+    the file. Work already running in a process is left to finish, and its result discarded.
+
+    :param extractor: The ChordExtractor to run in the workers
+    :param num_extractors: Number of extraction processes, by default the number of CPUs
+    :param num_preprocessors: Number of conversion processes
+    :param max_concurrency: Max number of files being worked on at once, by default the total number of processes
+    :param max_queued: Max number of files waiting in the admission queue for calls of extract, or None for no limit.
+     extract_many waits for its turn regardless, as it limits itself to max_concurrency files at once.
+    """
+
+    def __init__(self,
+                 extractor,
+                 num_extractors: Optional[int] = None,
+                 num_preprocessors: int = 1,
+                 max_concurrency: Optional[int] = None,
+                 max_queued: Optional[int] = None):
+        _share_tracker()
+        self.extractor = extractor
+        self.num_extractors = num_extractors or os.cpu_count() or 1
+        self.num_preprocessors = num_preprocessors
+        self.max_concurrency = max_concurrency or self.num_extractors + num_preprocessors
+        self.max_queued = max_queued
+        self._conversion_executor = self._executor(num_preprocessors)
+        self._extractor_executor = self._executor(self.num_extractors)
+        self._executor_lock = threading.Lock()
+        # Created on first use, as asyncio primitives are bound to the loop they are first used in on older Pythons
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._queued = 0
+        # Number of files in progress by path, for those being preprocessed, which share their conversion file (see
+        # ExtractorPool)
+        self._pins: Dict[str, list] = {}
+
+    def _executor(self, processes: int) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(self.extractor,))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self, wait: bool = True):
+        """
+        Shut down the worker processes.
+
+        :param wait: Whether to wait for work already submitted to finish
+        """
+        for executor in (self._conversion_executor, self._extractor_executor):
+            executor.shutdown(wait=wait)
+
+    @property
+    def queued(self) -> int:
+        """Number of files waiting in the admission queue"""
+        return self._queued
+
+    @asynccontextmanager
+    async def _admit(self, reject: bool):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        if reject and self._slots.locked() and self.max_queued is not None and self._queued >= self.max_queued:
+            raise Overloaded('{} files already waiting'.format(self._queued))
+        self._queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._queued -= 1
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    async def _run(self, conversion: bool, fn, *args, on_withdrawn=None, **kwargs):
+        # Run fn in one of the executors, calling on_withdrawn if cancelled before a process has picked it up
+        name = '_conversion_executor' if conversion else '_extractor_executor'
+        executor = getattr(self, name)
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            future = None
+        try:
+            if future is None:
+                raise BrokenProcessPool('A process of the pool terminated abruptly')
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if future.cancel() and on_withdrawn is not None:
+                on_withdrawn()
+            raise
+        except BrokenProcessPool:
+            # A process died (e.g. from a crash in a native library), which breaks the whole executor, so replace it
+            # for the files that follow
+            with self._executor_lock:
+                if getattr(self, name) is executor:
+                    _log.error('Worker process died, restarting the pool')
+                    setattr(self, name, self._executor(self.num_preprocessors if conversion else self.num_extractors))
+                    executor.shutdown(wait=False)
+            raise
+
+    async def _process(self, file: str, stop_on_error: bool) -> LabelledChordSequence:
+        if not self.extractor.needs_preprocessing(file):
+            return await self._run(False, _extract, file, stop_on_error=stop_on_error)
+        key = os.path.abspath(file)
+        pin = self._pins.setdefault(key, [0, None])
+        pin[0] += 1
+        try:
+            path, cached, result_key = await self._run(True, _preprocess, file)
+            if cached is not None:
+                return LabelledChordSequence(id=file, sequence=cached)
+            if isinstance(path, SharedAudio):
+                # Removed by the extraction worker, so if it never gets to run, remove it here
+                return await self._run(False, _consume, path, source=file, remove_path=True,
+                                       stop_on_error=stop_on_error, result_key=result_key,
+                                       on_withdrawn=partial(self.extractor._discard_conversion, path))
+            if path and not self.extractor.conversion_cache.max_size_bytes:
+                pin[1] = path
+            return await self._run(False, _consume, path or file, source=file, stop_on_error=stop_on_error,
+                                   result_key=result_key)
+        finally:
+            pin[0] -= 1
+            if not pin[0]:
+                del self._pins[key]
+                if pin[1] is not None:
+                    self.extractor._discard_conversion(pin[1])
+
+    async def _process_or_fail(self, file: str, stop_on_error: bool) -> LabelledChordSequence:
+        # Process a file for extract_many, which returns errors as results unless stopping on them
+        async with self._admit(reject=False):
+            try:
+                return await self._process(file, stop_on_error=stop_on_error)
+            except Exception as e:
+                if stop_on_error:
+                    raise
+                _log.error('Error has been encountered with extracting chords from {}.'.format(file))
+                _log.error(e)
+                return LabelledChordSequence(id=file, sequence=None, error=ExtractionError(
+                    kind='crash' if isinstance(e, BrokenProcessPool) else 'error',
+                    message='{}: {}'.format(type(e).__name__, e)))
+
+    async def extract(self, file: str) -> List[ChordChange]:
+        """
+        Preprocess and extract chords from a single file, waiting for a turn if max_concurrency files are already
+        being worked on.
+
+        :param file: Path to the file
+        :return: List of chord changes for the sound file (a ChordSequence if the extractor has compact_results set)
+        :raises Overloaded: If max_queued files are already waiting
+        """
+        async with self._admit(reject=True):
+            return (await self._process(file, stop_on_error=True)).sequence
+
+    async def extract_many(self,
+                           files: Union[Iterable[str], AsyncIterable[str]],
+                           stop_on_error=False) -> AsyncIterator[LabelledChordSequence]:
+        """
+        Extract chords from many files, yielding each result as soon as it is ready. Files are taken lazily from an
+        iterable or async iterable, and at most max_concurrency are in progress at once. If the iteration is
+        cancelled or closed early, files still in progress are cancelled as for extract.
+
+        :param files: Iterable or async iterable of paths to files we wish to extract chords for
+        :param stop_on_error: See ChordExtractor.extract_many
+        :return: Async iterator of results in the order the extractions complete
+        """
+        source = _aiter(files)
+        pending = set()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.max_concurrency:
+                    try:
+                        file = await source.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.ensure_future(self._process_or_fail(file, stop_on_error)))
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            if hasattr(source, 'aclose'):
+                await source.aclose()
+
+
+def _aiter(files: Union[Iterable[str], AsyncIterable[str]]) -> AsyncIterator[str]:
+    if hasattr(files, '__aiter__'):
+        return files.__aiter__()
+
+    async def from_iterable():
+        for f in files:
+            yield f
+    return from_iterable()
+
+
+# Pools used by ChordExtractor.aextract and aextract_many, each with the finalizer closing it, by their extractor. The
+# pools run a copy of the extractor, so as not to keep it alive.
+_shared_pools: 'weakref.WeakKeyDictionary[Any, Tuple[AsyncExtractorPool, weakref.finalize]]' = \
+    weakref.WeakKeyDictionary()
+_shared_pools_lock = threading.Lock()
+
+
+def shared_pool(extractor) -> AsyncExtractorPool:
+    """
+    The pool used for an extractor by ChordExtractor.aextract and aextract_many, started with default settings the
+    first time it is needed and kept until it is closed with close_shared_pool, the extractor is garbage collected or
+    the process exits. The pool runs a copy of the extractor taken when it starts, so later changes to the extractor's
+    settings do not affect it.
+
+    :param extractor: The ChordExtractor
+    :return: The pool
+    """
+    with _shared_pools_lock:
+        entry = _shared_pools.get(extractor)
+        if entry is None:
+            pool = AsyncExtractorPool(copy.copy(extractor))
+            entry = _shared_pools[extractor] = pool, weakref.finalize(extractor, pool.close, False)
+        return entry[0]
+
+
+def close_shared_pool(extractor, wait: bool = True):
+    """
+    Shut down the pool used for an extractor by ChordExtractor.aextract and aextract_many, if it has one.
+
+    :param extractor: The ChordExtractor
+    :param wait: Whether to wait for work already submitted to finish
+    """
+    with _shared_pools_lock:
+        entry = _shared_pools.pop(extractor, None)
+    if entry is not None:
+        pool, finalizer = entry
+        finalizer.detach()
+        pool.close(wait=wait)
@@ -18,39 +18,32 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 from abc import ABC, abstractmethod
-from typing import List, Callable, Optional
-import multiprocessing as mp
+from typing import List, Callable, Optional, Tuple, Iterable, Iterator, Union
+from .cache import ResultCache, ConversionCache, file_digest
 from .converters import midi_to_wav
+import json
 import logging
 import os
-import glob
-from .outputs import ChordChange, LabelledChordSequence
-import signal
+from .outputs import ChordChange, ChordSequence, LabelledChordSequence, ExtractionError
+from .memory import Audio, SharedAudio
+from .metrics import MetricsCollector, stage
 
 
 _log = logging.getLogger(__name__)
 _tmp_root = os.getenv('EXTRACTOR_TEMP_FILE_PATH', '/tmp/')
+# Created by the conversion cache when first used
 _tmp_dir = os.path.join(_tmp_root, 'extractor/')
-if not os.path.exists(_tmp_dir):
-    os.makedirs(_tmp_dir)
-
-
-def _convert_to_intermediate_file(instance, path, extract_q, file_count_q):
-    file_count_q.put(path)
-    intermediate_file = getattr(instance, 'preprocess')(path)
-    extract_q.put((intermediate_file, True) if intermediate_file else (path, False))
+_midi_extensions = ['.mid', '.midi']
+# Rough seconds of audio per byte of common formats, for estimating the cost of extracting from a file from its size
+_seconds_per_byte = {'.wav': 1 / 176400, '.aif': 1 / 176400, '.aiff': 1 / 176400, '.flac': 1 / 90000,
+                     '.mp3': 1 / 16000, '.ogg': 1 / 16000, '.m4a': 1 / 16000, '.mid': 1 / 150, '.midi': 1 / 150}
+_default_seconds_per_byte = 1 / 32000
+_conversion_cache = ConversionCache(_tmp_dir, max_size_bytes=int(os.getenv('EXTRACTOR_CONVERSION_CACHE_BYTES', 0)))
 
 
 def clear_conversion_cache():
     """Clear the temporary directory containing sound file conversions."""
-    files = glob.glob(os.path.join(_tmp_dir, '*'))
-    for f in files:
-        os.remove(f)
-
-
-def _error_cb(e):
-    _log.exception(e)
-    os.kill(os.getpid(), signal.SIGKILL)
+    _conversion_cache.clear()
 
 
 class ChordExtractor(ABC):
@@ -58,8 +51,28 @@ class ChordExtractor(ABC):
     Abstract class for extracting chords from sound files. It also provides functionality for sound file conversion,
     which can be added to by overriding .convert. This is useful as implementations using .extract
     may take only certain file formats, and integrating conversion logic here enables it to be parallelized.
+
+    :param result_cache: Optional persistent cache of extraction results. If given, extractions of files whose
+     contents have been extracted before by an extractor with the same identity are returned from the cache.
+    :param conversion_cache: Cache to hold sound file conversions made in preprocessing. If not given, conversions
+     are held in the directory given by the environment variable EXTRACTOR_TEMP_FILE_PATH (/tmp if not specified),
+     limited in size to EXTRACTOR_CONVERSION_CACHE_BYTES if that is specified.
+    :param compact_results: If True, results of extract_many are returned as ChordSequences (see compact), which
+     take a fraction of the memory of lists of ChordChange and are far cheaper to send back from worker processes.
     """
 
+    result_cache: Optional[ResultCache] = None
+    conversion_cache: ConversionCache = _conversion_cache
+    compact_results: bool = False
+
+    def __init__(self, result_cache: Optional[ResultCache] = None,
+                 conversion_cache: Optional[ConversionCache] = None,
+                 compact_results: bool = False):
+        self.result_cache = result_cache
+        self.compact_results = compact_results
+        if conversion_cache is not None:
+            self.conversion_cache = conversion_cache
+
     @abstractmethod
     def extract(self, file: str) -> List[ChordChange]:
         """
@@ -69,21 +82,96 @@ class ChordExtractor(ABC):
         :return: List of chord changes for the sound file
         """
 
-    def preprocess(self, path: str) -> Optional[str]:
+    def identity(self) -> str:
+        """
+        String identifying this extractor and any settings that affect its results. This is used to key the result
+        cache, so implementations with settings should override this to include them.
+
+        :return: Identity of the extractor
+        """
+        return '{}.{}'.format(type(self).__module__, type(self).__qualname__)
+
+    def _result_key(self, file, use_cache: bool = True, **kwargs) -> Optional[Tuple[str, str]]:
+        # Key of the file's result in the result cache, or None if it is not to be cached. Hashing the file is the
+        # costly part, so the key from a lookup is kept to store the result under.
+        if not use_cache or self.result_cache is None or not isinstance(file, str):
+            return None
+        identity = self.identity()
+        if kwargs:
+            identity += json.dumps(kwargs, sort_keys=True, default=str)
+        try:
+            return file_digest(file), identity
+        except OSError:
+            return None
+
+    def _cached_result(self, key: Optional[Tuple[str, str]], file) -> Optional[List[ChordChange]]:
+        if key is None:
+            return None
+        res = self.result_cache.get(*key)
+        if res is not None:
+            _log.info('Returning cached chord extraction for {}.'.format(file))
+        return res
+
+    def _cache_result(self, key: Optional[Tuple[str, str]], result: List[ChordChange]):
+        if key is not None:
+            self.result_cache.put(*key, result)
+
+    def _extract_uncached(self, file):
+        # Run extract without it consulting or updating the result cache. Extractors whose extract uses the cache
+        # override this to pass use_cache=False to it.
+        return self.extract(file)
+
+    def needs_preprocessing(self, path: str) -> bool:
+        """
+        Whether the file at the path needs to go through preprocess before extraction. In extract_many, files that do
+        not are passed straight to an extraction process, skipping the preprocessing stage. This implementation
+        returns True for midi files, or for any file if preprocess has been overridden, so overrides of preprocess
+        should also override this if only some files need preprocessing.
+
+        :param path: Path to the file
+        :return: True if the file should be preprocessed
+        """
+        if type(self).preprocess is not ChordExtractor.preprocess:
+            return True
+        return os.path.splitext(path)[1] in _midi_extensions
+
+    def estimate_cost(self, path: str) -> float:
+        """
+        Estimate the relative cost of extracting from a file, used to schedule expensive files first (see the
+        longest_first argument of extract_many). Only the ordering of the estimates matters. This implementation
+        estimates the duration of the audio in seconds from the size of the file and a typical bit rate for its
+        format, so overrides able to estimate more precisely, e.g. from the file header, should return comparable
+        values.
+
+        :param path: Path to the file
+        :return: Estimated cost, 0 if the file cannot be read
+        """
+        try:
+            size = os.path.getsize(path)
+        except (OSError, TypeError):
+            return 0.
+        return size * _seconds_per_byte.get(os.path.splitext(path)[1].lower(), _default_seconds_per_byte)
+
+    def preprocess(self, path: str) -> Optional[Union[str, Audio]]:
         """
         Run any preprocessing steps based on the location path of the sound file provided. Primarily this is used to
         convert the file at the path, based on its file extension to a file usable by the extract method. However, an
         override of this method can perform any logic that may benefit from multiprocessing available in extract_many.
 
-        In this implementation any midi files are converted to wav files which are placed in a temporary directory
-        (conversion cache).
+        An override may also return the decoded audio itself as an Audio, e.g. to decode files in the preprocessing
+        processes. In extract_many the samples are then placed in a shared memory block, which the extraction process
+        reads in place and frees once done, so nothing is written to disk and the samples are not pickled between
+        processes. extract must then accept an Audio in place of a path.
+
+        In this implementation any midi files are converted to wav files which are placed in the conversion cache.
 
         :param path: Path to the file
-        :return: Return file path to output file of conversion if conversion has happened, else None
+        :return: Return file path to output file of conversion if conversion has happened, or the decoded Audio, else
+         None
         """
         ext = os.path.splitext(path)[1]
-        if ext in ['.mid', '.midi']:
-            return midi_to_wav(path, _tmp_dir)
+        if ext in _midi_extensions:
+            return midi_to_wav(path, self.conversion_cache)
         return None
 
     def extract_many(self,
@@ -92,17 +180,28 @@ class ChordExtractor(ABC):
                      num_extractors: int = 1,
                      num_preprocessors: int = 1,
                      max_files_in_cache: int = 50,
-                     stop_on_error=False) -> List[LabelledChordSequence]:
+                     stop_on_error=False,
+                     metrics: Optional[MetricsCollector] = None,
+                     task_timeout: Optional[float] = None,
+                     max_retries: int = 0,
+                     quarantine_file: Optional[str] = None,
+                     longest_first: bool = False,
+                     balance_workers: bool = False,
+                     deduplicate: bool = False,
+                     max_bytes_in_cache: Optional[int] = None) -> List[LabelledChordSequence]:
         """
         Extract chords from a list of files. As opposed to looping over the .extract method, this one gives the option
         to run many extractions in parallel. Furthermore any file conversions that have to be done as a prerequisite
-        to extraction can also be done in parallel with the extractions.
+        to extraction can also be done in parallel with the extractions. The worker processes last for this call only;
+        to reuse them across many calls, see ExtractorPool.
 
         Files can be a mix of different file formats. If a file is of a format that needs to be converted in
-        preprocessing, it is the conversion that is passed to a queue for extraction. Otherwise the original file will
-        be queued. Any conversions are cached in a temporary folder specified using the environment variable
-        EXTRACTOR_TEMP_FILE_PATH (/tmp if not specified). Note, if in any subsequent extract runs, an existing file
-        conversion is found in the temporary directory, a new conversion will be skipped and the existing one used.
+        preprocessing, it is the conversion that is passed on for extraction once made. Otherwise the original file
+        goes straight to an extraction process (see needs_preprocessing). Any conversions are held in the extractor's
+        conversion cache, keyed by the path and contents of the original file. Note, if in any subsequent extract
+        runs, an existing conversion of the same file is found in the cache, a new conversion will be skipped and the
+        existing one used.
+        If the extractor has a result cache, files found in it skip both conversion and extraction.
 
         :param files: List of paths to files we wish to extract chords for
         :param callback: An optional callable that is called when chords have been extracted from a particular file.
@@ -111,51 +210,192 @@ class ChordExtractor(ABC):
         :param num_preprocessors: Max number of conversion processes to run in parallel
         :param max_files_in_cache: Limit of number of files for a single extract_many run to have in the temporary file
          cache (for file conversions) at any one time. If 0, there is no limit and no conversions will be deleted,
-         otherwise conversions are deleted once extractions are performed (extractions are paused if the file limit
-         is reached).
+         otherwise conversions are deleted once extractions are performed (conversions are paused if the file limit
+         is reached). If the conversion cache is limited in size, conversions are kept for later runs and the cache
+         evicts them as needed instead. Ignored if max_bytes_in_cache is given.
         :param stop_on_error: If True, an error encountered during a single extraction will stop the overall
-         extraction process. Be warned, this means that the parent process will be killed. If False, an error will
-         cause a None result to be returned in the sequence attribute for a particular LabelledChordSequence result.
-        :return: List of tuples, each with the extraction results and id being the file that the extraction was taken
-         from.
-        """
-        m = mp.Manager()
-        extract_q = m.Queue()
-        file_count_q = m.Queue(maxsize=max_files_in_cache)
-        conversion_pool = mp.Pool(processes=num_preprocessors)
-        extractor_pool = mp.Pool(processes=num_extractors)
-        conversions = [conversion_pool.apply_async(_convert_to_intermediate_file,
-                                                   args=(self, file, extract_q, file_count_q))
-                       for file in files]
-        extractions = []
-        while len(extractions) < len(files):
-            path, remove_path = extract_q.get()
-            extractions.append((path, extractor_pool.apply_async(self._consume,
-                                                                 args=(path, file_count_q),
-                                                                 kwds={'remove_path': remove_path
-                                                                                      and not not max_files_in_cache,
-                                                                       'stop_on_error': stop_on_error},
-                                                                 callback=callback,
-                                                                 error_callback=_error_cb)))
-
-        for c in conversions:
-            c.get()
-        res = [a[1].get() for a in extractions]
+         extraction process, with the error raised from this method and any other work in progress abandoned. If
+         False, an error will cause a None result to be returned in the sequence attribute for a particular
+         LabelledChordSequence result, with the error attribute describing it.
+        :param metrics: Optional collector to record the time each file spends in each stage of processing, e.g. to
+         choose between more preprocessors or more extractors (see chord_extractor.metrics)
+        :param task_timeout: If given, files are processed with fault isolation: any preprocessing or extraction of a
+         file taking longer than this many seconds is abandoned, and its process is killed and replaced, as is any
+         process that dies (e.g. from a crash in a native library), without affecting the work on other files.
+        :param max_retries: With task_timeout, the number of times a file that timed out or crashed is tried again
+         before giving up on it
+        :param quarantine_file: With task_timeout, a file listing files that have timed out or crashed on every
+         attempt. These are added to it, and files already in it are skipped, with an error result of kind
+         'quarantined'.
+        :param longest_first: If True, files are submitted in order of their estimated cost (see estimate_cost), most
+         expensive first, rather than in the order given. This shortens the whole run when a batch holds a few files
+         far longer than the rest, which would otherwise be left running on their own at the end.
+        :param balance_workers: If True, the num_extractors + num_preprocessors processes are shared by conversion and
+         extraction, each taking whichever work is most pressing when it becomes free, rather than being fixed to one
+         stage (see ExtractorPool)
+        :param deduplicate: If True, files with the same contents as another file in the batch (e.g. copies under
+         different paths) are only preprocessed and extracted from once, with the result returned for each of their
+         paths. Files are compared by size and a hash of their ends first, and only hashed in full if those match.
+        :param max_bytes_in_cache: If given, replaces max_files_in_cache with a limit on the bytes held by
+         preprocessing results not yet extracted from: audio in shared memory (see preprocess) and conversion files
+         that are deleted once extracted from. Conversions are paused while the limit is reached, and only as many
+         are queued as there are processes to make them, so the limit is exceeded by at most the results of the
+         conversions in progress.
+        :return: List of tuples, each with the extraction results and id being the path of the file (as given in
+         files) that the extraction was taken from, in the order the extractions completed.
+        """
+        res = []
+        for r in self.iter_extract_many(files, num_extractors=num_extractors, num_preprocessors=num_preprocessors,
+                                        max_files_in_cache=max_files_in_cache, max_in_flight=len(files) or None,
+                                        stop_on_error=stop_on_error, metrics=metrics, task_timeout=task_timeout,
+                                        max_retries=max_retries, quarantine_file=quarantine_file,
+                                        longest_first=longest_first, balance_workers=balance_workers,
+                                        deduplicate=deduplicate, max_bytes_in_cache=max_bytes_in_cache):
+            if callback:
+                callback(r)
+            res.append(r)
         return res
 
-    def _consume(self, path, file_count_q, remove_path=False, stop_on_error=False) -> LabelledChordSequence:
+    def iter_extract_many(self,
+                          files: Iterable[str],
+                          num_extractors: int = 1,
+                          num_preprocessors: int = 1,
+                          max_files_in_cache: int = 50,
+                          max_in_flight: Optional[int] = None,
+                          stop_on_error=False,
+                          metrics: Optional[MetricsCollector] = None,
+                          task_timeout: Optional[float] = None,
+                          max_retries: int = 0,
+                          quarantine_file: Optional[str] = None,
+                          longest_first: bool = False,
+                          balance_workers: bool = False,
+                          deduplicate: bool = False,
+                          max_bytes_in_cache: Optional[int] = None) -> Iterator[LabelledChordSequence]:
+        """
+        Extract chords from many files as extract_many does, but yield each result as soon as it is ready rather than
+        returning them all at the end. Files are taken lazily from any iterable (e.g. a generator walking a directory)
+        and only a bounded number are in progress at once, so memory use does not grow with the number of files.
+
+        If the generator is closed before it is exhausted, any extractions still in progress are terminated.
+
+        :param files: Iterable of paths to files we wish to extract chords for
+        :param num_extractors: Max number of extraction processes to run in parallel
+        :param num_preprocessors: Max number of conversion processes to run in parallel
+        :param max_files_in_cache: See extract_many
+        :param max_in_flight: Max number of files that have been submitted but whose results have not yet been
+         yielded. Defaults to four times the total number of processes.
+        :param stop_on_error: See extract_many
+        :param metrics: See extract_many. The callback stage is the time taken by the caller to ask for the next result.
+        :param task_timeout: See extract_many
+        :param max_retries: See extract_many
+        :param quarantine_file: See extract_many
+        :param longest_first: See extract_many. The files are all read from the iterable and sorted before any is
+         submitted.
+        :param balance_workers: See extract_many
+        :param deduplicate: See extract_many. A file is only matched with an earlier one whose result has not yet been
+         yielded, so results are not kept; later copies are extracted from again, or found in the result cache.
+        :param max_bytes_in_cache: See extract_many
+        :return: Iterator of results in the order the extractions complete, each with id being the path of the file
+         the extraction was taken from
+        """
+        from .pool import ExtractorPool
+        with ExtractorPool(self, num_extractors=num_extractors, num_preprocessors=num_preprocessors,
+                           task_timeout=task_timeout, max_retries=max_retries, quarantine_file=quarantine_file,
+                           balance_workers=balance_workers) as pool:
+            yield from pool.iter_extract_many(files, max_files_in_cache=max_files_in_cache,
+                                              max_in_flight=max_in_flight, stop_on_error=stop_on_error,
+                                              metrics=metrics, longest_first=longest_first, deduplicate=deduplicate,
+                                              max_bytes_in_cache=max_bytes_in_cache)
+
+    async def aextract(self, file: str) -> List[ChordChange]:
+        """
+        Preprocess and extract chords from a file without blocking the event loop, on a pool of worker processes that
+        is shared by every call for this extractor (see chord_extractor.aio). For control over the number of
+        processes and the admission queue, use an AsyncExtractorPool directly.
+
+        :param file: Path to the file
+        :return: List of chord changes for the sound file
+        """
+        from .aio import shared_pool
+        return await shared_pool(self).extract(file)
+
+    def aextract_many(self, files, stop_on_error=False):
+        """
+        Extract chords from many files as iter_extract_many does, as an async iterator, on the pool of worker processes
+        shared by aextract::
+
+            async for res in chordino.aextract_many(files):
+                ...
+
+        :param files: Iterable or async iterable of paths to files we wish to extract chords for
+        :param stop_on_error: See extract_many
+        :return: Async iterator of results in the order the extractions complete
+        """
+        from .aio import shared_pool
+        return shared_pool(self).extract_many(files, stop_on_error=stop_on_error)
+
+    def compact(self, result):
+        """
+        Convert a result of extract to the compact form sent back from worker processes in extract_many when
+        compact_results is set. This implementation converts a list of chord changes to a ChordSequence.
+        Implementations whose extract returns something else should override this.
+
+        :param result: Result of extract
+        :return: Compact form of the result
+        """
+        return ChordSequence.from_changes(result)
+
+    def _discard_conversion(self, path: Union[str, SharedAudio]):
+        # Free a conversion made by preprocessing that has been extracted from or never will be
+        if isinstance(path, SharedAudio):
+            path.release()
+        else:
+            self.conversion_cache.remove(path)
+
+    def _output(self, result):
+        return self.compact(result) if self.compact_results and result is not None else result
+
+    def _extract_preprocessed(self, path, source: str):
+        # Extract from the result of preprocessing source. Another run sharing the conversion cache may remove a
+        # conversion file, or the cache evict it, before it is read, in which case the source is converted again.
+        extract = self._extract_uncached
+        if isinstance(path, SharedAudio):
+            return path.apply(extract)
+        attempts = 0
+        while True:
+            try:
+                return extract(path)
+            except Exception:
+                attempts += 1
+                if path == source or not isinstance(path, str) or os.path.exists(path) or attempts == 3:
+                    raise
+            _log.info('Conversion {} of {} was removed before it was read, so converting again.'.format(path, source))
+            path = self.preprocess(source)
+            if path is None:
+                raise ValueError('Unable to convert {} again'.format(source))
+
+    def _consume(self, path, source=None, remove_path=False, stop_on_error=False,
+                 result_key: Optional[Tuple[str, str]] = None) -> LabelledChordSequence:
+        source = source or path
         res = None
+        error = None
         try:
-            res = self.extract(path)
+            # The cache was consulted for the original file before preprocessing, under result_key, so store the result
+            # against that rather than letting extract key it on any intermediate file
+            res = self._extract_preprocessed(path, source)
+            if res is not None:
+                with stage('postprocess'):
+                    self._cache_result(result_key, res)
         except Exception as e:
             _log.error('Error has been encountered with extracting chords from {}.'.format(path))
             if stop_on_error:
                 raise
             _log.exception(e)
             _log.info('Proceeding to next extraction')
-
+            error = ExtractionError(kind='error', message='{}: {}'.format(type(e).__name__, e))
         finally:
-            file_count_q.get()
-        if remove_path:
-            os.remove(path)
-        return LabelledChordSequence(id=path, sequence=res)
+            if remove_path:
+                with stage('postprocess'):
+                    self._discard_conversion(path)
+        with stage('postprocess'):
+            return LabelledChordSequence(id=source, sequence=self._output(res), error=error)
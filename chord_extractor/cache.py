@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Persistent caches keyed by the content of sound files, so that work done in one run can be reused by later runs.
+"""
+
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+from typing import NamedTuple, List, Optional, Callable, Dict, Iterator
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+from .outputs import ChordChange
+
+_log = logging.getLogger(__name__)
+_read_chunk_size = 1 << 20
+
+
+def file_digest(path: str) -> str:
+    """
+    Hash the contents of a file.
+
+    :param path: Path to the file
+    :return: Hex digest of the file contents
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_read_chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def partial_digest(path: str, chunk_size: int = 1 << 16) -> str:
+    """
+    Cheaply fingerprint the contents of a file by its size and a hash of its first and last chunk. Files with
+    different fingerprints certainly differ, while files with the same fingerprint should be compared with file_digest.
+
+    :param path: Path to the file
+    :param chunk_size: Bytes hashed from each end of the file
+    :return: Fingerprint of the file
+    """
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        h.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(chunk_size, size - chunk_size))
+            h.update(f.read(chunk_size))
+    return '{}:{}'.format(size, h.hexdigest())
+
+
+class CacheStats(NamedTuple):
+    """Counters describing the state and effectiveness of a cache."""
+    hits: int
+    misses: int
+    entries: int
+    size_bytes: int
+
+
+class _SQLiteStore:
+    """
+    Common handling of a SQLite database shared between processes, holding entries and usage counters. The total size
+    of the entries is kept up to date by triggers, so eviction need not add it up. Lookups are recorded in memory and
+    written in batches (see _flush_every), as a write transaction for every lookup would have processes queueing on
+    the database lock.
+    """
+
+    # Table of entries, each with a size and an accessed time, if the store holds any
+    _table = ''
+    _schema = ''
+    # Statement updating the access time of an entry, given the time then the key passed to _record
+    _touch = ''
+    # WAL is fastest for processes on one machine, but relies on shared memory so cannot be used over network
+    # filesystems, where the rollback journal must be used instead
+    _journal_mode = 'WAL'
+    # Lookups recorded before they are written, and the seconds after which they are written anyway on the next lookup.
+    # Any left are written when the process exits, unless it is killed.
+    _flush_every = 64
+    _flush_interval = 1.
+
+    def __init__(self, path: str, max_size_bytes: int = 0):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self._conn = None
+        self._pid = None
+        self._reset_pending()
+
+    def __getstate__(self):
+        # Connections cannot be pickled; each process opens its own, and records its own lookups
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        for name in ('_pending_lock', '_finalizer', '_counts', '_accessed', '_pending_pid'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self._pending_lock = threading.Lock()
+        self._finalizer = None
+        self._counts: Dict[str, int] = {}
+        self._accessed: Dict[tuple, float] = {}
+        self._pending_since = 0.
+        self._pending_pid = os.getpid()
+
+    def _connection(self) -> sqlite3.Connection:
+        # A connection inherited from a forked parent must not be used, so check it was opened by this process
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=' + self._journal_mode)
+            conn.executescript('BEGIN IMMEDIATE;' + self._schema + 'CREATE TABLE IF NOT EXISTS counters '
+                               '(name TEXT PRIMARY KEY, value INTEGER NOT NULL);' + self._total_schema() + 'COMMIT;')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _total_schema(self) -> str:
+        if not self._table:
+            return ''
+        return ('CREATE TABLE IF NOT EXISTS total (size INTEGER NOT NULL);'
+                'INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM {0} WHERE NOT EXISTS (SELECT 1 FROM total);'
+                'CREATE TRIGGER IF NOT EXISTS {0}_inserted AFTER INSERT ON {0} '
+                'BEGIN UPDATE total SET size = size + new.size; END;'
+                'CREATE TRIGGER IF NOT EXISTS {0}_deleted AFTER DELETE ON {0} '
+                'BEGIN UPDATE total SET size = size - old.size; END;'
+                'CREATE TRIGGER IF NOT EXISTS {0}_resized AFTER UPDATE OF size ON {0} '
+                'BEGIN UPDATE total SET size = size - old.size + new.size; END;'.format(self._table))
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # A write transaction, which also writes any lookups recorded so far
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._write_pending(conn)
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _record(self, counter: str, key: Optional[tuple] = None):
+        # Count a lookup, and for a hit note the access time of the entry for least recently used eviction
+        if self._pending_pid != os.getpid():
+            # Lookups inherited from a forked parent are the parent's to write
+            self._reset_pending()
+        now = time.time()
+        with self._pending_lock:
+            if not self._counts:
+                self._pending_since = now
+                if self._finalizer is None:
+                    self._finalizer = Finalize(self, self._flush, exitpriority=0)
+            self._counts[counter] = self._counts.get(counter, 0) + 1
+            if key is not None:
+                self._accessed[key] = now
+            due = sum(self._counts.values()) >= self._flush_every or now - self._pending_since >= self._flush_interval
+        if due:
+            self._flush()
+
+    def _write_pending(self, conn: sqlite3.Connection):
+        if self._pending_pid != os.getpid():
+            self._reset_pending()
+            return
+        with self._pending_lock:
+            counts, self._counts = self._counts, {}
+            accessed, self._accessed = self._accessed, {}
+        conn.executemany(self._touch, [(t,) + key for key, t in accessed.items()])
+        self._add_counts(conn, counts)
+
+    @staticmethod
+    def _add_counts(conn: sqlite3.Connection, counts: Dict[str, int]):
+        conn.executemany('INSERT INTO counters (name, value) VALUES (?, ?) '
+                         'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value', counts.items())
+
+    def _flush(self):
+        # Write the lookups recorded by this process
+        if self._counts and self._pending_pid == os.getpid():
+            with self._transaction():
+                pass
+
+    def _evict(self, conn: sqlite3.Connection, on_evict: Callable[[sqlite3.Row], None] = None):
+        # Called within a transaction
+        total = conn.execute('SELECT size FROM total').fetchone()[0]
+        evicted = 0
+        while total > self.max_size_bytes:
+            rows = conn.execute('SELECT rowid, size, * FROM {} ORDER BY accessed LIMIT 16'.format(
+                self._table)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                if total <= self.max_size_bytes:
+                    break
+                conn.execute('DELETE FROM {} WHERE rowid = ?'.format(self._table), (row[0],))
+                if on_evict:
+                    on_evict(row)
+                total -= row[1]
+                evicted += 1
+        if evicted:
+            self._add_counts(conn, {'evictions': evicted})
+
+    def _stats(self) -> CacheStats:
+        self._flush()
+        conn = self._connection()
+        counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+        entries = conn.execute('SELECT COUNT(*) FROM ' + self._table).fetchone()[0]
+        size = conn.execute('SELECT size FROM total').fetchone()[0]
+        return CacheStats(hits=counters.get('hits', 0), misses=counters.get('misses', 0), entries=entries,
+                          size_bytes=size)
+
+    def reset_stats(self):
+        """Set the hit and miss counters back to zero."""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM counters')
+
+    def close(self):
+        """Write any lookups not yet written, and close the connection held by this process."""
+        self._flush()
+        if self._finalizer is not None:
+            self._finalizer.cancel()
+            self._finalizer = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class ResultCache(_SQLiteStore):
+    """
+    On-disk cache of extraction results held in a SQLite database. Entries are keyed by a hash of the sound file
+    contents together with the identity of the extractor (see ChordExtractor.identity), so a result is only reused if
+    both the file and the extractor settings are unchanged. The cache can be shared between processes, therefore
+    between the workers of ChordExtractor.extract_many.
+
+    :param path: Path to the SQLite database file, which is created if it does not exist
+    :param max_size_bytes: Limit on the total size of stored results. Once exceeded, least recently used entries are
+     evicted. If 0, there is no limit.
+    """
+
+    _table = 'results'
+    _schema = ('CREATE TABLE IF NOT EXISTS results (digest TEXT NOT NULL, identity TEXT NOT NULL, '
+               'data BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (digest, identity));'
+               'CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);')
+    _touch = 'UPDATE results SET accessed = ? WHERE digest = ? AND identity = ?'
+
+    def get(self, digest: str, identity: str) -> Optional[List[ChordChange]]:
+        """
+        Look up a stored result.
+
+        :param digest: Hash of the sound file contents (see file_digest)
+        :param identity: Identity of the extractor that produced the result
+        :return: The stored chord changes, or None if there is no entry
+        """
+        conn = self._connection()
+        row = conn.execute('SELECT data FROM results WHERE digest = ? AND identity = ?',
+                           (digest, identity)).fetchone()
+        if row is None:
+            self._record('misses')
+            return None
+        self._record('hits', (digest, identity))
+        return [ChordChange(chord=c, timestamp=t) for c, t in json.loads(zlib.decompress(row[0]))]
+
+    def put(self, digest: str, identity: str, sequence: List[ChordChange]):
+        """
+        Store a result, evicting least recently used entries if the size limit is exceeded.
+
+        :param digest: Hash of the sound file contents (see file_digest)
+        :param identity: Identity of the extractor that produced the result
+        :param sequence: Chord changes to store
+        """
+        data = zlib.compress(json.dumps([[c.chord, c.timestamp] for c in sequence],
+                                        separators=(',', ':')).encode())
+        with self._transaction() as conn:
+            conn.execute('INSERT INTO results (digest, identity, data, size, accessed) VALUES (?, ?, ?, ?, ?) '
+                         'ON CONFLICT (digest, identity) DO UPDATE SET data = excluded.data, size = excluded.size, '
+                         'accessed = excluded.accessed', (digest, identity, data, len(data), time.time()))
+            if self.max_size_bytes:
+                self._evict(conn)
+
+    def invalidate(self, file: Optional[str] = None, identity: Optional[str] = None) -> int:
+        """
+        Remove entries from the cache. With no arguments every entry is removed.
+
+        :param file: If given, only remove entries for the contents of this file
+        :param identity: If given, only remove entries produced by an extractor with this identity
+        :return: Number of entries removed
+        """
+        clauses, args = [], []
+        if file is not None:
+            clauses.append('digest = ?')
+            args.append(file_digest(file))
+        if identity is not None:
+            clauses.append('identity = ?')
+            args.append(identity)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return self._connection().execute('DELETE FROM results' + where, args).rowcount
+
+    def stats(self) -> CacheStats:
+        """
+        Counters for this cache, accumulated across all processes using it. Lookups by other processes are only
+        counted once written, which they are in batches and when each process exits.
+        """
+        return self._stats()
+
+
+class ConversionCache(_SQLiteStore):
+    """
+    Directory of converted sound files (e.g. wavs rendered from midis), keyed by the path and a hash of the contents
+    of the source file, and the conversion settings. Each source path has its own conversion, as conversions are
+    deleted once extracted from (see ChordExtractor.extract_many), which a copy of the file elsewhere that is being
+    extracted from at the same time could otherwise still be using. Conversions are written to a temporary file and
+    renamed into place once complete, so a partially written file is never returned. An index of the entries is kept
+    in a SQLite database in the same directory, which allows the cache to be bounded by total size and shared between
+    concurrent processes. A conversion returned by fetch may still be removed by another process, or evicted, before
+    it is read; extraction then converts the file again.
+
+    :param directory: Directory to hold the conversions, which is created if it does not exist
+    :param max_size_bytes: Limit on the total size of conversions. Once exceeded, least recently used conversions are
+     deleted. If 0, there is no limit.
+    """
+
+    _index_name = '.index.sqlite'
+    _table = 'conversions'
+    _schema = ('CREATE TABLE IF NOT EXISTS conversions (name TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+               'accessed REAL NOT NULL);'
+               'CREATE INDEX IF NOT EXISTS conversions_accessed ON conversions (accessed);')
+    _touch = 'UPDATE conversions SET accessed = ? WHERE name = ?'
+
+    def __init__(self, directory: str, max_size_bytes: int = 0):
+        super().__init__(os.path.join(directory, self._index_name), max_size_bytes)
+        self.directory = directory
+
+    def fetch(self, source: str, settings: str, convert: Callable[[str, str], bool],
+              extension: str = '') -> Optional[str]:
+        """
+        Get the conversion of a file, running the conversion if it is not already in the cache.
+
+        :param source: Path to the file to convert
+        :param settings: String identifying the conversion and any settings affecting its output
+        :param convert: Callable taking the source path and a destination path, which writes the conversion to the
+         destination and returns whether it was successful
+        :param extension: File extension to give the conversion
+        :return: Path to the conversion, or None if the conversion was unsuccessful
+        """
+        key = self._key(source, settings)
+        name = key + extension
+        path = os.path.join(self.directory, name)
+        # Opening the index creates the directory
+        self._connection()
+        if os.path.isfile(path):
+            self._record('hits', (name,))
+            _log.info('Returning already existing conversion {} of {}'.format(path, source))
+            return path
+        self._record('misses')
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + key, suffix='.tmp', dir=self.directory)
+        os.close(fd)
+        try:
+            if not convert(source, tmp_path):
+                return None
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._transaction() as conn:
+            conn.execute('INSERT INTO conversions (name, size, accessed) VALUES (?, ?, ?) ON CONFLICT (name) '
+                         'DO UPDATE SET size = excluded.size, accessed = excluded.accessed',
+                         (name, os.path.getsize(path), time.time()))
+            if self.max_size_bytes:
+                self._evict(conn, on_evict=lambda row: self._unlink(row[2]))
+        return path
+
+    def _key(self, source: str, settings: str) -> str:
+        return hashlib.blake2b('{}:{}:{}'.format(file_digest(source), os.path.abspath(source), settings).encode(),
+                               digest_size=20).hexdigest()
+
+    def _unlink(self, name: str):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def remove(self, path: str):
+        """
+        Delete a conversion from the cache. Paths outside the cache directory are simply deleted. A conversion that is
+        already gone, e.g. evicted, is ignored.
+
+        :param path: Path to the conversion
+        """
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.directory):
+            self._connection().execute('DELETE FROM conversions WHERE name = ?', (os.path.basename(path),))
+
+    def clear(self):
+        """Delete every conversion in the cache directory."""
+        if not os.path.isdir(self.directory):
+            return
+        conn = self._connection()
+        for name in os.listdir(self.directory):
+            if not name.startswith(self._index_name) and os.path.isfile(os.path.join(self.directory, name)):
+                self._unlink(name)
+        conn.execute('DELETE FROM conversions')
+
+    def stats(self) -> CacheStats:
+        """Counters for this cache, accumulated across all processes using it (see ResultCache.stats)."""
+        return self._stats()
+
+
+class AudioCache(ConversionCache):
+    """
+    Cache of decoded audio, holding each signal as a float32 .npy file keyed by a hash of the source file contents and
+    the decoding settings. Cached signals are returned memory-mapped rather than read into memory, so processes
+    extracting from the same file share the page-cached data and a re-run skips decoding entirely. As entries are only
+    ever deleted by eviction, unlike conversions, copies of a file share one entry wherever they are.
+
+    :param directory: Directory to hold the decoded audio, which is created if it does not exist
+    :param max_size_bytes: Limit on the total size of decoded audio. Once exceeded, least recently used entries are
+     deleted. If 0, there is no limit.
+    """
+
+    def _key(self, source: str, settings: str) -> str:
+        return hashlib.blake2b('{}:{}'.format(file_digest(source), settings).encode(), digest_size=20).hexdigest()
+
+    def fetch_array(self, source: str, settings: str, decode: Callable[[str], np.ndarray]) -> np.ndarray:
+        """
+        Get the decoded signal of a file, decoding it if it is not already in the cache.
+
+        :param source: Path to the sound file
+        :param settings: String identifying the decoding and any settings affecting its output (e.g. sample rate)
+        :param decode: Callable taking the source path and returning the decoded signal
+        :return: Read-only signal, backed by a memory map of the cached file
+        """
+        def convert(src, dest):
+            data = np.ascontiguousarray(decode(src), dtype=np.float32)
+            with open(dest, 'wb') as f:
+                np.save(f, data)
+            return True
+
+        while True:
+            path = self.fetch(source, settings, convert, extension='.npy')
+            try:
+                # A plain ndarray view of the memmap, as vamp does not accept ndarray subclasses
+                return np.asarray(np.load(path, mmap_mode='r'))
+            except FileNotFoundError:
+                # Evicted by another process between fetching and mapping, so decode again
+                continue
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+The chord-extractor command, which extracts chords from many files with Chordino and appends the results to a JSON
+lines file. Completed files are recorded in an append-only journal, so that a run that is interrupted can be restarted
+with the same command and picks up where it left off.
+
+With --queue, the work is distributed through a job queue on shared storage: the command puts the files on the queue
+and collects the results, while the extraction is done by commands run with --queue and --worker on any number of
+machines.
+"""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+from .cache import ResultCache
+from .distributed import SQLiteJobQueue, DistributedWorker
+from .metrics import MetricsCollector, JsonLinesSink, PrometheusTextfileSink
+from .outputs import LabelledChordSequence
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_EXTENSIONS = ['.mid', '.midi', '.wav', '.mp3', '.ogg', '.flac', '.aiff', '.aif', '.m4a']
+
+
+def find_files(inputs: Iterable[str], extensions: Iterable[str]) -> Iterator[str]:
+    """
+    Expand the inputs to the command into the files to extract from, without repeats.
+
+    :param inputs: Files, directories (searched recursively for files with the given extensions) or glob patterns
+    :param extensions: File extensions to look for in directories
+    :return: Iterator of absolute file paths
+    """
+    extensions = {e.lower() for e in extensions}
+    seen = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = []
+            for root, dirs, names in os.walk(item):
+                dirs.sort()
+                paths.extend(os.path.join(root, n) for n in sorted(names)
+                             if os.path.splitext(n)[1].lower() in extensions)
+        elif os.path.exists(item):
+            paths = [item]
+        else:
+            paths = sorted(glob.glob(item, recursive=True))
+            if not paths:
+                _log.warning('No files found for {}'.format(item))
+        for path in paths:
+            path = os.path.abspath(path)
+            if path not in seen and os.path.isfile(path):
+                seen.add(path)
+                yield path
+
+
+def read_manifest(path: str) -> List[str]:
+    """
+    Read a manifest of inputs, one per line. Blank lines and lines starting with # are ignored.
+
+    :param path: Path to the manifest, or - for standard input
+    :return: The inputs
+    """
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class Journal:
+    """
+    Append-only record of the files a run has completed, one JSON object per line. Lines are flushed as they are
+    written, and a line left incomplete by a crash is ignored when the journal is read back.
+
+    :param path: Path of the journal file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def completed(self, include_failed: bool = True) -> Set[str]:
+        """
+        Files recorded as completed.
+
+        :param include_failed: Whether to include files whose extraction failed
+        :return: Paths of the files
+        """
+        res = set()
+        if not os.path.exists(self.path):
+            return res
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry['ok'] or include_failed:
+                    res.add(entry['id'])
+                else:
+                    res.discard(entry['id'])
+        return res
+
+    def record(self, file: str, ok: bool):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps({'id': file, 'ok': ok}) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _parse_params(items: List[str]) -> Dict[str, object]:
+    params = {}
+    for item in items:
+        key, _, value = item.partition('=')
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='chord-extractor', description=__doc__.strip())
+    parser.add_argument('inputs', nargs='*', help='Files, directories or glob patterns of files to extract from')
+    parser.add_argument('-m', '--manifest', help='File listing inputs, one per line (- for standard input)')
+    parser.add_argument('-o', '--output', help='JSON lines file the results are appended to (required unless --worker)')
+    parser.add_argument('--journal', help='Journal of completed files (default: the output path + .journal)')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Extract again from files whose extraction failed in an earlier run')
+    parser.add_argument('--extensions', nargs='+', default=DEFAULT_EXTENSIONS,
+                        help='File extensions to look for in directories')
+    parser.add_argument('-j', '--num-extractors', type=int, default=os.cpu_count() or 1,
+                        help='Number of extraction processes (default: number of CPUs)')
+    parser.add_argument('-p', '--num-preprocessors', type=int, default=1, help='Number of conversion processes')
+    parser.add_argument('--max-files-in-cache', type=int, default=50, help='See ChordExtractor.extract_many')
+    parser.add_argument('--max-bytes-in-cache', type=int,
+                        help='See ChordExtractor.extract_many (replaces --max-files-in-cache)')
+    parser.add_argument('--max-in-flight', type=int, help='See ChordExtractor.iter_extract_many')
+    parser.add_argument('--longest-first', action='store_true',
+                        help='Extract from the files estimated to take longest first (lists all files before starting)')
+    parser.add_argument('--balance-workers', action='store_true',
+                        help='Share the processes between conversion and extraction rather than fixing them to one')
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='Extract once from files with the same contents, writing the result for each '
+                             '(not with --queue)')
+    parser.add_argument('--task-timeout', type=float,
+                        help='Seconds after which a file is abandoned and its process replaced '
+                             '(enables fault isolation)')
+    parser.add_argument('--max-retries', type=int, default=0,
+                        help='Times a file that timed out or crashed its process is retried (with --task-timeout)')
+    parser.add_argument('--quarantine', help='File listing files to skip after they timed out or crashed '
+                                             '(with --task-timeout, default: the output path + .quarantine)')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='Chordino parameter, e.g. roll_on=2 (may be repeated)')
+    parser.add_argument('--decoder', choices=['librosa', 'soundfile', 'ffmpeg'], default='librosa',
+                        help='How sound files are decoded (see Chordino)')
+    parser.add_argument('--midi-in-memory', action='store_true', help='Render midi in memory (see Chordino)')
+    parser.add_argument('--decode-in-preprocessing', action='store_true',
+                        help='Decode files in the conversion processes, passing the audio on in shared memory '
+                             '(see Chordino)')
+    parser.add_argument('--result-cache', help='SQLite file to cache results in across runs')
+    parser.add_argument('--metrics', help='JSON lines file to append per-file stage timings to')
+    parser.add_argument('--prometheus', help='Prometheus textfile to write aggregated metrics to')
+    parser.add_argument('--queue', help='SQLite job queue on shared storage to distribute the files through')
+    parser.add_argument('--worker', action='store_true',
+                        help='Extract from files on the queue until it is empty, rather than adding files to it')
+    parser.add_argument('--lease', type=float, default=300,
+                        help='With --worker, seconds after which files claimed by a worker that stopped responding '
+                             'go back on the queue')
+    parser.add_argument('--log-level', default='WARNING', help='Logging level (default: WARNING)')
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Run the chord-extractor command.
+
+    :param argv: Command line arguments, by default those of the process
+    :return: Exit status, 1 if any extraction failed and 0 otherwise
+    """
+    parser = _parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    from .extractors import Chordino, DecodeBackend
+
+    chordino = Chordino(result_cache=ResultCache(args.result_cache) if args.result_cache else None,
+                        decoder=DecodeBackend(args.decoder), midi_in_memory=args.midi_in_memory,
+                        decode_in_preprocessing=args.decode_in_preprocessing,
+                        **_parse_params(args.param))
+    if args.worker:
+        if not args.queue:
+            parser.error('--worker requires --queue')
+        return _run_worker(args, chordino)
+    if not args.output:
+        parser.error('the following arguments are required: -o/--output')
+
+    inputs = list(args.inputs) + (read_manifest(args.manifest) if args.manifest else [])
+    if not inputs:
+        parser.error('no inputs given')
+    journal = Journal(args.journal or args.output + '.journal')
+    completed = journal.completed(include_failed=not args.retry_failed)
+    if completed:
+        _log.warning('Skipping {} files completed by an earlier run'.format(len(completed)))
+    files = (f for f in find_files(inputs, args.extensions) if f not in completed)
+
+    # With a queue, the workers doing the extraction record the metrics
+    metrics = None if args.queue else _metrics(args)
+    results = _queue_results(args, chordino, files) if args.queue else \
+        chordino.iter_extract_many(files, num_extractors=args.num_extractors,
+                                   num_preprocessors=args.num_preprocessors,
+                                   max_files_in_cache=args.max_files_in_cache, max_in_flight=args.max_in_flight,
+                                   metrics=metrics, task_timeout=args.task_timeout, max_retries=args.max_retries,
+                                   quarantine_file=args.quarantine or args.output + '.quarantine',
+                                   longest_first=args.longest_first, balance_workers=args.balance_workers,
+                                   deduplicate=args.deduplicate, max_bytes_in_cache=args.max_bytes_in_cache)
+    failures = 0
+    done = 0
+    try:
+        with open(args.output, 'a') as out:
+            for res in results:
+                _write(out, res)
+                # The result is written before the journal entry, so a crash in between repeats the file rather than
+                # losing it
+                journal.record(res.id, res.sequence is not None)
+                failures += res.sequence is None
+                done += 1
+                if done % 100 == 0:
+                    _log.warning('{} files done, {} failed'.format(done, failures))
+    finally:
+        journal.close()
+        if metrics is not None:
+            metrics.close()
+    _log.warning('Finished: {} files done, {} failed'.format(done, failures))
+    return 1 if failures else 0
+
+
+def _run_worker(args, chordino) -> int:
+    metrics = _metrics(args)
+    worker = DistributedWorker(chordino, SQLiteJobQueue(args.queue), num_extractors=args.num_extractors,
+                               num_preprocessors=args.num_preprocessors, task_timeout=args.task_timeout,
+                               max_retries=args.max_retries, quarantine_file=args.quarantine,
+                               balance_workers=args.balance_workers,
+                               max_files_in_cache=args.max_files_in_cache, max_in_flight=args.max_in_flight,
+                               lease_seconds=args.lease, metrics=metrics, max_bytes_in_cache=args.max_bytes_in_cache)
+    try:
+        _log.warning('Worker {} finished: {} files done'.format(worker.worker_id, worker.run()))
+    finally:
+        if metrics is not None:
+            metrics.close()
+    return 0
+
+
+def _queue_results(args, chordino, files: Iterable[str]) -> Iterator[LabelledChordSequence]:
+    queue = SQLiteJobQueue(args.queue)
+    if args.longest_first:
+        # Workers claim files in the order they were added
+        files = sorted(files, key=chordino.estimate_cost, reverse=True)
+    _log.warning('Added {} files to the queue'.format(queue.put(files)))
+    return queue.iter_results()
+
+
+def _metrics(args) -> Optional[MetricsCollector]:
+    sinks = []
+    if args.metrics:
+        sinks.append(JsonLinesSink(args.metrics))
+    if args.prometheus:
+        sinks.append(PrometheusTextfileSink(args.prometheus, interval=30))
+    return MetricsCollector(sinks) if sinks else None
+
+
+def _write(out, res: LabelledChordSequence):
+    chords = None if res.sequence is None else [[c.chord, c.timestamp] for c in res.sequence]
+    entry = {'id': res.id, 'chords': chords}
+    if res.error is not None:
+        entry['error'] = res.error._asdict()
+    out.write(json.dumps(entry) + '\n')
+    out.flush()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
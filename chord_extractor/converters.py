@@ -17,32 +17,55 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os
+from typing import Optional, Tuple, Union
+from .cache import ConversionCache
+import numpy as np
 import subprocess
 import logging
 
 _log = logging.getLogger(__name__)
 
 
-def midi_to_wav(midi_path: str, wav_to_dir: str):
+def _timidity_to_wav(midi_path: str, wav_file: str) -> bool:
+    _log.info('Running timidity on {} to create {}'.format(midi_path, wav_file))
+    result = subprocess.run(['timidity', midi_path, '-Ow', '-o', wav_file], stdout=subprocess.PIPE, text=True,
+                            errors="replace")
+    if "Not a MIDI file!" in result.stdout:
+        _log.error('Invalid midi file at {}'.format(midi_path))
+        return False
+    return True
+
+
+def midi_to_pcm(midi_path: str, sr: int = 22050) -> Optional[Tuple[np.ndarray, int]]:
+    """
+    Render midi at given path to a mono signal in memory using Timidity (http://timidity.sourceforge.net/), which
+    writes raw PCM to a pipe rather than to a wav file on disk.
+
+    :param midi_path: Path to input midi file
+    :param sr: Sample rate to render at
+    :return: Tuple of the signal and its sample rate, or None if the midi file is invalid
+    """
+    _log.info('Running timidity on {} to render it in memory'.format(midi_path))
+    result = subprocess.run(['timidity', midi_path, '-Or', '--output-mono', '--output-signed', '--output-16bit',
+                             '-s', str(sr), '-o', '-'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # With the audio going to stdout, timidity reports errors on stderr, but check both in case of older versions
+    if b'Not a MIDI file!' in result.stderr or b'Not a MIDI file!' in result.stdout:
+        _log.error('Invalid midi file at {}'.format(midi_path))
+        return None
+    pcm = np.frombuffer(result.stdout, dtype=np.int16, count=len(result.stdout) // 2)
+    return pcm.astype(np.float32) / 32768, sr
+
+
+def midi_to_wav(midi_path: str, wav_to_dir: Union[str, ConversionCache]) -> Optional[str]:
     """
     Convert midi at given path to wav file and save in specified output directory. This is done using
-    Timidity (http://timidity.sourceforge.net/). If an invalid midi file is passed, note that no exception is raised
-    and an output file containing invalid wav data.
+    Timidity (http://timidity.sourceforge.net/). The output directory is treated as a conversion cache, with the wav
+    named after a hash of the midi path and contents, so the conversion is skipped if the same midi has been converted
+    before.
 
     :param midi_path: Path to input midi file
-    :param wav_to_dir: Path to the output directory
-    :return: Path to the new wav file
+    :param wav_to_dir: Path to the output directory, or the conversion cache to use
+    :return: Path to the new wav file, or None if the midi file is invalid
     """
-    base = os.path.basename(midi_path)
-    file_name = os.path.splitext(base)[0]
-    wav_file = os.path.join(wav_to_dir, file_name)
-    if not os.path.isfile(wav_file):
-        _log.info('Running timidity on {} to create {}'.format(midi_path, wav_file))
-        result = subprocess.run(['timidity', midi_path, '-Ow', '-o', wav_file], stdout=subprocess.PIPE, text=True, errors="replace")
-        if "Not a MIDI file!" in result.stdout:
-            _log.error('Invalid midi file at {}'.format(midi_path))
-            return None
-    else:
-        _log.info('Returning already existing temporary wav file {}'.format(wav_file))
-    return wav_file
+    cache = wav_to_dir if isinstance(wav_to_dir, ConversionCache) else ConversionCache(wav_to_dir)
+    return cache.fetch(midi_path, 'timidity-wav', _timidity_to_wav, extension='.wav')
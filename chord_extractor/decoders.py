@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Functions for decoding sound files into mono float32 signals, as alternatives to loading a whole file with librosa.
+"""
+
+from typing import Iterator, Optional, Tuple
+import logging
+import subprocess
+import tempfile
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+
+def load_soundfile(file: str, sr: Optional[int] = 22050, quality: str = 'HQ', offset: float = 0.,
+                   duration: Optional[float] = None) -> Tuple[np.ndarray, int]:
+    """
+    Decode a whole sound file with soundfile, mixing down to mono and resampling with soxr. This skips the fallback
+    to audioread in librosa.load, and allows a faster resampling quality to be chosen. Only formats readable by
+    soundfile (e.g. wav, flac, ogg, and mp3 with recent versions of libsndfile) are supported.
+
+    :param file: Path to the sound file
+    :param sr: Sample rate to resample to, or None to keep the native sample rate
+    :param quality: soxr resampling quality, one of 'VHQ', 'HQ', 'MQ', 'LQ' or 'QQ' (fastest)
+    :param offset: Seconds into the file to start decoding at, which is sought to rather than decoded up to
+    :param duration: Seconds of audio to decode, or None to decode to the end of the file
+    :return: Tuple of the signal and its sample rate
+    :raises soundfile.LibsndfileError: If the file cannot be opened by soundfile
+    """
+    # Imported here rather than with the module, to keep importing chord_extractor quick
+    import soundfile as sf
+    import soxr
+    with sf.SoundFile(file) as f:
+        native_rate = f.samplerate
+        if offset:
+            f.seek(min(int(offset * native_rate), f.frames))
+        data = f.read(-1 if duration is None else int(duration * native_rate), dtype='float32', always_2d=True)
+    data = data.mean(axis=1, dtype=np.float32)
+    rate = sr or native_rate
+    if rate != native_rate:
+        data = soxr.resample(data, native_rate, rate, quality=quality)
+    return data, rate
+
+
+def _ffmpeg_command(file: str, rate: int, offset: float = 0., duration: Optional[float] = None):
+    # Seeking before the input seeks in the file rather than decoding up to the offset
+    span = (['-ss', str(offset)] if offset else []) + (['-t', str(duration)] if duration is not None else [])
+    return ['ffmpeg', '-v', 'error', '-nostdin'] + span + \
+        ['-i', file, '-map', '0:a:0', '-f', 'f32le', '-ac', '1', '-ar', str(rate), '-']
+
+
+def probe_sample_rate(file: str) -> int:
+    """
+    Find the sample rate of the first audio stream of a file using ffprobe.
+
+    :param file: Path to the sound file
+    :return: Sample rate
+    """
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=sample_rate',
+                             '-of', 'csv=p=0', file], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return int(result.stdout.split()[0])
+
+
+def load_ffmpeg(file: str, sr: Optional[int] = 22050, offset: float = 0.,
+                duration: Optional[float] = None) -> Tuple[np.ndarray, int]:
+    """
+    Decode a whole sound file by piping it through ffmpeg, which mixes down to mono and resamples as it decodes.
+    This supports any format ffmpeg does, and is usually much faster than librosa.load for compressed formats.
+
+    :param file: Path to the sound file
+    :param sr: Sample rate to resample to, or None to keep the native sample rate
+    :param offset: Seconds into the file to start decoding at, which is sought to rather than decoded up to
+    :param duration: Seconds of audio to decode, or None to decode to the end of the file
+    :return: Tuple of the signal and its sample rate
+    :raises subprocess.CalledProcessError: If ffmpeg cannot decode the file
+    """
+    rate = sr or probe_sample_rate(file)
+    result = subprocess.run(_ffmpeg_command(file, rate, offset, duration), stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32), rate
+
+
+def stream_ffmpeg(file: str, sr: Optional[int] = 22050, block_frames: int = 65536) -> Tuple[int, Iterator[np.ndarray]]:
+    """
+    Decode a sound file block by block by piping it through ffmpeg, so that only a block of the file is held in memory
+    at once. See load_ffmpeg.
+
+    :param file: Path to the sound file
+    :param sr: Sample rate to resample to, or None to keep the native sample rate
+    :param block_frames: Number of frames to read at a time
+    :return: Tuple of the sample rate of the signal and an iterator of consecutive blocks of it
+    """
+    rate = sr or probe_sample_rate(file)
+
+    def blocks():
+        # Errors go to a file, as a pipe only read once decoding ends could fill up and stall ffmpeg
+        errors = tempfile.TemporaryFile()
+        process = subprocess.Popen(_ffmpeg_command(file, rate), stdout=subprocess.PIPE, stderr=errors)
+        try:
+            block_bytes = 4 * block_frames
+            while True:
+                chunk = process.stdout.read(block_bytes)
+                if not chunk:
+                    break
+                # Keep whole samples only, carrying any remainder on to the next read
+                whole = len(chunk) - len(chunk) % 4
+                if whole < len(chunk):
+                    chunk += process.stdout.read(4 - len(chunk) % 4)
+                    whole = len(chunk)
+                yield np.frombuffer(chunk[:whole], dtype=np.float32)
+            if process.wait() != 0:
+                errors.seek(0)
+                raise subprocess.CalledProcessError(process.returncode, process.args, stderr=errors.read())
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            errors.close()
+
+    return rate, blocks()
+
+
+def stream_audio(file: str, sr: Optional[int] = 22050, block_frames: int = 65536,
+                 quality: str = 'HQ') -> Tuple[int, Iterator[np.ndarray]]:
+    """
+    Decode a sound file block by block, mixing down to mono and resampling as librosa.load does, so that only a
+    block of the file is held in memory at once. Only formats readable by soundfile (e.g. wav, flac, ogg, and mp3 with
+    recent versions of libsndfile) are supported.
+
+    :param file: Path to the sound file
+    :param sr: Sample rate to resample to, or None to keep the native sample rate
+    :param block_frames: Number of frames to decode at a time
+    :param quality: soxr resampling quality, one of 'VHQ', 'HQ', 'MQ', 'LQ' or 'QQ' (fastest)
+    :return: Tuple of the sample rate of the signal and an iterator of consecutive blocks of it
+    :raises soundfile.LibsndfileError: If the file cannot be opened by soundfile
+    """
+    import soundfile as sf
+    import soxr
+    f = sf.SoundFile(file)
+    rate = sr or f.samplerate
+
+    def blocks():
+        with f:
+            resampler = soxr.ResampleStream(f.samplerate, rate, 1, dtype='float32',
+                                            quality=quality) if rate != f.samplerate else None
+            for block in f.blocks(blocksize=block_frames, dtype='float32', always_2d=True):
+                mono = block.mean(axis=1, dtype=np.float32)
+                yield resampler.resample_chunk(mono) if resampler else mono
+            if resampler:
+                yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+    return rate, blocks()
+
+
+def frames_from_blocks(blocks: Iterator[np.ndarray], step_size: int, frame_size: int) -> Iterator[np.ndarray]:
+    """
+    Generate frames of a signal given as consecutive blocks, in the same way as vamp.frames.frames_from_array does
+    for a whole signal. Frames start every step_size samples, and those extending past the end are zero padded.
+
+    :param blocks: Iterator of consecutive 1d blocks of the signal
+    :param step_size: Number of samples between the starts of consecutive frames
+    :param frame_size: Number of samples in a frame
+    :return: Iterator of frames, each of shape (1, frame_size)
+    """
+    buf = np.zeros(0, dtype=np.float32)
+    for block in blocks:
+        buf = np.concatenate((buf, block))
+        while len(buf) >= frame_size:
+            yield buf[:frame_size].reshape(1, frame_size)
+            buf = buf[step_size:]
+    while len(buf):
+        yield np.pad(buf[:frame_size], (0, max(0, frame_size - len(buf)))).reshape(1, frame_size)
+        buf = buf[step_size:]
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Extraction distributed across machines through a shared job queue. A coordinator puts files on the queue and collects
+the results, while workers on any number of machines claim files from it, extract from them with an ExtractorPool and
+write the results back::
+
+    # On the coordinator
+    queue = SQLiteJobQueue('/shared/jobs.sqlite')
+    queue.put(files)
+    for res in queue.iter_results():
+        ...
+
+    # On each worker machine
+    DistributedWorker(Chordino(), SQLiteJobQueue('/shared/jobs.sqlite'), num_extractors=16).run()
+
+Workers hold a lease on each file they claim, which they renew while working on it. If a worker dies or loses contact
+with the queue, its leases expire and the files go back on the queue for another worker to claim. Files must be
+readable at the same paths on every machine, e.g. on a shared filesystem.
+"""
+
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from .cache import _SQLiteStore
+from .metrics import MetricsCollector
+from .outputs import ChordChange, LabelledChordSequence, ExtractionError
+from .pool import ExtractorPool
+
+_log = logging.getLogger(__name__)
+
+
+class Job(NamedTuple):
+    """
+    A file claimed from a job queue.
+
+    :param id: Identifier of the job in the queue
+    :param file: Path of the file to extract from
+    :param attempts: Number of times the file has been claimed, including this one
+    """
+    id: int
+    file: str
+    attempts: int
+
+
+class JobQueue(ABC):
+    """
+    Queue of files to extract from, shared between a coordinator and workers that may be on different machines.
+    Implementations must be safe to use from many processes at once. SQLiteJobQueue is the reference implementation.
+    """
+
+    @abstractmethod
+    def put(self, files: Iterable[str]) -> int:
+        """
+        Add files to the queue. Files already in the queue, whether waiting, being worked on or with results not yet
+        collected, are not added again.
+
+        :param files: Paths of the files
+        :return: Number of files added
+        """
+
+    @abstractmethod
+    def claim(self, worker: str, lease_seconds: float, limit: int = 1) -> List[Job]:
+        """
+        Take files waiting in the queue, leasing them to a worker. Files whose leases have expired are first returned
+        to the queue.
+
+        :param worker: Identifier of the worker
+        :param lease_seconds: Seconds until the leases expire, unless renewed
+        :param limit: Maximum number of files to take
+        :return: The jobs claimed, empty if there are no files waiting
+        """
+
+    @abstractmethod
+    def renew(self, worker: str, lease_seconds: float) -> int:
+        """
+        Extend every lease held by a worker.
+
+        :param worker: Identifier of the worker
+        :param lease_seconds: Seconds from now until the leases expire
+        :return: Number of leases renewed
+        """
+
+    @abstractmethod
+    def complete(self, worker: str, job: Job, result: LabelledChordSequence) -> bool:
+        """
+        Record the result of a job, if the worker still holds its lease.
+
+        :param worker: Identifier of the worker
+        :param job: The job, as claimed
+        :param result: Result of extracting from the file
+        :return: True if the result was recorded, False if the lease had been lost to another worker
+        """
+
+    @abstractmethod
+    def release(self, worker: str) -> int:
+        """
+        Return the files leased to a worker to the queue, e.g. when it shuts down before finishing them.
+
+        :param worker: Identifier of the worker
+        :return: Number of files returned
+        """
+
+    @abstractmethod
+    def collect(self, limit: int = 100) -> List[Tuple[Job, LabelledChordSequence]]:
+        """
+        Results not yet acknowledged, in the order they were completed.
+
+        :param limit: Maximum number of results to return
+        :return: Jobs with their results
+        """
+
+    @abstractmethod
+    def acknowledge(self, jobs: Iterable[Job]):
+        """
+        Remove collected results from the queue, once they have been handled.
+
+        :param jobs: The jobs whose results were handled
+        """
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]:
+        """Number of files waiting ('pending'), being worked on ('leased') and with results to collect ('done')"""
+
+    def iter_results(self, poll_interval: float = 1., wait: bool = True) -> Iterator[LabelledChordSequence]:
+        """
+        Yield results as workers complete them, acknowledging each once the caller asks for the next, so that a
+        coordinator that stops part way through gets the unhandled results again when it restarts.
+
+        :param poll_interval: Seconds between checks of the queue for new results
+        :param wait: If True, carry on until no files are waiting or being worked on, else stop once the results
+         available now have been yielded
+        :return: Iterator of results in the order they were completed
+        """
+        while True:
+            results = self.collect()
+            for job, res in results:
+                yield res
+                self.acknowledge([job])
+            if results:
+                continue
+            counts = self.counts()
+            if not wait or not (counts.get('pending') or counts.get('leased')):
+                return
+            time.sleep(poll_interval)
+
+
+def _encode(result: LabelledChordSequence) -> bytes:
+    chords = None if result.sequence is None else [[c.chord, c.timestamp] for c in result.sequence]
+    error = None if result.error is None else list(result.error)
+    return zlib.compress(json.dumps({'chords': chords, 'error': error}, separators=(',', ':')).encode())
+
+
+def _decode(file: str, data: bytes) -> LabelledChordSequence:
+    data = json.loads(zlib.decompress(data))
+    sequence = None if data['chords'] is None else [ChordChange(chord=c, timestamp=t) for c, t in data['chords']]
+    error = None if data['error'] is None else ExtractionError(*data['error'])
+    return LabelledChordSequence(id=file, sequence=sequence, error=error)
+
+
+class SQLiteJobQueue(_SQLiteStore, JobQueue):
+    """
+    Job queue held in a SQLite database, which can be on a filesystem shared between machines so that no other
+    service is needed. Claims are made in exclusive transactions, so each file is leased to one worker at a time.
+    The database uses the rollback journal rather than WAL, as WAL does not work over network filesystems; the
+    filesystem must support POSIX locks (e.g. NFS with locking enabled).
+
+    :param path: Path to the SQLite database file, which is created if it does not exist
+    :param max_attempts: Number of times a file may be claimed by workers whose leases then expired before it is
+     given up on, with an error result of kind 'lease_expired'. This stops a file that brings down whole workers
+     from going round the queue forever.
+    """
+
+    _journal_mode = 'DELETE'
+    _schema = ('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, file TEXT NOT NULL, state TEXT NOT NULL, '
+               'worker TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0, completed INTEGER, result BLOB);'
+               'CREATE UNIQUE INDEX IF NOT EXISTS jobs_file ON jobs (file);'
+               'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);')
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        super().__init__(path)
+        self.max_attempts = max_attempts
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _transaction(self):
+        # The connection is shared with the lease renewing thread of a worker, so transactions are serialized
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def put(self, files: Iterable[str]) -> int:
+        files = iter(files)
+        added = 0
+        while True:
+            # In batches, so that workers can claim files while a long listing is still being added
+            batch = list(islice(files, 1000))
+            if not batch:
+                return added
+            with self._transaction() as conn:
+                for file in batch:
+                    added += conn.execute("INSERT OR IGNORE INTO jobs (file, state) VALUES (?, 'pending')",
+                                          (file,)).rowcount
+
+    def _finish(self, conn, job_id: int, result: LabelledChordSequence):
+        conn.execute("UPDATE jobs SET state = 'done', worker = NULL, expires = NULL, result = ?, "
+                     "completed = (SELECT COALESCE(MAX(completed), 0) + 1 FROM jobs) WHERE id = ?",
+                     (_encode(result), job_id))
+
+    def _requeue_expired(self, conn) -> int:
+        expired = conn.execute("SELECT id, file, attempts, worker FROM jobs WHERE state = 'leased' AND expires < ?",
+                               (time.time(),)).fetchall()
+        for job_id, file, attempts, worker in expired:
+            if attempts >= self.max_attempts:
+                message = 'Lease held by {} expired, after {} attempts'.format(worker, attempts)
+                _log.error('{}: {}'.format(file, message))
+                self._finish(conn, job_id, LabelledChordSequence(id=file, sequence=None, error=ExtractionError(
+                    kind='lease_expired', message=message, attempts=attempts)))
+            else:
+                _log.warning('Lease of {} held by {} expired, returning it to the queue'.format(file, worker))
+                conn.execute("UPDATE jobs SET state = 'pending', worker = NULL, expires = NULL WHERE id = ?",
+                             (job_id,))
+        return len(expired)
+
+    def requeue_expired(self) -> int:
+        """
+        Return files whose leases have expired to the queue, or give up on them if they have used up their attempts.
+        This is also done whenever files are claimed.
+
+        :return: Number of expired leases
+        """
+        with self._transaction() as conn:
+            return self._requeue_expired(conn)
+
+    def claim(self, worker: str, lease_seconds: float, limit: int = 1) -> List[Job]:
+        with self._transaction() as conn:
+            self._requeue_expired(conn)
+            rows = conn.execute("SELECT id, file, attempts FROM jobs WHERE state = 'pending' ORDER BY id LIMIT ?",
+                                (limit,)).fetchall()
+            conn.executemany("UPDATE jobs SET state = 'leased', worker = ?, expires = ?, attempts = attempts + 1 "
+                             "WHERE id = ?", [(worker, time.time() + lease_seconds, r[0]) for r in rows])
+        return [Job(id=job_id, file=file, attempts=attempts + 1) for job_id, file, attempts in rows]
+
+    def renew(self, worker: str, lease_seconds: float) -> int:
+        with self._transaction() as conn:
+            return conn.execute("UPDATE jobs SET expires = ? WHERE state = 'leased' AND worker = ?",
+                                (time.time() + lease_seconds, worker)).rowcount
+
+    def complete(self, worker: str, job: Job, result: LabelledChordSequence) -> bool:
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM jobs WHERE id = ? AND state = 'leased' AND worker = ?",
+                            (job.id, worker)).fetchone() is None:
+                return False
+            self._finish(conn, job.id, result)
+            return True
+
+    def release(self, worker: str) -> int:
+        # Not counted as an attempt, as the worker gave the file up rather than failing on it
+        with self._transaction() as conn:
+            return conn.execute("UPDATE jobs SET state = 'pending', worker = NULL, expires = NULL, "
+                                "attempts = attempts - 1 WHERE state = 'leased' AND worker = ?", (worker,)).rowcount
+
+    def collect(self, limit: int = 100) -> List[Tuple[Job, LabelledChordSequence]]:
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT id, file, attempts, result FROM jobs WHERE state = 'done' ORDER BY completed "
+                                "LIMIT ?", (limit,)).fetchall()
+        return [(Job(id=job_id, file=file, attempts=attempts), _decode(file, result))
+                for job_id, file, attempts, result in rows]
+
+    def acknowledge(self, jobs: Iterable[Job]):
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM jobs WHERE id = ? AND state = 'done'", [(job.id,) for job in jobs])
+
+    def counts(self) -> Dict[str, int]:
+        with self._transaction() as conn:
+            return dict(conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def clear(self):
+        """Remove every file and result from the queue."""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM jobs')
+
+
+class DistributedWorker:
+    """
+    Worker claiming files from a job queue and extracting from them with an ExtractorPool on this machine, writing
+    the results back to the queue. Files go through the same preprocessing, result cache and fault isolation as in
+    extract_many. Leases on the files being worked on are renewed from a background thread.
+
+    :param extractor: The ChordExtractor to extract with
+    :param queue: Queue to take files from
+    :param num_extractors: See ExtractorPool
+    :param num_preprocessors: See ExtractorPool
+    :param max_tasks_per_worker: See ExtractorPool
+    :param task_timeout: See ExtractorPool
+    :param max_retries: See ExtractorPool
+    :param quarantine_file: See ExtractorPool
+    :param balance_workers: See ExtractorPool
+    :param max_files_in_cache: See ChordExtractor.extract_many
+    :param max_in_flight: Max number of files claimed but not yet completed, see ChordExtractor.iter_extract_many
+    :param lease_seconds: Length of the leases on claimed files. If the worker stops renewing them, e.g. because its
+     machine went down, its files go back on the queue this long after the last renewal.
+    :param poll_interval: Seconds between checks of the queue for files returned to it, while other workers finish
+    :param worker_id: Identifier of this worker in the queue, by default made from the host name and process id
+    :param metrics: Optional collector to record the time each file spends in each stage on this worker, see
+     ChordExtractor.extract_many
+    :param max_bytes_in_cache: See ChordExtractor.extract_many
+    """
+
+    def __init__(self,
+                 extractor,
+                 queue: JobQueue,
+                 num_extractors: int = 1,
+                 num_preprocessors: int = 1,
+                 max_tasks_per_worker: Optional[int] = None,
+                 task_timeout: Optional[float] = None,
+                 max_retries: int = 0,
+                 quarantine_file: Optional[str] = None,
+                 balance_workers: bool = False,
+                 max_files_in_cache: int = 50,
+                 max_in_flight: Optional[int] = None,
+                 lease_seconds: float = 300,
+                 poll_interval: float = 5,
+                 worker_id: Optional[str] = None,
+                 metrics: Optional[MetricsCollector] = None,
+                 max_bytes_in_cache: Optional[int] = None):
+        self.extractor = extractor
+        self.queue = queue
+        self.num_extractors = num_extractors
+        self.num_preprocessors = num_preprocessors
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.task_timeout = task_timeout
+        self.max_retries = max_retries
+        self.quarantine_file = quarantine_file
+        self.balance_workers = balance_workers
+        self.max_files_in_cache = max_files_in_cache
+        self.max_in_flight = max_in_flight
+        self.max_bytes_in_cache = max_bytes_in_cache
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.metrics = metrics
+        self._claimed: Dict[str, Deque[Job]] = {}
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Stop claiming files, so that run returns once those already claimed are complete."""
+        self._stopping.set()
+
+    def _claim(self) -> Iterator[str]:
+        while not self._stopping.is_set():
+            jobs = self.queue.claim(self.worker_id, self.lease_seconds)
+            if not jobs:
+                return
+            self._claimed.setdefault(jobs[0].file, deque()).append(jobs[0])
+            yield jobs[0].file
+
+    def _renew(self, stopped: threading.Event):
+        while not stopped.wait(self.lease_seconds / 3):
+            try:
+                self.queue.renew(self.worker_id, self.lease_seconds)
+            except Exception as e:
+                _log.error('Unable to renew leases: {}'.format(e))
+
+    def run(self, wait: bool = True) -> int:
+        """
+        Extract from files in the queue until there are none left.
+
+        :param wait: If True, once there are no files waiting, carry on checking the queue until no other worker is
+         working on a file either, in case their leases expire and the files are returned. If False, return as soon
+         as no files are waiting.
+        :return: Number of files this worker completed
+        """
+        completed = 0
+        self._stopping.clear()
+        stopped = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(stopped,), daemon=True)
+        renewer.start()
+        try:
+            with ExtractorPool(self.extractor, num_extractors=self.num_extractors,
+                               num_preprocessors=self.num_preprocessors, max_tasks_per_worker=self.max_tasks_per_worker,
+                               task_timeout=self.task_timeout, max_retries=self.max_retries,
+                               quarantine_file=self.quarantine_file, balance_workers=self.balance_workers) as pool:
+                while not self._stopping.is_set():
+                    for res in pool.iter_extract_many(self._claim(), max_files_in_cache=self.max_files_in_cache,
+                                                      max_in_flight=self.max_in_flight, metrics=self.metrics,
+                                                      max_bytes_in_cache=self.max_bytes_in_cache):
+                        jobs = self._claimed[res.id]
+                        job = jobs.popleft()
+                        if not jobs:
+                            del self._claimed[res.id]
+                        if not self.queue.complete(self.worker_id, job, res):
+                            _log.warning('Lease on {} was lost before its result was recorded'.format(res.id))
+                        completed += 1
+                    if not wait:
+                        break
+                    counts = self.queue.counts()
+                    if not counts.get('pending') and not counts.get('leased'):
+                        break
+                    self._stopping.wait(self.poll_interval)
+        finally:
+            stopped.set()
+            renewer.join()
+            self._claimed.clear()
+            self.queue.release(self.worker_id)
+        return completed
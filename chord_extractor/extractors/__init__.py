@@ -21,6 +21,6 @@
 Module containing specific ChordExtractor implementations, and any input enums that they use
 """
 
-from .chordino import Chordino, TuningMode, ChromaNormalization
+from .chordino import Chordino, TuningMode, ChromaNormalization, DecodeBackend, Resampler
 
-__all__ = ['Chordino', 'TuningMode', 'ChromaNormalization']
+__all__ = ['Chordino', 'TuningMode', 'ChromaNormalization', 'DecodeBackend', 'Resampler']
@@ -18,20 +18,40 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
-from chord_extractor.base import ChordExtractor, ChordChange
-import librosa
-import vamp
-from typing import List
+from chord_extractor.base import ChordExtractor, ChordChange, _midi_extensions
+from chord_extractor.converters import midi_to_pcm
+from chord_extractor.cache import ResultCache, ConversionCache, AudioCache, file_digest
+from chord_extractor.outputs import ChordSequence, LabelledChordSequence, ChordFeatures
+from chord_extractor.metrics import stage, note
+from chord_extractor.memory import Audio
+from chord_extractor.decoders import load_soundfile, load_ffmpeg, stream_audio, stream_ffmpeg, frames_from_blocks
+import numpy as np
+import multiprocessing as mp
+from functools import partial, lru_cache
+from typing import List, Optional, Dict, Any, Callable, Iterator, Tuple, Sequence, Union
+from collections import OrderedDict
 from enum import Enum
+import json
 import os
 import sys
-from pkg_resources import resource_filename
 import logging
+import threading
 
 _log = logging.getLogger(__name__)
 
+# Sample rate midi is rendered at when extracting at the native sample rate
+_midi_render_rate = 44100
+
+
+@lru_cache(maxsize=None)
+def _soundfile():
+    # Imported on first use and then looked up once, rather than with this module (see Chordino._decode)
+    import soundfile
+    return soundfile
+
+
 if not os.getenv('VAMP_PATH') and sys.platform == 'linux' and sys.maxsize > 2 ** 32:
-    os.environ['VAMP_PATH'] = os.path.dirname(resource_filename('chord_extractor', '_lib/nnls-chroma.so'))
+    os.environ['VAMP_PATH'] = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '_lib')
 elif not os.getenv('VAMP_PATH'):
     _log.warning('Please make sure VAMP_PATH is specified pointing to the directory containing the '
                  'appropriate compiled library for Chordino. '
@@ -53,6 +73,231 @@ class ChromaNormalization(Enum):
     L2 = 3
 
 
+class DecodeBackend(Enum):
+    """Options for how Chordino decodes sound files (see Chordino doc)"""
+    LIBROSA = 'librosa'
+    SOUNDFILE = 'soundfile'
+    FFMPEG = 'ffmpeg'
+
+
+class Resampler(Enum):
+    """soxr resampling qualities, from the most accurate to the fastest"""
+    VHQ = 'soxr_vhq'
+    HQ = 'soxr_hq'
+    MQ = 'soxr_mq'
+    LQ = 'soxr_lq'
+    QQ = 'soxr_qq'
+
+
+# Chordino constructor arguments and the vamp parameter identifiers they correspond to
+_param_keys = {
+    'use_nnls': 'useNNLS',
+    'roll_on': 'rollon',
+    'tuning_mode': 'tuningmode',
+    'spectral_whitening': 'whitening',
+    'spectral_shape': 's',
+    'boost_n_likelihood': 'boostn'
+}
+
+
+# Features that can be extracted alongside the chords (see Chordino.extract_features), with the plugin and index of the
+# output each comes from
+_feature_outputs = {
+    'harmonicchange': ('nnls-chroma:chordino', 2),
+    'loglikelihood': ('nnls-chroma:chordino', 3),
+    'logfreqspec': ('nnls-chroma:nnls-chroma', 0),
+    'tunedlogfreqspec': ('nnls-chroma:nnls-chroma', 1),
+    'semitonespectrum': ('nnls-chroma:nnls-chroma', 2),
+    'chroma': ('nnls-chroma:nnls-chroma', 3),
+    'basschroma': ('nnls-chroma:nnls-chroma', 4),
+    'bothchroma': ('nnls-chroma:nnls-chroma', 5),
+    'tuning': ('nnls-chroma:tuning', 0),
+    'localtuning': ('nnls-chroma:tuning', 1),
+}
+
+# Vamp parameters of the plugins other than Chordino, which reject any they do not have
+_plugin_params = {
+    'nnls-chroma:nnls-chroma': {'useNNLS', 'rollon', 'tuningmode', 'whitening', 's', 'chromanormalize'},
+    'nnls-chroma:tuning': {'rollon'},
+}
+
+
+def _to_vamp_params(**kwargs) -> Dict[str, float]:
+    params = {}
+    for k, v in kwargs.items():
+        if isinstance(v, Enum):
+            v = v.value
+        elif isinstance(v, bool):
+            v = int(v)
+        params[_param_keys.get(k, k)] = v
+    return params
+
+
+# Initialised plugins kept loaded by this process between extractions, keyed by their settings, least recently used
+# first. Loading and initialising the plugin takes far longer than extracting from a short clip, while resetting a
+# loaded one is almost free.
+_idle_plugins: 'OrderedDict[tuple, List[tuple]]' = OrderedDict()
+_idle_plugins_pid = None
+_idle_plugins_lock = threading.Lock()
+# Max number of idle plugins kept by a process
+max_idle_plugins = 8
+
+
+def _unload(plugin):
+    try:
+        plugin.unload()
+    except Exception as e:
+        _log.warning('Unable to unload plugin: {}'.format(e))
+
+
+def _load_plugin(key: str, rate: int, params: Dict[str, float], step_size: Optional[int] = None,
+                 block_size: Optional[int] = None):
+    import vampyhost
+    plugin = vampyhost.load_plugin(key, rate, vampyhost.ADAPT_INPUT_DOMAIN + vampyhost.ADAPT_CHANNEL_COUNT)
+    plugin.set_parameter_values(params)
+    block_size = block_size or plugin.get_preferred_block_size() or 1024
+    step_size = step_size or plugin.get_preferred_step_size() or block_size
+    if not plugin.initialise(1, step_size, block_size):
+        _unload(plugin)
+        raise Exception('Failed to initialise plugin')
+    return plugin, step_size, block_size
+
+
+def _acquire_plugin(settings: tuple):
+    # An idle plugin with the settings, reset ready for a new signal, or a newly loaded one if there is none or
+    # resetting fails. settings are the plugin key, sample rate, sorted parameter items and the step and block sizes
+    # (None for those preferred by the plugin).
+    global _idle_plugins_pid
+    with _idle_plugins_lock:
+        if _idle_plugins_pid != os.getpid():
+            # Plugins inherited from a forked parent are copies of its state, so are left alone
+            _idle_plugins.clear()
+            _idle_plugins_pid = os.getpid()
+        idle = _idle_plugins.pop(settings, [])
+        loaded = idle.pop() if idle else None
+        if idle:
+            _idle_plugins[settings] = idle
+    if loaded is not None:
+        try:
+            loaded[0].reset()
+            return loaded
+        except Exception as e:
+            _log.info('Unable to reset plugin, so loading it again: {}'.format(e))
+            _unload(loaded[0])
+    key, rate, params, sizes = settings
+    return _load_plugin(key, rate, dict(params), *(sizes or ()))
+
+
+def _release_plugin(settings: tuple, loaded: tuple):
+    evicted = []
+    with _idle_plugins_lock:
+        if _idle_plugins_pid == os.getpid():
+            _idle_plugins.setdefault(settings, []).append(loaded)
+            _idle_plugins.move_to_end(settings)
+            loaded = None
+            while sum(len(v) for v in _idle_plugins.values()) > max_idle_plugins:
+                oldest = next(iter(_idle_plugins))
+                evicted.append(_idle_plugins[oldest].pop(0)[0])
+                if not _idle_plugins[oldest]:
+                    del _idle_plugins[oldest]
+    if loaded is not None:
+        evicted.append(loaded[0])
+    for plugin in evicted:
+        _unload(plugin)
+
+
+def _iter_outputs(rate: int, plugin_sets: List[Tuple[str, Dict[str, float]]],
+                  frames_of: Callable[[int, int], Iterator[np.ndarray]],
+                  reuse_plugins: bool = True) -> Iterator[Tuple[int, Dict[int, List[dict]]]]:
+    # Feed each frame of the signal to one plugin instance per (plugin key, parameters) pair, so the signal is only
+    # framed and traversed once however many plugins there are. All are initialised with the step and block sizes
+    # preferred by the first. frames_of takes the step and block size and returns the frames, and the features each
+    # plugin returns, keyed by output index, are yielded with the index of the plugin as soon as it returns them.
+    # With reuse_plugins, plugins are taken from and returned to those kept by the process, and only returned if the
+    # signal was processed to the end.
+    import vampyhost
+    settings = []
+    plugins = []
+    finished = False
+    try:
+        for key, params in plugin_sets:
+            # Instances of the same plugin as the first prefer the same sizes, so keep the key of a lone instance
+            sizes = None if not plugins or key == plugin_sets[0][0] else plugins[0][1:]
+            settings.append((key, rate, tuple(sorted(params.items())), sizes))
+            plugins.append(_acquire_plugin(settings[-1]) if reuse_plugins
+                           else _load_plugin(key, rate, params, *(sizes or ())))
+        step_size, block_size = plugins[0][1], plugins[0][2]
+        fi = 0
+        for frame in frames_of(step_size, block_size):
+            timestamp = vampyhost.frame_to_realtime(fi, rate)
+            for i, (plugin, _, _) in enumerate(plugins):
+                outputs = plugin.process_block(frame, timestamp)
+                if outputs:
+                    yield i, outputs
+            fi += step_size
+        for i, (plugin, _, _) in enumerate(plugins):
+            outputs = plugin.get_remaining_features()
+            if outputs:
+                yield i, outputs
+        finished = True
+    finally:
+        for s, loaded in zip(settings, plugins):
+            if finished and reuse_plugins:
+                _release_plugin(s, loaded)
+            else:
+                _unload(loaded[0])
+
+
+def _iter_chord_changes(rate: int, param_sets: List[Dict[str, float]],
+                        frames_of: Callable[[int, int], Iterator[np.ndarray]],
+                        reuse_plugins: bool = True) -> Iterator[Tuple[int, ChordChange]]:
+    # Chord changes from one Chordino instance per parameter set (see _iter_outputs), yielded with the index of their
+    # parameter set
+    for i, outputs in _iter_outputs(rate, [('nnls-chroma:chordino', params) for params in param_sets], frames_of,
+                                    reuse_plugins):
+        for change in outputs.get(0, []):
+            yield i, ChordChange(timestamp=float(change['timestamp']), chord=change['label'])
+
+
+def _run_plugins(data, rate: int, param_sets: List[Dict[str, float]],
+                 reuse_plugins: bool = True) -> List[List[ChordChange]]:
+    import vamp.frames
+    res = [[] for _ in param_sets]
+    for i, change in _iter_chord_changes(rate, param_sets,
+                                         lambda step, block: vamp.frames.frames_from_array(data, step, block),
+                                         reuse_plugins):
+        res[i].append(change)
+    return res
+
+
+def _slice(data: np.ndarray, rate: int, offset: float = 0., duration: Optional[float] = None):
+    return data[int(offset * rate):None if duration is None else int((offset + duration) * rate)], rate
+
+
+def _clip(changes: List[ChordChange], start: float, end: Optional[float]) -> List[ChordChange]:
+    # The changes from start up to end, beginning with the chord in effect at start
+    res = []
+    before = None
+    for change in changes:
+        if change.timestamp < start:
+            before = change
+        elif end is None or change.timestamp < end:
+            res.append(change)
+    if before is not None and (not res or res[0].timestamp > start):
+        res.insert(0, ChordChange(chord=before.chord, timestamp=start))
+    return res
+
+
+def _stitch(parts: List[List[ChordChange]]) -> List[ChordChange]:
+    # Join the changes of consecutive spans, dropping the change at the start of a span to the chord already in effect
+    res = []
+    for part in parts:
+        if res and part and part[0].chord == res[-1].chord:
+            part = part[1:]
+        res.extend(part)
+    return res
+
+
 class Chordino(ChordExtractor):
     """
     Class for extracting chords using Chordino (http://www.isophonics.net/nnls-chroma). All parameters are those
@@ -66,6 +311,43 @@ class Chordino(ChordExtractor):
     :param spectral_whitening: Spectral whitening (range: 0 - 1)
     :param spectral_shape: Spectral shape (range: 0.5 - 0.9)
     :param boost_n_likelihood: Boost likelihood of the N (no chord) label
+    :param result_cache: Optional persistent cache of extraction results (see ChordExtractor)
+    :param conversion_cache: Optional cache to hold sound file conversions (see ChordExtractor)
+    :param audio_cache: Optional cache of decoded audio. If given, the signal loaded by librosa is kept in the cache
+     and memory-mapped by later extractions of the same file contents with the same load settings, e.g. when
+     re-extracting with different parameters.
+    :param streaming: If True, extract decodes files in blocks (see extract_stream) rather than loading them whole,
+     so memory use does not depend on the length of the recording. Files that soundfile cannot read are loaded whole
+     as usual, and the audio cache is not used for streamed files.
+    :param decoder: How sound files are decoded. LIBROSA (the default) uses librosa.load, which reads files with
+     soundfile and falls back to audioread for formats soundfile cannot read. SOUNDFILE reads files with soundfile
+     directly and pipes those it cannot read through ffmpeg, and FFMPEG pipes all files through ffmpeg. Both skip the
+     overheads of librosa.load and audioread, which can make decoding several times faster for compressed formats,
+     though ffmpeg resamples with its own resampler so results can differ very slightly from those with LIBROSA.
+     The ffmpeg executable must be available on the PATH to use ffmpeg. Calls to extract with keyword arguments other
+     than sr are always decoded with librosa.load.
+    :param sample_rate: Sample rate the signal is resampled to before extraction, or None to extract at the native
+     sample rate of each file, which skips resampling altogether. Chordino works on a log-frequency spectrum, so
+     results are usually very similar at any common sample rate, but extraction takes longer at higher rates.
+    :param resampler: soxr resampling quality used by librosa and soundfile decoding. If None, librosa's default
+     (HQ) is used. Lower qualities resample faster at the cost of slightly more aliasing near the Nyquist frequency,
+     which is well above the range of pitches Chordino analyses, so LQ or QQ rarely changes the chords extracted.
+    :param midi_in_memory: If True, midi files are rendered by timidity straight into memory at the sample rate
+     being extracted at, rather than converted to wav files in preprocessing and decoded again from disk. In
+     extract_many, midi files then go straight to an extraction process and nothing is written to the conversion
+     cache, which avoids the disk traffic of the conversions at the cost of rendering in the extraction processes.
+    :param compact_results: If True, results of extract_many are returned as ChordSequences (see ChordExtractor)
+    :param reuse_plugins: If True, each process keeps the plugin loaded between extractions with the same sample rate
+     and parameters, resetting it for each file rather than loading and initialising it again, which takes longer
+     than extracting from a short clip. If a plugin cannot be reset, a fresh one is loaded. Up to max_idle_plugins
+     (a module attribute) plugins are kept per process.
+    :param decode_in_preprocessing: If True, extract_many decodes files in the preprocessing processes, handing the
+     signal to the extraction processes in shared memory (see ChordExtractor.preprocess), so the extraction processes
+     only run the plugin. This moves the decoding out of the way of the plugin when there are spare cores for it, and
+     midi conversions are decoded straight away rather than left on disk for the extraction process to read. Use
+     max_bytes_in_cache of extract_many to bound the memory held by decoded files waiting for extraction.
+    :param span_margin: Seconds of audio decoded and analysed either side of a span of a file given to extract, so
+     that Chordino's tuning estimate and chord smoothing have context at the edges of the span
     :param kwargs: Any other parameters that may become available to the chordino vamp plugin. Param keys are the
      vamp identifier.
     """
@@ -77,31 +359,579 @@ class Chordino(ChordExtractor):
                  spectral_whitening: float = 1,
                  spectral_shape=0.7,
                  boost_n_likelihood: float = 0.1,
+                 result_cache: Optional[ResultCache] = None,
+                 conversion_cache: Optional[ConversionCache] = None,
+                 audio_cache: Optional[AudioCache] = None,
+                 streaming: bool = False,
+                 decoder: DecodeBackend = DecodeBackend.LIBROSA,
+                 sample_rate: Optional[int] = 22050,
+                 resampler: Optional[Resampler] = None,
+                 midi_in_memory: bool = False,
+                 compact_results: bool = False,
+                 reuse_plugins: bool = True,
+                 decode_in_preprocessing: bool = False,
+                 span_margin: float = 5,
                  **kwargs):
-        super().__init__()
-        self._params = {
-            'useNNLS': int(use_nnls),
-            'rollon': roll_on,
-            'tuningmode': tuning_mode.value,
-            'whitening': spectral_whitening,
-            's': spectral_shape,
-            'boostn': boost_n_likelihood
-        }
+        super().__init__(result_cache=result_cache, conversion_cache=conversion_cache,
+                         compact_results=compact_results)
+        self.audio_cache = audio_cache
+        self.streaming = streaming
+        self.decoder = decoder
+        self.sample_rate = sample_rate
+        self.resampler = resampler
+        self.midi_in_memory = midi_in_memory
+        self.reuse_plugins = reuse_plugins
+        self.decode_in_preprocessing = decode_in_preprocessing
+        self.span_margin = span_margin
+        self._params = _to_vamp_params(use_nnls=use_nnls,
+                                       roll_on=roll_on,
+                                       tuning_mode=tuning_mode,
+                                       spectral_whitening=spectral_whitening,
+                                       spectral_shape=spectral_shape,
+                                       boost_n_likelihood=boost_n_likelihood)
         self._params.update(kwargs)
 
-    def extract(self, file: str, **kwargs) -> List[ChordChange]:
+    def identity(self) -> str:
+        return self._identity(self._params)
+
+    def _identity(self, params: Dict[str, float]) -> str:
+        identity = '{}{}'.format(super().identity(), json.dumps(params, sort_keys=True))
+        decode_settings = self._decode_settings()
+        if self.streaming:
+            # Decoding block by block can give slightly different results to decoding the whole file. It is not part
+            # of the decode settings, which also key the audio cache of whole decoded files.
+            decode_settings['streaming'] = True
+        if decode_settings:
+            identity += json.dumps(decode_settings, sort_keys=True)
+        return identity
+
+    def _decode_settings(self) -> Dict[str, Any]:
+        # Only settings that differ from the defaults, so that identities and cache keys for the default decoding are
+        # unchanged
+        settings = {}
+        if self.decoder is not DecodeBackend.LIBROSA:
+            settings['decoder'] = self.decoder.value
+        if self.sample_rate != 22050:
+            settings['sr'] = self.sample_rate
+        if self.resampler is not None:
+            settings['resampler'] = self.resampler.value
+        if self.midi_in_memory:
+            settings['midi_in_memory'] = True
+        return settings
+
+    def _renders_midi(self, file) -> bool:
+        return self.midi_in_memory and isinstance(file, str) and os.path.splitext(file)[1] in _midi_extensions
+
+    def needs_preprocessing(self, path: str) -> bool:
+        # Not the base implementation, which takes the override of preprocess to mean every file needs it
+        return self.decode_in_preprocessing or (os.path.splitext(path)[1] in _midi_extensions and
+                                                not self._renders_midi(path))
+
+    def preprocess(self, path: str) -> Optional[Union[str, Audio]]:
+        if not self.decode_in_preprocessing:
+            return super().preprocess(path)
+        return self._preprocess_audio(path)
+
+    def _preprocess_audio(self, path: str, offset: float = 0., duration: Optional[float] = None) -> Audio:
+        # Decode in preprocessing, from offset for duration seconds
+        if os.path.splitext(path)[1] not in _midi_extensions or self._renders_midi(path):
+            return Audio(*self._load(path, offset, duration))
+        # Decoded from the usual conversion, so that results are the same as without decoding in preprocessing
+        while True:
+            conversion = super().preprocess(path)
+            if conversion is None:
+                raise ValueError('Invalid midi file at {}'.format(path))
+            try:
+                return Audio(*self._load(conversion, offset, duration))
+            except Exception:
+                if os.path.exists(conversion):
+                    raise
+                # Removed by another process converting the same file between converting and decoding, so convert
+                # again
+            finally:
+                if not self.conversion_cache.max_size_bytes:
+                    self.conversion_cache.remove(conversion)
+
+    def estimate_cost(self, path: str) -> float:
+        # The duration in the header where soundfile can read it, as this is cheap and far more precise than the size
+        if os.path.splitext(path)[1].lower() not in _midi_extensions:
+            try:
+                return _soundfile().info(path).duration
+            except Exception:
+                pass
+        return super().estimate_cost(path)
+
+    def _quality(self) -> str:
+        return (self.resampler or Resampler.HQ).name
+
+    def _decode(self, file, offset: float = 0., duration: Optional[float] = None, **kwargs):
+        # librosa and vamp are imported where they are used, and soundfile by _soundfile, rather than with this
+        # module, as they take a long time to import and are not needed by processes that only preprocess
+        import librosa
+        sr = kwargs.pop('sr', self.sample_rate)
+        if self._renders_midi(file):
+            rendered = midi_to_pcm(file, sr or _midi_render_rate)
+            if rendered is None:
+                raise ValueError('Invalid midi file at {}'.format(file))
+            return _slice(*rendered, offset, duration)
+        if self.decoder is DecodeBackend.LIBROSA or kwargs or not isinstance(file, str):
+            if self.resampler is not None:
+                kwargs.setdefault('res_type', self.resampler.value)
+            return librosa.load(file, sr=sr, offset=offset, duration=duration, **kwargs)
+        if self.decoder is DecodeBackend.SOUNDFILE:
+            try:
+                return load_soundfile(file, sr, quality=self._quality(), offset=offset, duration=duration)
+            except _soundfile().LibsndfileError:
+                _log.info('Unable to read {} with soundfile, so decoding it with ffmpeg.'.format(file))
+        return load_ffmpeg(file, sr, offset=offset, duration=duration)
+
+    def _stream(self, file: str, sr: Optional[int]):
+        if self.decoder is DecodeBackend.FFMPEG:
+            return stream_ffmpeg(file, sr)
+        try:
+            return stream_audio(file, sr, quality=self._quality())
+        except _soundfile().LibsndfileError:
+            if self.decoder is DecodeBackend.LIBROSA:
+                raise
+            _log.info('Unable to read {} with soundfile, so decoding it with ffmpeg.'.format(file))
+            return stream_ffmpeg(file, sr)
+
+    def _load(self, file, offset: float = 0., duration: Optional[float] = None, **kwargs):
+        if isinstance(file, Audio):
+            return _slice(file.samples, file.sample_rate, offset, duration)
+        if offset or duration is not None:
+            # Spans are decoded on their own, as the whole file would be decoded for the audio cache
+            return self._decode(file, offset, duration, **kwargs)
+        if self.audio_cache is None or not isinstance(file, str):
+            return self._decode(file, **kwargs)
+        settings = 'librosa{}'.format(json.dumps(kwargs, sort_keys=True, default=str))
+        decode_settings = self._decode_settings()
+        if decode_settings:
+            settings += json.dumps(decode_settings, sort_keys=True)
+        data = self.audio_cache.fetch_array(file, settings, lambda f: self._decode(f, **kwargs)[0])
+        rate = kwargs.get('sr', self.sample_rate)
+        if not rate:
+            import librosa
+            rate = _midi_render_rate if self._renders_midi(file) else librosa.get_samplerate(file)
+        return data, rate
+
+    def extract(self, file: str, start: Optional[float] = None, end: Optional[float] = None, use_cache: bool = True,
+                **kwargs) -> List[ChordChange]:
         """
-        Extract chord changes from a particular file. The file is loaded into librosa, therefore takes sound files
-        supported by librosa (which uses audioread and soundfile). This includes .wav, .mp3, .ogg and others.
+        Extract chord changes from a particular file. By default the file is loaded into librosa, therefore takes sound
+        files supported by librosa (which uses audioread and soundfile). This includes .wav, .mp3, .ogg and others.
+        See the decoder parameter for faster alternatives.
 
-        :param file: Absolute file path to the relevant file. A file like object is also acceptable.
+        :param file: Absolute file path to the relevant file. A file like object, or decoded Audio (see
+         decode_in_preprocessing), is also acceptable.
+        :param start: If start or end is given, only the span of the file between them is extracted from, e.g. for a
+         quick preview of part of a long recording. The decoder seeks to span_margin seconds before the span and
+         stops span_margin seconds after it, so only that part of the file is decoded and analysed. The chord changes
+         returned are those within the span, starting with the chord in effect at start, with timestamps in seconds
+         from the start of the file. start defaults to the start of the file.
+        :param end: End of the span in seconds (see start), by default the end of the file
+        :param use_cache: If False, the result cache is neither consulted nor updated
         :param kwargs: Keyword arguments for librosa.load
-         (see https://librosa.org/doc/0.7.0/generated/librosa.core.load.html)
+         (see https://librosa.org/doc/0.7.0/generated/librosa.core.load.html). If sr is not given, the extractor's
+         sample_rate is used.
         :return: List of chord changes for the sound file
         """
-        data, rate = librosa.load(file, **kwargs)
+        if start is not None or end is not None:
+            return self._extract_span(file, start or 0., end, use_cache, **kwargs)
+        key = self._result_key(file, use_cache, **kwargs)
+        cached = self._cached_result(key, file)
+        if cached is not None:
+            return cached
+        if self.streaming and isinstance(file, str) and set(kwargs) <= {'sr'} and not self._renders_midi(file):
+            try:
+                with stage('plugin'):
+                    res = list(self.extract_stream(file, **kwargs))
+                with stage('postprocess'):
+                    self._cache_result(key, res)
+                return res
+            except _soundfile().LibsndfileError:
+                _log.info('Unable to stream {}, so loading it whole.'.format(file))
+        with stage('decode'):
+            data, rate = self._load(file, **kwargs)
+        note(audio_seconds=len(data) / rate)
         _log.info('Submitting {} to Chordino for chord extraction.'.format(file))
-        chords = vamp.collect(data, rate, 'nnls-chroma:chordino', parameters=self._params)
+        with stage('plugin'):
+            res = _run_plugins(data, rate, [self._params], self.reuse_plugins)[0]
         _log.info('Chord extraction for {} complete.'.format(file))
-        return [ChordChange(timestamp=float(change['timestamp']),
-                            chord=change['label']) for change in chords['list']]
+        with stage('postprocess'):
+            self._cache_result(key, res)
+        return res
+
+    def _extract_span(self, file, start: float, end: Optional[float], use_cache: bool,
+                      **kwargs) -> List[ChordChange]:
+        span = {'start': start, 'end': end, 'margin': self.span_margin}
+        key = self._result_key(file, use_cache, span=span, **kwargs)
+        cached = self._cached_result(key, file)
+        if cached is not None:
+            return cached
+        offset, duration = self._span_window(start, end)
+        with stage('decode'):
+            data, rate = self._load(file, offset, duration, **kwargs)
+        res = self._extract_window(file, Audio(data, rate), offset, start, end)
+        with stage('postprocess'):
+            self._cache_result(key, res)
+        return res
+
+    def _span_window(self, start: float, end: Optional[float]) -> Tuple[float, Optional[float]]:
+        # Offset and duration of the audio decoded to extract from a span, with span_margin either side of it
+        offset = max(0., start - self.span_margin)
+        return offset, None if end is None else end + self.span_margin - offset
+
+    def _extract_window(self, file, audio: Audio, offset: float, start: float,
+                        end: Optional[float]) -> List[ChordChange]:
+        # Extract from the span of a file given the audio decoded from its window, which starts at offset
+        note(audio_seconds=len(audio.samples) / audio.sample_rate)
+        _log.info('Submitting {} from {}s to {}s to Chordino for chord extraction.'.format(file, start, end))
+        with stage('plugin'):
+            changes = _run_plugins(audio.samples, audio.sample_rate, [self._params], self.reuse_plugins)[0]
+        _log.info('Chord extraction for {} complete.'.format(file))
+        with stage('postprocess'):
+            return _clip([c._replace(timestamp=c.timestamp + offset) for c in changes], start, end)
+
+    def _extract_uncached(self, file):
+        return self.extract(file, use_cache=False)
+
+    def extract_windowed(self, file: str, window: float = 60, num_extractors: int = 1,
+                         **kwargs) -> List[ChordChange]:
+        """
+        Extract chord changes from a long file by splitting it into consecutive windows that are extracted from in
+        parallel, as spans of the file (see extract), and stitching the chord changes of the windows together. Each
+        window is analysed with span_margin seconds of the windows either side, so the windows overlap and the
+        chords at their boundaries have context; a change at the start of a window to the chord the previous window
+        ended on is dropped. Results are usually very close to those of extract, but can differ slightly around the
+        boundaries, as Chordino smooths its estimates over the audio it is given.
+
+        :param file: Absolute file path to the relevant file
+        :param window: Length of the windows in seconds
+        :param num_extractors: Max number of processes to extract from windows in parallel
+        :param kwargs: Keyword arguments for librosa.load
+        :return: List of chord changes for the sound file
+        """
+        conversion = None
+        if os.path.splitext(file)[1] in _midi_extensions and not self._renders_midi(file):
+            # Converted once here rather than by every window
+            conversion = ChordExtractor.preprocess(self, file)
+            if conversion is None:
+                raise ValueError('Invalid midi file at {}'.format(file))
+        path = conversion or file
+        try:
+            try:
+                duration = _soundfile().info(path).duration
+            except _soundfile().LibsndfileError:
+                if self._renders_midi(path):
+                    return self.extract(path, **kwargs)
+                import librosa
+                duration = librosa.get_duration(path=path)
+            windows = max(1, int(np.ceil(duration / window)))
+            spans = [(path, i * window, None if i == windows - 1 else (i + 1) * window) for i in range(windows)]
+            if windows == 1 or num_extractors <= 1:
+                return _stitch([self.extract(*span, **kwargs) for span in spans])
+            with mp.Pool(min(num_extractors, windows)) as pool:
+                return _stitch(pool.starmap(partial(self.extract, **kwargs), spans))
+        finally:
+            if conversion is not None and not self.conversion_cache.max_size_bytes:
+                self.conversion_cache.remove(conversion)
+
+    def extract_stream(self, file: str, **kwargs) -> Iterator[ChordChange]:
+        """
+        Extract chord changes from a particular file, decoding it block by block and feeding the plugin as each block
+        is decoded, so that only a small part of the signal is in memory at any time however long the recording.
+        Chord changes are yielded as the plugin makes them available; note that Chordino smooths its chord estimates
+        over the whole recording, so in practice they become available once the end of the file is reached.
+
+        The signal is mixed down to mono and resampled as librosa.load does, though the results may differ very
+        slightly from those of extract. With the default decoder only formats readable by soundfile are supported;
+        with the SOUNDFILE and FFMPEG decoders files are streamed through ffmpeg as described for the decoder
+        parameter.
+
+        :param file: Absolute file path to the relevant file
+        :param kwargs: Optionally sr, the sample rate to resample to or None to keep the native sample rate. If not
+         given, the extractor's sample_rate is used.
+        :return: Iterator of chord changes for the sound file
+        :raises soundfile.LibsndfileError: If the file cannot be opened by soundfile with the default decoder
+        """
+        rate, blocks = self._stream(file, kwargs.get('sr', self.sample_rate))
+        samples = 0
+
+        def counted():
+            nonlocal samples
+            for b in blocks:
+                samples += len(b)
+                yield b
+
+        _log.info('Streaming {} to Chordino for chord extraction.'.format(file))
+        for _, change in _iter_chord_changes(rate, [self._params],
+                                             lambda step, block: frames_from_blocks(counted(), step, block),
+                                             self.reuse_plugins):
+            yield change
+        note(audio_seconds=samples / rate)
+        _log.info('Chord extraction for {} complete.'.format(file))
+
+    def extract_features(self,
+                         file: str,
+                         features: Sequence[str] = ('chroma', 'basschroma', 'harmonicchange'),
+                         chroma_normalization: ChromaNormalization = ChromaNormalization.NONE,
+                         **kwargs) -> ChordFeatures:
+        """
+        Extract chord changes from a particular file together with other features computed by the NNLS Chroma plugins,
+        e.g. the chromagram. The file is decoded once and each frame of it is passed to Chordino and to each of the
+        other plugins needed, in a single pass over the signal, rather than decoding and processing the file again for
+        each output.
+
+        Features available are harmonicchange and loglikelihood from Chordino, logfreqspec, tunedlogfreqspec,
+        semitonespectrum, chroma, basschroma and bothchroma from NNLS Chroma, and tuning and localtuning from Tuning
+        (see the link in the class documentation). The plugins share the parameters of this Chordino where they have
+        them. The chords extracted are the same as those of extract, and are added to the result cache if there is
+        one, but the features are not cached.
+
+        :param file: Absolute file path to the relevant file. A file like object is also acceptable.
+        :param features: Names of the features to extract
+        :param chroma_normalization: Normalization of the chroma features
+        :param kwargs: Keyword arguments for librosa.load
+        :return: The chord changes, and for each feature an array with one row per frame (a single row for tuning)
+        """
+        unknown = [f for f in features if f not in _feature_outputs]
+        if unknown:
+            raise ValueError('Unknown features {}, expected some of {}'.format(unknown, list(_feature_outputs)))
+        params = dict(self._params, chromanormalize=chroma_normalization.value)
+        keys = ['nnls-chroma:chordino'] + sorted({_feature_outputs[f][0] for f in features} - {'nnls-chroma:chordino'})
+        plugin_sets = [(k, self._params if k == 'nnls-chroma:chordino' else
+                        {p: v for p, v in params.items() if p in _plugin_params[k]}) for k in keys]
+        with stage('decode'):
+            data, rate = self._load(file, **kwargs)
+        note(audio_seconds=len(data) / rate)
+        _log.info('Submitting {} to Chordino for chord and feature extraction.'.format(file))
+        import vamp.frames
+        chords = []
+        collected = {f: [] for f in features}
+        # The frame-wise outputs all have one feature per step at the same times, so they are taken from one of them
+        times_of = next((f for f in features if f != 'tuning'), None)
+        times = []
+        wanted = {(keys.index(k), i): f for f, (k, i) in _feature_outputs.items() if f in collected}
+        with stage('plugin'):
+            for p, outputs in _iter_outputs(rate, plugin_sets,
+                                            lambda step, block: vamp.frames.frames_from_array(data, step, block),
+                                            self.reuse_plugins):
+                if p == 0:
+                    chords.extend(ChordChange(timestamp=float(c['timestamp']), chord=c['label'])
+                                  for c in outputs.get(0, []))
+                for i, frames in outputs.items():
+                    name = wanted.get((p, i))
+                    if name is None:
+                        continue
+                    if name == times_of:
+                        times.extend(float(f['timestamp']) for f in frames)
+                    collected[name].extend(f['values'] for f in frames)
+        _log.info('Chord and feature extraction for {} complete.'.format(file))
+        with stage('postprocess'):
+            self._cache_result(self._result_key(file, **kwargs), chords)
+            res = ChordFeatures(chords=chords,
+                                features={f: np.array(v, dtype=np.float32) if v else np.zeros((0, 0), np.float32)
+                                          for f, v in collected.items()},
+                                times=np.array(times, dtype=np.float64))
+        return res
+
+    def extract_sweep(self, file: str, param_sets: List[Dict[str, Any]], **kwargs) -> List[List[ChordChange]]:
+        """
+        Extract chord changes from a particular file with several Chordino configurations, e.g. for a grid search over
+        parameters. The file is decoded once, and each frame of it is passed to one instance of the plugin per
+        configuration, so the cost is roughly one decode plus one plugin run per configuration. (The plugin computes
+        its spectral front-end internally, so that part cannot be shared between configurations.)
+
+        :param file: Absolute file path to the relevant file. A file like object is also acceptable.
+        :param param_sets: List of parameter overrides, one per configuration. Keys are either the names of the
+         Chordino constructor arguments (e.g. roll_on) or vamp identifiers, and any parameter not given takes the value
+         this Chordino was constructed with.
+        :param kwargs: Keyword arguments for librosa.load
+        :return: List of chord change lists, one per configuration in the order given
+        """
+        params = [{**self._params, **_to_vamp_params(**p)} for p in param_sets]
+        identities = [self._identity(p) + (json.dumps(kwargs, sort_keys=True, default=str) if kwargs else '')
+                      for p in params]
+        res = [None] * len(params)
+        digest = None
+        if self.result_cache is not None and isinstance(file, str):
+            digest = file_digest(file)
+            res = [self.result_cache.get(digest, identity) for identity in identities]
+        missing = [i for i, r in enumerate(res) if r is None]
+        if missing:
+            with stage('decode'):
+                data, rate = self._load(file, **kwargs)
+            note(audio_seconds=len(data) / rate)
+            _log.info('Submitting {} to Chordino for chord extraction with {} configurations.'.format(file,
+                                                                                                      len(missing)))
+            with stage('plugin'):
+                plugin_res = _run_plugins(data, rate, [params[i] for i in missing], self.reuse_plugins)
+            for i, r in zip(missing, plugin_res):
+                res[i] = r
+                if digest is not None:
+                    self.result_cache.put(digest, identities[i], r)
+            _log.info('Chord extraction for {} complete.'.format(file))
+        return res
+
+    def extract_sweep_many(self,
+                           files: List[str],
+                           param_sets: List[Dict[str, Any]],
+                           callback: Callable[[List[LabelledChordSequence]], None] = None,
+                           num_extractors: int = 1,
+                           num_preprocessors: int = 1,
+                           max_files_in_cache: int = 50,
+                           stop_on_error=False) -> List[List[LabelledChordSequence]]:
+        """
+        Extract chords from many files with several Chordino configurations, running the extractions in parallel as
+        extract_many does. Each file is decoded once (see extract_sweep).
+
+        :param files: List of paths to files we wish to extract chords for
+        :param param_sets: List of parameter overrides, one per configuration (see extract_sweep)
+        :param callback: An optional callable that is called when chords have been extracted from a particular file,
+         with the results for that file, one per configuration
+        :param num_extractors: Max number of extraction processes to run in parallel
+        :param num_preprocessors: Max number of conversion processes to run in parallel
+        :param max_files_in_cache: See extract_many
+        :param stop_on_error: See extract_many
+        :return: One list of results per configuration in the order given, each as extract_many would return for that
+         configuration
+        """
+        res = [[] for _ in param_sets]
+        sweep = _ChordinoSweep(self, param_sets)
+        for r in sweep.iter_extract_many(files, num_extractors=num_extractors, num_preprocessors=num_preprocessors,
+                                         max_files_in_cache=max_files_in_cache, max_in_flight=len(files) or None,
+                                         stop_on_error=stop_on_error):
+            sequences = r.sequence or [None] * len(param_sets)
+            labelled = [LabelledChordSequence(id=r.id, sequence=s) for s in sequences]
+            if callback:
+                callback(labelled)
+            for configuration_res, lcs in zip(res, labelled):
+                configuration_res.append(lcs)
+        return res
+
+    def extract_features_many(self,
+                              files: List[str],
+                              features: Sequence[str] = ('chroma', 'basschroma', 'harmonicchange'),
+                              chroma_normalization: ChromaNormalization = ChromaNormalization.NONE,
+                              callback: Callable[[LabelledChordSequence], None] = None,
+                              **kwargs) -> List[LabelledChordSequence]:
+        """
+        Extract chords and features from many files, running the extractions in parallel as extract_many does. Each
+        file is decoded and processed once (see extract_features).
+
+        :param files: List of paths to files we wish to extract chords and features for
+        :param features: Names of the features to extract (see extract_features)
+        :param chroma_normalization: Normalization of the chroma features
+        :param callback: An optional callable that is called when a file has been extracted from, with its result
+        :param kwargs: Any other arguments of extract_many, e.g. num_extractors
+        :return: Results as extract_many returns them, with a ChordFeatures as the sequence of each
+        """
+        unknown = [f for f in features if f not in _feature_outputs]
+        if unknown:
+            raise ValueError('Unknown features {}, expected some of {}'.format(unknown, list(_feature_outputs)))
+        return _ChordinoFeatures(self, features, chroma_normalization).extract_many(files, callback=callback, **kwargs)
+
+    def extract_span_many(self,
+                          files: List[str],
+                          start: Optional[float] = None,
+                          end: Optional[float] = None,
+                          callback: Callable[[LabelledChordSequence], None] = None,
+                          **kwargs) -> List[LabelledChordSequence]:
+        """
+        Extract chords from the same span of many files (see extract), e.g. for previews, running the extractions in
+        parallel as extract_many does.
+
+        :param files: List of paths to files we wish to extract chords for
+        :param start: Start of the span in seconds, by default the start of each file
+        :param end: End of the span in seconds, by default the end of each file
+        :param callback: An optional callable that is called when a file has been extracted from, with its result
+        :param kwargs: Any other arguments of extract_many, e.g. num_extractors
+        :return: Results as extract_many returns them
+        """
+        return _ChordinoSpan(self, start, end).extract_many(files, callback=callback, **kwargs)
+
+
+class _ChordinoSweep(ChordExtractor):
+    """Extractor running Chordino.extract_sweep, so that sweeps can use the multiprocessing of extract_many."""
+
+    def __init__(self, chordino: Chordino, param_sets: List[Dict[str, Any]]):
+        # Results are cached per configuration by the wrapped Chordino rather than for the sweep as a whole
+        super().__init__(conversion_cache=chordino.conversion_cache, compact_results=chordino.compact_results)
+        self._chordino = chordino
+        self._param_sets = param_sets
+
+    def needs_preprocessing(self, path: str) -> bool:
+        return self._chordino.needs_preprocessing(path)
+
+    def preprocess(self, path: str) -> Optional[str]:
+        return self._chordino.preprocess(path)
+
+    def estimate_cost(self, path: str) -> float:
+        # The file is decoded once, but analysed once per configuration
+        return self._chordino.estimate_cost(path) * len(self._param_sets)
+
+    def extract(self, file: str, **kwargs) -> List[List[ChordChange]]:
+        return self._chordino.extract_sweep(file, self._param_sets, **kwargs)
+
+    def compact(self, result):
+        return [ChordSequence.from_changes(r) for r in result]
+
+
+class _ChordinoFeatures(ChordExtractor):
+    """Extractor running Chordino.extract_features, so that it can use the multiprocessing of extract_many."""
+
+    def __init__(self, chordino: Chordino, features: Sequence[str], chroma_normalization: ChromaNormalization):
+        # Chords are cached by the wrapped Chordino, while the features are not cached
+        super().__init__(conversion_cache=chordino.conversion_cache, compact_results=chordino.compact_results)
+        self._chordino = chordino
+        self._features = tuple(features)
+        self._chroma_normalization = chroma_normalization
+
+    def needs_preprocessing(self, path: str) -> bool:
+        return self._chordino.needs_preprocessing(path)
+
+    def preprocess(self, path: str) -> Optional[str]:
+        return self._chordino.preprocess(path)
+
+    def estimate_cost(self, path: str) -> float:
+        return self._chordino.estimate_cost(path)
+
+    def extract(self, file: str, **kwargs) -> ChordFeatures:
+        return self._chordino.extract_features(file, self._features, self._chroma_normalization, **kwargs)
+
+    def compact(self, result):
+        return result._replace(chords=ChordSequence.from_changes(result.chords))
+
+
+class _ChordinoSpan(ChordExtractor):
+    """Extractor running Chordino.extract on a span of each file, so that it can use the multiprocessing of
+    extract_many."""
+
+    def __init__(self, chordino: Chordino, start: Optional[float], end: Optional[float]):
+        # Results are cached per span by the wrapped Chordino
+        super().__init__(conversion_cache=chordino.conversion_cache, compact_results=chordino.compact_results)
+        self._chordino = chordino
+        self._start = start
+        self._end = end
+
+    def needs_preprocessing(self, path: str) -> bool:
+        return self._chordino.needs_preprocessing(path)
+
+    def preprocess(self, path: str) -> Optional[Union[str, Audio]]:
+        if not self._chordino.decode_in_preprocessing:
+            return self._chordino.preprocess(path)
+        # Only the window around the span is decoded, which extract takes as it is
+        return self._chordino._preprocess_audio(path, *self._chordino._span_window(self._start or 0., self._end))
+
+    def estimate_cost(self, path: str) -> float:
+        # The part of the file's estimated duration within the window decoded for the span
+        cost = self._chordino.estimate_cost(path)
+        offset, duration = self._chordino._span_window(self._start or 0., self._end)
+        return max(0., min(cost, cost if duration is None else offset + duration) - offset)
+
+    def extract(self, file: str, **kwargs) -> List[ChordChange]:
+        if isinstance(file, Audio):
+            offset = self._chordino._span_window(self._start or 0., self._end)[0]
+            return self._chordino._extract_window('preprocessed audio', file, offset, self._start or 0., self._end)
+        return self._chordino.extract(file, self._start, self._end, **kwargs)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Decoded audio handed from preprocessing to extraction in memory, through shared memory blocks that the extraction
+process reads in place, rather than through conversion files on disk or pickled arrays.
+"""
+
+from multiprocessing import shared_memory
+from typing import Callable, NamedTuple, TypeVar
+import logging
+import os
+import traceback
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class Audio(NamedTuple):
+    """
+    Decoded audio held in memory, which ChordExtractor.preprocess may return in place of the path of a conversion.
+
+    :param samples: The mono signal
+    :param sample_rate: Sample rate of the signal
+    """
+    samples: np.ndarray
+    sample_rate: int
+
+
+class SharedAudio(NamedTuple):
+    """
+    Handle to audio in a shared memory block, which is what extract_many passes from a preprocessing process to an
+    extraction process in place of an Audio returned by preprocess. The block stays in shared memory until released,
+    which the extraction process does once it has extracted from it.
+
+    :param name: Name of the shared memory block
+    :param length: Number of samples
+    :param dtype: Type of the samples, as a numpy type string
+    :param sample_rate: Sample rate of the signal
+    """
+    name: str
+    length: int
+    dtype: str
+    sample_rate: int
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the samples in bytes"""
+        return self.length * np.dtype(self.dtype).itemsize
+
+    @classmethod
+    def share(cls, audio: Audio) -> 'SharedAudio':
+        """
+        Copy audio into a new shared memory block.
+
+        :param audio: The audio
+        :return: Handle to the block, which must be released when finished with
+        """
+        samples = np.ascontiguousarray(audio.samples)
+        block = shared_memory.SharedMemory(create=True, size=max(samples.nbytes, 1))
+        try:
+            np.ndarray(samples.shape, samples.dtype, block.buf)[:] = samples
+        except BaseException:
+            block.close()
+            block.unlink()
+            raise
+        block.close()
+        return cls(name=block.name, length=len(samples), dtype=samples.dtype.str, sample_rate=audio.sample_rate)
+
+    def apply(self, fn: Callable[[Audio], T]) -> T:
+        """
+        Call a function with the audio, whose samples are a view onto the shared memory block rather than a copy, so
+        are only valid for the duration of the call.
+
+        :param fn: The function
+        :return: What the function returns
+        """
+        block = shared_memory.SharedMemory(name=self.name)
+        try:
+            return fn(Audio(np.ndarray((self.length,), self.dtype, block.buf), self.sample_rate))
+        except BaseException as e:
+            # The frames of the traceback would otherwise keep views of the samples alive, so the block can be closed
+            traceback.clear_frames(e.__traceback__)
+            raise
+        finally:
+            try:
+                block.close()
+            except BufferError:
+                _log.warning('Samples of {} still referenced after use, so the block is left open'.format(self.name))
+
+    def release(self):
+        """Free the shared memory block, if it has not been already."""
+        try:
+            block = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        block.close()
+        block.unlink()
+
+
+def _share_tracker():
+    # Start the resource tracker of this process, if it is not running, so that worker processes started afterwards
+    # share it rather than each starting their own. Blocks created in one worker and released in another are then
+    # tracked as one, and any left behind, e.g. by work abandoned on an error, are freed when this process exits.
+    if os.name == 'posix':
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
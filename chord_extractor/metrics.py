@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Per-file timings of each stage of extract_many, aggregated into counters and histograms and written to pluggable
+sinks.
+
+Stages timed are:
+
+- backpressure: waiting for a conversion slot to free up (see max_files_in_cache and max_bytes_in_cache)
+- queue_wait: waiting in the queues of the worker pools for a free process
+- cache: looking the file up in the result cache
+- preprocess: file conversion (e.g. timidity for midi), including decoding if it is done in preprocessing
+- decode: decoding the sound file into a signal
+- plugin: running the extraction plugin (for streamed extractions this includes decoding)
+- postprocess: building, caching and compacting the result
+- callback: the caller's handling of the result, i.e. the extract_many callback or the code consuming
+  iter_extract_many
+
+Extractors can time their own stages with the stage context manager, which does nothing unless a file is being timed.
+"""
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, NamedTuple, Optional, Sequence
+import bisect
+import json
+import os
+import tempfile
+import time
+
+# Timings of the file being processed in this process, if it is being timed
+_current: Optional[Dict[str, float]] = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Context manager timing a stage of the processing of the current file. Time spent in the same stage more than once
+    is added up. If the file is not being timed, this does nothing.
+
+    :param name: Name of the stage
+    """
+    timings = _current
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.) + time.perf_counter() - start
+
+
+def note(**values: float):
+    """
+    Record values describing the current file, e.g. audio_seconds, the duration of its audio. If the file is not
+    being timed, this does nothing.
+
+    :param values: Values to record
+    """
+    if _current is not None:
+        _current.update(values)
+
+
+@contextmanager
+def collecting():
+    """Context manager timing the stages of a file processed within it, yielding the dictionary they are added to."""
+    global _current
+    previous, _current = _current, {}
+    try:
+        yield _current
+    finally:
+        _current = previous
+
+
+def _instrumented(fn, submitted: float, *args, **kwargs):
+    # Run fn in a worker process, timing its stages and the time since it was submitted in the parent
+    with collecting() as timings:
+        timings['queue_wait'] = max(0., time.time() - submitted)
+        res = fn(*args, **kwargs)
+    return res, timings
+
+
+class FileMetrics(NamedTuple):
+    """
+    Timings of the processing of a single file by extract_many.
+
+    :param id: Path of the file
+    :param stages: Seconds spent in each stage (see the module documentation)
+    :param total_seconds: Seconds from submission of the file to its result being taken
+    :param audio_seconds: Duration of the audio, if known
+    :param bytes: Size of the file, if known
+    :param ok: Whether a result was extracted
+    """
+    id: str
+    stages: Dict[str, float]
+    total_seconds: float
+    audio_seconds: Optional[float]
+    bytes: Optional[int]
+    ok: bool
+
+
+class Histogram:
+    """
+    Cumulative histogram of observations, as in Prometheus.
+
+    :param buckets: Upper bounds of the buckets, in increasing order
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[int]:
+        """Number of observations at most each bucket bound, ending with the total for the +Inf bucket"""
+        res, total = [], 0
+        for c in self.counts:
+            total += c
+            res.append(total)
+        return res
+
+
+class MetricsSink(ABC):
+    """Destination for the metrics of a MetricsCollector"""
+
+    def record(self, event: FileMetrics, collector: 'MetricsCollector'):
+        """
+        Handle the metrics of a single file as it completes.
+
+        :param event: Metrics of the file
+        :param collector: Collector holding the aggregated metrics so far
+        """
+
+    @abstractmethod
+    def flush(self, collector: 'MetricsCollector'):
+        """
+        Write out anything outstanding, called at the end of each batch.
+
+        :param collector: Collector holding the aggregated metrics
+        """
+
+    def close(self):
+        """Release any resources held by the sink."""
+
+
+class MetricsCollector:
+    """
+    Aggregates the per-file timings of extract_many runs (see the module documentation) into counters and histograms,
+    passing each file's timings and the aggregates on to any sinks. Pass one as the metrics argument of extract_many,
+    iter_extract_many or the equivalent ExtractorPool methods; a collector can be used for many runs.
+
+    :param sinks: Sinks to write metrics to
+    :param buckets: Bucket bounds in seconds for the stage histograms
+    """
+
+    def __init__(self, sinks: Sequence[MetricsSink] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.sinks = list(sinks)
+        self.buckets = buckets
+        self.files = 0
+        self.failures = 0
+        self.audio_seconds = 0.
+        self.bytes = 0
+        self.wall_seconds = 0.
+        self.stages: Dict[str, Histogram] = {}
+        self.file_seconds = Histogram(buckets)
+
+    def record(self, event: FileMetrics):
+        """
+        Add the metrics of a single file.
+
+        :param event: Metrics of the file
+        """
+        self.files += 1
+        self.failures += not event.ok
+        self.audio_seconds += event.audio_seconds or 0.
+        self.bytes += event.bytes or 0
+        self.file_seconds.observe(event.total_seconds)
+        for name, seconds in event.stages.items():
+            if name not in self.stages:
+                self.stages[name] = Histogram(self.buckets)
+            self.stages[name].observe(seconds)
+        for sink in self.sinks:
+            sink.record(event, self)
+
+    def add_wall_time(self, seconds: float):
+        """
+        Add to the elapsed time of the runs being measured, which throughput is relative to.
+
+        :param seconds: Elapsed seconds
+        """
+        self.wall_seconds += seconds
+
+    def throughput(self) -> float:
+        """Seconds of audio extracted per second of elapsed time"""
+        return self.audio_seconds / self.wall_seconds if self.wall_seconds else 0.
+
+    def stage_totals(self) -> Dict[str, float]:
+        """Total seconds spent in each stage, across all files"""
+        return {name: h.sum for name, h in self.stages.items()}
+
+    def flush(self):
+        """Write the metrics to the sinks."""
+        for sink in self.sinks:
+            sink.flush(self)
+
+    def close(self):
+        """Flush and close the sinks."""
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+
+
+class JsonLinesSink(MetricsSink):
+    """
+    Sink appending the metrics of each file to a file as a line of JSON.
+
+    :param path: Path of the file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'a')
+
+    def record(self, event: FileMetrics, collector: MetricsCollector):
+        self._file.write(json.dumps(event._asdict()) + '\n')
+
+    def flush(self, collector: MetricsCollector):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class PrometheusTextfileSink(MetricsSink):
+    """
+    Sink writing the aggregated metrics in the Prometheus text format, e.g. for the node exporter textfile collector.
+    The file is replaced atomically each time it is written.
+
+    :param path: Path of the file, which should end in .prom for the textfile collector
+    :param interval: If given, the file is also rewritten during a batch, at most once per this many seconds
+    :param prefix: Prefix for the metric names
+    """
+
+    def __init__(self, path: str, interval: Optional[float] = None, prefix: str = 'chord_extractor'):
+        self.path = path
+        self.interval = interval
+        self.prefix = prefix
+        self._written = time.monotonic()
+
+    def record(self, event: FileMetrics, collector: MetricsCollector):
+        if self.interval is not None and time.monotonic() - self._written >= self.interval:
+            self.flush(collector)
+
+    def _lines(self, collector: MetricsCollector) -> List[str]:
+        p = self.prefix
+        lines = []
+
+        def scalar(name, kind, help_, value):
+            lines.extend(['# HELP {}_{} {}'.format(p, name, help_), '# TYPE {}_{} {}'.format(p, name, kind),
+                          '{}_{} {}'.format(p, name, value)])
+
+        def histogram(name, labels, h):
+            for bound, count in zip(h.buckets + ['+Inf'], h.cumulative_counts()):
+                lines.append('{}_{}_bucket{{{}le="{}"}} {}'.format(p, name, labels, bound, count))
+            lines.append('{}_{}_sum{} {}'.format(p, name, '{{{}}}'.format(labels[:-1]) if labels else '', h.sum))
+            lines.append('{}_{}_count{} {}'.format(p, name, '{{{}}}'.format(labels[:-1]) if labels else '', h.count))
+
+        scalar('files_total', 'counter', 'Files processed.', collector.files)
+        scalar('failures_total', 'counter', 'Files with no result.', collector.failures)
+        scalar('audio_seconds_total', 'counter', 'Seconds of audio processed.', collector.audio_seconds)
+        scalar('bytes_total', 'counter', 'Bytes of files processed.', collector.bytes)
+        scalar('wall_seconds_total', 'counter', 'Elapsed seconds of extraction runs.', collector.wall_seconds)
+        scalar('throughput_ratio', 'gauge', 'Seconds of audio processed per elapsed second.', collector.throughput())
+        lines.extend(['# HELP {}_file_seconds Seconds from submission to result of each file.'.format(p),
+                      '# TYPE {}_file_seconds histogram'.format(p)])
+        histogram('file_seconds', '', collector.file_seconds)
+        lines.extend(['# HELP {}_stage_seconds Seconds spent in each stage per file.'.format(p),
+                      '# TYPE {}_stage_seconds histogram'.format(p)])
+        for name in sorted(collector.stages):
+            histogram('stage_seconds', 'stage="{}",'.format(name), collector.stages[name])
+        return lines
+
+    def flush(self, collector: MetricsCollector):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(self._lines(collector)) + '\n')
+            os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self._written = time.monotonic()
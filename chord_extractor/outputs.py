@@ -17,7 +17,10 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from typing import NamedTuple, List, Optional
+from typing import Dict, NamedTuple, List, Optional, Sequence, Iterable, Iterator, Union
+import json
+import threading
+import numpy as np
 
 
 class ChordChange(NamedTuple):
@@ -32,10 +35,290 @@ class ChordChange(NamedTuple):
     timestamp: float
 
 
+class ChordVocabulary:
+    """
+    Mapping between chord strings and the integer codes that ChordSequence stores in place of them. Codes are assigned
+    in order of first appearance, and a chord keeps its code for the life of the vocabulary.
+
+    :param chords: Chords to assign the first codes to, in order
+    """
+
+    def __init__(self, chords: Iterable[str] = ()):
+        self.chords: List[str] = []
+        self._codes = {}
+        self._lock = threading.Lock()
+        for chord in chords:
+            self.code(chord)
+
+    def code(self, chord: str) -> int:
+        """
+        Get the code for a chord, assigning it the next free code if it has not been seen before.
+
+        :param chord: Chord string
+        :return: Code of the chord
+        """
+        code = self._codes.get(chord)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(chord)
+                if code is None:
+                    code = len(self.chords)
+                    self.chords.append(chord)
+                    self._codes[chord] = code
+        return code
+
+    def codes(self, chords: Iterable[str]) -> np.ndarray:
+        """
+        Get the codes for many chords (see code).
+
+        :param chords: Chord strings
+        :return: Array of codes
+        """
+        return np.array([self.code(c) for c in chords], dtype=np.int32)
+
+    def __getitem__(self, code: int) -> str:
+        return self.chords[code]
+
+    def __reduce__(self):
+        return ChordVocabulary, (self.chords,)
+
+    def __len__(self):
+        return len(self.chords)
+
+    def __repr__(self):
+        return 'ChordVocabulary({!r})'.format(self.chords)
+
+
+# Vocabulary shared by all ChordSequences in a process unless another is given
+default_vocabulary = ChordVocabulary()
+
+
+def _from_labels(timestamps: np.ndarray, codes: np.ndarray, labels: List[str]) -> 'ChordSequence':
+    return ChordSequence(timestamps, default_vocabulary.codes(labels)[codes] if len(labels) else codes)
+
+
+class ChordSequence(Sequence[ChordChange]):
+    """
+    Compact, immutable sequence of chord changes, which stores the timestamps in a float64 array and the chords as
+    integer codes into a vocabulary shared between sequences, rather than as one tuple per change. It can be used
+    wherever a list of ChordChange is, as it indexes and iterates as ChordChange and compares equal to a list of the
+    same changes, but takes a fraction of the memory and is far cheaper to pickle between processes.
+
+    A pickled sequence carries only the chords it uses, and is mapped onto the default vocabulary of the process it
+    is unpickled in.
+
+    :param timestamps: Timestamps of the chord changes
+    :param codes: Codes of the chords changed to, from the vocabulary
+    :param vocabulary: The vocabulary the codes are from, by default the vocabulary shared within the process
+    """
+
+    __slots__ = ('timestamps', 'codes', 'vocabulary')
+
+    def __init__(self, timestamps: np.ndarray, codes: np.ndarray, vocabulary: Optional[ChordVocabulary] = None):
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.vocabulary = vocabulary if vocabulary is not None else default_vocabulary
+
+    @classmethod
+    def from_changes(cls, changes: Iterable[ChordChange],
+                     vocabulary: Optional[ChordVocabulary] = None) -> 'ChordSequence':
+        """
+        Make a sequence from chord changes.
+
+        :param changes: Chord changes, e.g. a list of ChordChange
+        :param vocabulary: The vocabulary to code the chords with, by default the vocabulary shared within the process
+        :return: The sequence
+        """
+        if isinstance(changes, ChordSequence) and (vocabulary is None or vocabulary is changes.vocabulary):
+            return changes
+        vocabulary = vocabulary if vocabulary is not None else default_vocabulary
+        changes = list(changes)
+        return cls(np.array([c.timestamp for c in changes], dtype=np.float64),
+                   vocabulary.codes(c.chord for c in changes), vocabulary)
+
+    @property
+    def chords(self) -> List[str]:
+        """The chord strings of the changes"""
+        chords = self.vocabulary.chords
+        return [chords[c] for c in self.codes]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            return ChordSequence(self.timestamps[index], self.codes[index], self.vocabulary)
+        return ChordChange(chord=self.vocabulary[self.codes[index]], timestamp=float(self.timestamps[index]))
+
+    def __iter__(self) -> Iterator[ChordChange]:
+        chords = self.vocabulary.chords
+        for code, timestamp in zip(self.codes.tolist(), self.timestamps.tolist()):
+            yield ChordChange(chord=chords[code], timestamp=timestamp)
+
+    def __eq__(self, other):
+        if isinstance(other, ChordSequence):
+            if self.vocabulary is other.vocabulary:
+                return np.array_equal(self.codes, other.codes) and np.array_equal(self.timestamps, other.timestamps)
+            return self.chords == other.chords and np.array_equal(self.timestamps, other.timestamps)
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return 'ChordSequence({!r})'.format(list(self))
+
+    def __reduce__(self):
+        # Send only the chords used, as the codes mean nothing in the vocabulary of another process
+        used, codes = np.unique(self.codes, return_inverse=True)
+        return _from_labels, (self.timestamps, codes.astype(np.int32), [self.vocabulary[c] for c in used])
+
+
+class ChordFeatures(NamedTuple):
+    """
+    Chord changes together with features computed in the same pass over a sound file (see Chordino.extract_features).
+
+    :param chords: Chord changes
+    :param features: Array for each feature, with one row per frame (a single row for tuning)
+    :param times: Timestamps in seconds of the frames
+    """
+    chords: Sequence[ChordChange]
+    features: Dict[str, np.ndarray]
+    times: np.ndarray
+
+
+class ExtractionError(NamedTuple):
+    """
+    Why no result was returned for a file.
+
+    :param kind: 'error' if an exception was raised, 'timeout' if the file took too long, 'crash' if the process
+     working on it died, or 'quarantined' if it was skipped after failing in this way before
+    :param message: Description of the error
+    :param attempts: Number of times the file was attempted
+    """
+    kind: str
+    message: str
+    attempts: int = 1
+
+
 class LabelledChordSequence(NamedTuple):
     """
     Output of chord extractions with identifier, suitable for when running using asynchronous processes. The
-    sequence may be None if no result was returned for that particular id.
+    sequence may be None if no result was returned for that particular id, in which case error may say why.
     """
     id: str
-    sequence: Optional[List[ChordChange]]
+    sequence: Optional[Sequence[ChordChange]]
+    error: Optional[ExtractionError] = None
+
+
+def _chord_arrays(seq: Sequence[ChordChange], vocabulary: ChordVocabulary):
+    # Timestamps and codes of a sequence, with the codes mapped onto the vocabulary being saved
+    if isinstance(seq, ChordSequence):
+        used, inverse = np.unique(seq.codes, return_inverse=True)
+        return seq.timestamps, vocabulary.codes(seq.vocabulary[c] for c in used)[inverse] if len(seq) else seq.codes
+    if not isinstance(seq, (list, tuple)):
+        raise TypeError('Cannot save a result whose sequence is a {}, rather than a ChordSequence, list of ChordChange '
+                        'or ChordFeatures'.format(type(seq).__name__))
+    seq = ChordSequence.from_changes(seq, vocabulary)
+    return seq.timestamps, seq.codes
+
+
+class _FeatureArrays:
+    # Frame times and feature arrays of the ChordFeatures among many results, each concatenated into one array with
+    # the offset of every result's rows, as for the chords
+    def __init__(self):
+        self.names, self.times, self.time_offsets = [], [], [0]
+        self.arrays: Dict[str, List[np.ndarray]] = {}
+        self.offsets: Dict[str, List[int]] = {}
+
+    def add(self, res: Optional[ChordFeatures]):
+        self.names.append(json.dumps(list(res.features)) if res is not None else '')
+        if res is not None:
+            self.times.append(res.times)
+            for name, array in res.features.items():
+                self.arrays.setdefault(name, []).append(array)
+                self.offsets.setdefault(name, [0] * len(self.names)).append(len(array))
+        self.time_offsets.append(self.time_offsets[-1] + (len(res.times) if res is not None else 0))
+        for name, offsets in self.offsets.items():
+            if len(offsets) == len(self.names):
+                offsets.append(0)
+
+    def saved(self) -> Dict[str, np.ndarray]:
+        if not self.times:
+            return {}
+        saved = {'feature_names': np.array(self.names, dtype=str),
+                 'times': np.concatenate(self.times),
+                 'time_offsets': np.array(self.time_offsets, dtype=np.int64)}
+        for name, arrays in self.arrays.items():
+            saved['features.' + name] = np.concatenate(arrays)
+            saved['feature_offsets.' + name] = np.cumsum(self.offsets[name], dtype=np.int64)
+        return saved
+
+
+def save_sequences(path: str, results: Iterable[LabelledChordSequence]):
+    """
+    Save many extraction results to a single .npz file, with all timestamps and chord codes held in one array each,
+    so that a whole batch is written (and read back by load_sequences) in a handful of operations. The frame times and
+    each feature of results holding ChordFeatures (see Chordino.extract_features_many) are kept in the same way.
+
+    :param path: Path of the file to write
+    :param results: Results to save, e.g. the output of extract_many. Sequences of None and errors are preserved.
+    """
+    vocabulary = ChordVocabulary()
+    features = _FeatureArrays()
+    ids, offsets, missing, errors, timestamps, codes = [], [0], [], [], [], []
+    for res in results:
+        ids.append(res.id)
+        missing.append(res.sequence is None)
+        errors.append(json.dumps(res.error) if res.error is not None else '')
+        seq = res.sequence.chords if isinstance(res.sequence, ChordFeatures) else res.sequence
+        features.add(res.sequence if isinstance(res.sequence, ChordFeatures) else None)
+        if seq is not None:
+            times, seq_codes = _chord_arrays(seq, vocabulary)
+            timestamps.append(times)
+            codes.append(seq_codes)
+        offsets.append(offsets[-1] + (len(seq) if seq is not None else 0))
+    np.savez(path,
+             ids=np.array(ids, dtype=str),
+             offsets=np.array(offsets, dtype=np.int64),
+             missing=np.array(missing, dtype=bool),
+             errors=np.array(errors, dtype=str),
+             timestamps=np.concatenate(timestamps) if timestamps else np.zeros(0, dtype=np.float64),
+             codes=np.concatenate(codes).astype(np.int32) if codes else np.zeros(0, dtype=np.int32),
+             vocabulary=np.array(vocabulary.chords, dtype=str),
+             **features.saved())
+
+
+def _load_features(data, chords: List[Optional[ChordSequence]]) -> List[Union[ChordSequence, ChordFeatures, None]]:
+    # Wrap the chords of the results saved from ChordFeatures with their frame times and features
+    if 'feature_names' not in data:
+        return chords
+    names, times, time_offsets = data['feature_names'], data['times'], data['time_offsets']
+    arrays = {k.split('.', 1)[1]: (data[k], data['feature_offsets.' + k.split('.', 1)[1]])
+              for k in data.files if k.startswith('features.')}
+    return [ChordFeatures(seq, {n: arrays[n][0][arrays[n][1][i]:arrays[n][1][i + 1]] for n in json.loads(names[i])},
+                          times[time_offsets[i]:time_offsets[i + 1]]) if names[i] else seq
+            for i, seq in enumerate(chords)]
+
+
+def load_sequences(path: str) -> List[LabelledChordSequence]:
+    """
+    Load extraction results saved with save_sequences. Each array is read from the file into memory in full, as
+    arrays in a .npz cannot be memory-mapped, and the sequences are then slices of these arrays sharing one
+    vocabulary, so no further copies are made per sequence.
+
+    :param path: Path of the file to read
+    :return: The results, in the order they were saved, with the chords of any ChordFeatures as a ChordSequence
+    """
+    with np.load(path) as data:
+        ids, offsets, missing = data['ids'], data['offsets'], data['missing']
+        errors = data['errors'] if 'errors' in data else None
+        timestamps, codes = data['timestamps'], data['codes']
+        vocabulary = ChordVocabulary(data['vocabulary'].tolist())
+        sequences = _load_features(data, [None if missing[i] else
+                                          ChordSequence(timestamps[offsets[i]:offsets[i + 1]],
+                                                        codes[offsets[i]:offsets[i + 1]], vocabulary)
+                                          for i in range(len(ids))])
+    return [LabelledChordSequence(id=str(ids[i]), sequence=sequences[i],
+                                  error=ExtractionError(*json.loads(errors[i])) if errors is not None and errors[i]
+                                  else None)
+            for i in range(len(ids))]
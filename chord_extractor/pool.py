@@ -0,0 +1,675 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Long-lived pools of worker processes for running preprocessing and extraction in parallel.
+"""
+
+from typing import Dict, List, Callable, Optional, Iterable, Iterator, NamedTuple, Union
+from functools import partial
+import heapq
+import itertools
+import multiprocessing as mp
+import logging
+import os
+import queue
+import threading
+import time
+from .cache import file_digest, partial_digest
+from .metrics import MetricsCollector, FileMetrics, stage, _instrumented
+from .memory import Audio, SharedAudio, _share_tracker
+from .outputs import ChordChange, LabelledChordSequence, ExtractionError
+from .supervisor import SupervisedPool, WorkerFailure
+
+_log = logging.getLogger(__name__)
+
+# Extractor held by each worker process, set once by the pool initializer
+_worker_extractor = None
+
+
+def _init_worker(extractor):
+    global _worker_extractor
+    _worker_extractor = extractor
+
+
+def _preprocess(path):
+    # Returns the result of preprocessing, the cached result if there is one, and the key to cache the result under
+    with stage('cache'):
+        key = _worker_extractor._result_key(path)
+        cached = _worker_extractor._cached_result(key, path)
+    if cached is not None:
+        return path, _worker_extractor._output(cached), key
+    with stage('preprocess'):
+        converted = _worker_extractor.preprocess(path)
+        if isinstance(converted, Audio):
+            # Handed to the extraction process through shared memory rather than pickled with the result
+            converted = SharedAudio.share(converted)
+    return converted, None, key
+
+
+def _consume(path, **kwargs) -> LabelledChordSequence:
+    return _worker_extractor._consume(path, **kwargs)
+
+
+def _extract(path, **kwargs) -> LabelledChordSequence:
+    # Files needing no preprocessing go straight to an extraction worker, which checks the result cache itself
+    with stage('cache'):
+        key = _worker_extractor._result_key(path)
+        cached = _worker_extractor._cached_result(key, path)
+    if cached is not None:
+        return LabelledChordSequence(id=path, sequence=_worker_extractor._output(cached))
+    return _worker_extractor._consume(path, result_key=key, **kwargs)
+
+
+class _Deduplicator:
+    """
+    Finds files in a batch with the same contents as an earlier one still in progress. Files are first compared by the
+    cheap partial_digest, and only files whose partial digests collide are hashed in full. Originals are forgotten
+    once finished, so only files in progress are held.
+    """
+
+    def __init__(self):
+        # Partial digest -> [full digest, or None if not yet needed, first file with those contents]
+        self._seen: Dict[str, List[List[Optional[str]]]] = {}
+        # Original -> its partial digest
+        self._keys: Dict[str, str] = {}
+
+    def original(self, file: str) -> Optional[str]:
+        """
+        The earlier file with the same contents as this one, or None if there is none, in which case this file is the
+        original for any later duplicates.
+        """
+        try:
+            key = partial_digest(file)
+            entries = self._seen.get(key)
+            if entries is None:
+                self._seen[key] = [[None, file]]
+                self._keys[file] = key
+                return None
+            digest = file_digest(file)
+            for entry in entries:
+                if entry[0] is None:
+                    entry[0] = file_digest(entry[1])
+                if entry[0] == digest:
+                    return entry[1]
+        except (OSError, TypeError):
+            # Unreadable files are left for extraction to report on
+            return None
+        entries.append([digest, file])
+        self._keys[file] = key
+        return None
+
+    def forget(self, file: str):
+        """
+        Stop matching later files against this original, once its result is out.
+        """
+        key = self._keys.pop(file, None)
+        if key is None:
+            return
+        entries = [entry for entry in self._seen[key] if entry[1] != file]
+        if entries:
+            self._seen[key] = entries
+        else:
+            del self._seen[key]
+
+
+class _ByteBudget:
+    """
+    Limit on the bytes held by preprocessing results waiting to be extracted from. A conversion may start while the
+    bytes held are under the limit and fewer conversions are in progress than there are processes to make them, so
+    the limit is exceeded by at most the results of the conversions in progress.
+    """
+
+    def __init__(self, max_bytes: int, max_converting: int):
+        self.max_bytes = max_bytes
+        self.max_converting = max_converting
+        self.held = 0
+        self.converting = 0
+        self._cond = threading.Condition()
+
+    def start_conversion(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self.held < self.max_bytes and self.converting < self.max_converting)
+            self.converting += 1
+
+    def converted(self, nbytes: int):
+        with self._cond:
+            self.converting -= 1
+            self.held += nbytes
+            self._cond.notify_all()
+
+    def release(self, nbytes: int):
+        with self._cond:
+            self.held -= nbytes
+            self._cond.notify_all()
+
+
+class _Fatal(NamedTuple):
+    # Put on the results queue in place of a result to stop iter_extract_many with the error
+    error: BaseException
+
+
+class _Dispatcher:
+    """
+    Front for a process pool shared by preprocessing and extraction, holding tasks back until a process is free and
+    then handing it the most pressing one. Extractions go before conversions, as finishing files frees space in the
+    conversion cache and feeds results back sooner, and within each stage the most expensive files go first. The
+    share of the processes each stage gets therefore follows the work waiting for it, rather than being fixed.
+    """
+
+    # Priority of the stages, lowest first
+    EXTRACTION = 0
+    CONVERSION = 1
+
+    def __init__(self, pool, processes: int):
+        self.pool = pool
+        self.processes = processes
+        self._free = processes
+        self._waiting = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+
+    def apply_async(self, fn, args=(), kwds=None, callback=None, error_callback=None, stage=EXTRACTION, cost=0.):
+        with self._cond:
+            heapq.heappush(self._waiting, ((stage, -cost, next(self._order)), fn, args, kwds or {}, callback,
+                                           error_callback))
+        self._dispatch()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                if not self._free or not self._waiting:
+                    return
+                self._free -= 1
+                _, fn, args, kwds, callback, error_callback = heapq.heappop(self._waiting)
+            self.pool.apply_async(fn, args=args, kwds=kwds, callback=partial(self._done, callback),
+                                  error_callback=partial(self._done, error_callback))
+
+    def _done(self, fn, value):
+        # The callback may submit the next stage for the file, which should be in the running for the free process
+        try:
+            if fn is not None:
+                fn(value)
+        finally:
+            with self._cond:
+                self._free += 1
+                self._cond.notify_all()
+            self._dispatch()
+
+    def close(self):
+        # Tasks still held back would be refused by the pool once closed, so wait for them to be handed over
+        with self._cond:
+            self._cond.wait_for(lambda: not self._waiting)
+        self.pool.close()
+
+    def terminate(self):
+        with self._cond:
+            self._waiting.clear()
+        self.pool.terminate()
+
+    def join(self):
+        self.pool.join()
+
+
+class ExtractorPool:
+    """
+    Pool of worker processes for running preprocessing and extraction with a particular extractor, which stays alive
+    across many batches of files. The extractor is sent to each worker once when the worker starts, rather than with
+    every file, and the processes are only started once, making this suitable for services extracting many small
+    batches. ChordExtractor.extract_many uses a pool that lasts for a single call.
+
+    Use as a context manager so that the workers are shut down when finished with::
+
+        with ExtractorPool(Chordino(), num_extractors=4, max_tasks_per_worker=500) as pool:
+            for batch in batches:
+                res = pool.extract_many(batch)
+
+    :param extractor: The ChordExtractor to run in the workers
+    :param num_extractors: Number of extraction processes
+    :param num_preprocessors: Number of conversion processes
+    :param max_tasks_per_worker: If given, each worker process is replaced with a fresh one after this many files,
+     which bounds any memory growth in native libraries. If None, workers live as long as the pool.
+    :param task_timeout: If given, the workers run with fault isolation: preprocessing or extraction of a file taking
+     longer than this many seconds is abandoned and its worker killed and replaced, as is a worker that dies, without
+     affecting the other workers. See ChordExtractor.extract_many.
+    :param max_retries: With task_timeout, the number of times a file that timed out or crashed is tried again
+    :param quarantine_file: With task_timeout, a file listing files that timed out or crashed on every attempt, which
+     are skipped. Files that fail in this way are added to it, and to the quarantined attribute of the pool.
+    :param balance_workers: If True, rather than fixed numbers of conversion and extraction processes, a single set
+     of num_extractors + num_preprocessors processes is shared by both stages. Each process is given the most pressing
+     work as it becomes free: extraction before conversion, and the most expensive files first (see
+     ChordExtractor.estimate_cost). This keeps every process busy whatever the mix of files, e.g. a batch that is
+     mostly midi, or mostly audio needing no conversion.
+    """
+
+    def __init__(self,
+                 extractor,
+                 num_extractors: int = 1,
+                 num_preprocessors: int = 1,
+                 max_tasks_per_worker: Optional[int] = None,
+                 task_timeout: Optional[float] = None,
+                 max_retries: int = 0,
+                 quarantine_file: Optional[str] = None,
+                 balance_workers: bool = False):
+        _share_tracker()
+        self.extractor = extractor
+        self.num_extractors = num_extractors
+        self.num_preprocessors = num_preprocessors
+        self.quarantine_file = quarantine_file
+        self.quarantined = set()
+        if quarantine_file and os.path.exists(quarantine_file):
+            with open(quarantine_file) as f:
+                self.quarantined.update(line.rstrip('\n') for line in f if line.strip())
+        self._quarantine_lock = threading.Lock()
+        if task_timeout is None:
+            def pool(processes):
+                return mp.Pool(processes=processes, initializer=_init_worker, initargs=(extractor,),
+                               maxtasksperchild=max_tasks_per_worker)
+        else:
+            def pool(processes):
+                return SupervisedPool(processes=processes, initializer=_init_worker, initargs=(extractor,),
+                                      maxtasksperchild=max_tasks_per_worker, task_timeout=task_timeout,
+                                      max_retries=max_retries)
+        self.balance_workers = balance_workers
+        if balance_workers:
+            processes = num_extractors + num_preprocessors
+            self._conversion_pool = self._extractor_pool = _Dispatcher(pool(processes), processes)
+        else:
+            self._conversion_pool = pool(num_preprocessors)
+            self._extractor_pool = pool(num_extractors)
+
+    def _pools(self):
+        return [self._conversion_pool] if self.balance_workers else [self._conversion_pool, self._extractor_pool]
+
+    def _quarantine(self, file: str):
+        with self._quarantine_lock:
+            if file in self.quarantined:
+                return
+            self.quarantined.add(file)
+            if self.quarantine_file:
+                with open(self.quarantine_file, 'a') as f:
+                    f.write(file + '\n')
+
+    def _failure(self, source: str, e: BaseException) -> LabelledChordSequence:
+        # Structured result for a file whose processing failed in the parent's view, quarantining it if its worker
+        # timed out or crashed on every attempt
+        if isinstance(e, WorkerFailure):
+            self._quarantine(source)
+            error = ExtractionError(kind=e.kind, message=str(e), attempts=e.attempts)
+        else:
+            error = ExtractionError(kind='error', message='{}: {}'.format(type(e).__name__, e))
+        return LabelledChordSequence(id=source, sequence=None, error=error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def close(self):
+        """Wait for any submitted work to finish, then shut down the worker processes."""
+        for pool in self._pools():
+            pool.close()
+            pool.join()
+
+    def terminate(self):
+        """Stop the worker processes immediately, abandoning any work in progress."""
+        # The conversion pool goes first, as its callbacks submit work to the extractor pool
+        for pool in self._pools():
+            pool.terminate()
+            pool.join()
+
+    def extract_many(self,
+                     files: List[str],
+                     callback: Callable[[LabelledChordSequence], None] = None,
+                     max_files_in_cache: int = 50,
+                     stop_on_error=False,
+                     metrics: Optional[MetricsCollector] = None,
+                     longest_first: bool = False,
+                     deduplicate: bool = False,
+                     max_bytes_in_cache: Optional[int] = None) -> List[LabelledChordSequence]:
+        """
+        Extract chords from a list of files using the workers of this pool. See ChordExtractor.extract_many.
+
+        :param files: List of paths to files we wish to extract chords for
+        :param callback: An optional callable that is called with each result as it completes
+        :param max_files_in_cache: See ChordExtractor.extract_many
+        :param stop_on_error: See ChordExtractor.extract_many
+        :param metrics: See ChordExtractor.extract_many
+        :param longest_first: See ChordExtractor.extract_many
+        :param deduplicate: See ChordExtractor.extract_many
+        :param max_bytes_in_cache: See ChordExtractor.extract_many
+        :return: List of results in the order the extractions completed
+        """
+        res = []
+        for r in self.iter_extract_many(files, max_files_in_cache=max_files_in_cache,
+                                        max_in_flight=len(files) or None, stop_on_error=stop_on_error,
+                                        metrics=metrics, longest_first=longest_first, deduplicate=deduplicate,
+                                        max_bytes_in_cache=max_bytes_in_cache):
+            if callback:
+                callback(r)
+            res.append(r)
+        return res
+
+    def extract(self, file: str) -> Optional[List[ChordChange]]:
+        """
+        Preprocess and extract chords from a single file using the workers of this pool.
+
+        :param file: Path to the file
+        :return: List of chord changes for the sound file, or None if there was an error
+        """
+        return next(self.iter_extract_many([file])).sequence
+
+    def iter_extract_many(self,
+                          files: Iterable[str],
+                          max_files_in_cache: int = 50,
+                          max_in_flight: Optional[int] = None,
+                          stop_on_error=False,
+                          metrics: Optional[MetricsCollector] = None,
+                          longest_first: bool = False,
+                          deduplicate: bool = False,
+                          max_bytes_in_cache: Optional[int] = None) -> Iterator[LabelledChordSequence]:
+        """
+        Extract chords from many files using the workers of this pool, yielding each result as soon as it is ready.
+        See ChordExtractor.iter_extract_many. If the generator is closed early, files already submitted still complete
+        in the background.
+
+        :param files: Iterable of paths to files we wish to extract chords for
+        :param max_files_in_cache: See ChordExtractor.extract_many
+        :param max_in_flight: See ChordExtractor.iter_extract_many
+        :param stop_on_error: See ChordExtractor.extract_many
+        :param metrics: See ChordExtractor.extract_many
+        :param longest_first: See ChordExtractor.extract_many. The files are all read from the iterable and sorted
+         before any is submitted.
+        :param deduplicate: See ChordExtractor.iter_extract_many
+        :param max_bytes_in_cache: See ChordExtractor.extract_many
+        :return: Iterator of results in the order the extractions complete
+        """
+        if longest_first:
+            files = sorted(files, key=self.extractor.estimate_cost, reverse=True)
+        batch = _Batch(self, max_files_in_cache=max_files_in_cache, stop_on_error=stop_on_error, metrics=metrics,
+                       deduplicate=deduplicate, max_bytes_in_cache=max_bytes_in_cache)
+        yield from batch.run(files, max_in_flight or 4 * (self.num_extractors + self.num_preprocessors))
+
+
+class _BatchFile:
+    """A file of a batch in progress, and what it holds until it is finished with."""
+
+    __slots__ = ('source', 'timings', 'cost', 'holds_slot', 'pinned', 'conversion', 'nbytes')
+
+    def __init__(self, source: str, timings: Optional[Dict[str, float]], cost: float):
+        self.source = source
+        # Stage timings of the file if it is being timed
+        self.timings = timings
+        self.cost = cost
+        # Whether the file holds a conversion slot, or a place in the byte budget, and once preprocessed, what it made
+        self.holds_slot = False
+        # Whether the file is counted in those in progress with its path, which share its conversion
+        self.pinned = False
+        self.conversion = None
+        self.nbytes = 0
+
+
+class _Batch:
+    """
+    A single iteration of ExtractorPool.iter_extract_many. Files are submitted to the processes of the pool while the
+    limits on the files in flight and the conversions held allow, and the callbacks of the processes hand the results
+    to the iterating thread through a queue. Whatever a file holds is released by _finish, however its processing
+    ends. The callbacks run in the threads of the process pools that deliver results, which an exception would stop,
+    so any error raised in them becomes the result of the file instead.
+
+    Conversion files are removed here rather than by the extraction processes, once no other file of the batch with
+    the same path is in progress, as those files share the conversion (see ConversionCache).
+    """
+
+    def __init__(self, pool: ExtractorPool, max_files_in_cache: int, stop_on_error: bool,
+                 metrics: Optional[MetricsCollector], deduplicate: bool, max_bytes_in_cache: Optional[int]):
+        self.pool = pool
+        self.extractor = pool.extractor
+        self.stop_on_error = stop_on_error
+        self.metrics = metrics
+        self.remove_conversions = bool(max_files_in_cache or max_bytes_in_cache) and \
+            not self.extractor.conversion_cache.max_size_bytes
+        # Bounds the bytes, or else the number, of conversions made but not yet extracted from
+        self.budget = None
+        self.conversion_slots = None
+        if max_bytes_in_cache:
+            self.budget = _ByteBudget(max_bytes_in_cache, pool.num_extractors + pool.num_preprocessors
+                                      if pool.balance_workers else pool.num_preprocessors)
+        elif max_files_in_cache:
+            self.conversion_slots = threading.BoundedSemaphore(max_files_in_cache)
+        # Results, each with the stage timings of the file if it is being timed
+        self.done = queue.SimpleQueue()
+        self.dedup = _Deduplicator() if deduplicate else None
+        # Files waiting on the result of an earlier file with the same contents, and results of files already
+        # extracted from, by the path of the earlier file
+        # Original in progress -> later files with the same contents, waiting for its result
+        self.duplicates: Dict[str, List[str]] = {}
+        # Number of files in progress by path, for those being preprocessed, and the conversion file they share
+        self.pins: Dict[str, list] = {}
+        self._pins_lock = threading.Lock()
+
+    def run(self, files: Iterable[str], window: int) -> Iterator[LabelledChordSequence]:
+        files = iter(files)
+        in_flight = 0
+        started = time.perf_counter()
+        try:
+            while True:
+                while in_flight < window:
+                    file = next(files, None)
+                    if file is None:
+                        break
+                    in_flight += self._start(file)
+                if not in_flight:
+                    break
+                res, timings = self.done.get()
+                in_flight -= 1
+                if isinstance(res, _Fatal):
+                    raise res.error
+                yield from self._deliver(res, timings)
+        finally:
+            if self.metrics is not None:
+                self.metrics.add_wall_time(time.perf_counter() - started)
+                self.metrics.flush()
+
+    def _start(self, file: str) -> int:
+        # Submit a file, returning the number of results added to those in flight
+        timings = {'_submitted': time.perf_counter()} if self.metrics is not None else None
+        original = self.dedup.original(file) if self.dedup is not None else None
+        if original is not None:
+            self.duplicates.setdefault(original, []).append(file)
+            return 0
+        item = _BatchFile(file, timings, self.extractor.estimate_cost(file) if self.pool.balance_workers else 0.)
+        if file in self.pool.quarantined:
+            _log.warning('Skipping quarantined file {}'.format(file))
+            self._finish(item, LabelledChordSequence(id=file, sequence=None, error=ExtractionError(
+                kind='quarantined', message='Skipped as it failed in an earlier run', attempts=0)))
+        elif self.extractor.needs_preprocessing(file):
+            self._acquire(item)
+            self._pin(item)
+            self._submit(self.pool._conversion_pool, _preprocess, (file,), {}, item,
+                         partial(self._on_preprocessed, item), partial(self._on_preprocess_error, item),
+                         _Dispatcher.CONVERSION)
+        else:
+            self._submit(self.pool._extractor_pool, _extract, (file,), {'stop_on_error': self.stop_on_error}, item,
+                         partial(self._finish, item), partial(self._on_error, item, 'extracting chords from'),
+                         _Dispatcher.EXTRACTION)
+        return 1
+
+    def _acquire(self, item: _BatchFile):
+        # Wait for room for another conversion
+        wait_start = time.perf_counter()
+        if self.budget is not None:
+            self.budget.start_conversion()
+        elif self.conversion_slots:
+            self.conversion_slots.acquire()
+        else:
+            return
+        item.holds_slot = True
+        if item.timings is not None:
+            item.timings['backpressure'] = time.perf_counter() - wait_start
+
+    def _submit(self, pool, fn, args, kwds, item: _BatchFile, callback, error_callback, priority: int):
+        # With shared processes, the stage and estimated cost of the file decide when it runs (see _Dispatcher)
+        scheduling = {'stage': priority, 'cost': item.cost} if self.pool.balance_workers else {}
+        callback, error_callback = self._guard(item, callback), self._guard(item, error_callback)
+        timings = item.timings
+        if timings is None:
+            pool.apply_async(fn, args=args, kwds=kwds, callback=callback, error_callback=error_callback,
+                             **scheduling)
+            return
+
+        def timed_callback(res):
+            res, worker_timings = res
+            for name, value in worker_timings.items():
+                timings[name] = timings.get(name, 0.) + value
+            callback(res)
+
+        pool.apply_async(_instrumented, args=(fn, time.time()) + args, kwds=kwds, callback=timed_callback,
+                         error_callback=error_callback, **scheduling)
+
+    def _guard(self, item: _BatchFile, fn):
+        def guarded(value):
+            try:
+                fn(value)
+            except Exception as e:
+                self._on_error(item, 'handling the result of', e)
+        return guarded
+
+    def _removed(self, conversion) -> bool:
+        # Shared memory is always freed once extracted from, while files may be kept by the conversion cache
+        return isinstance(conversion, SharedAudio) or (bool(conversion) and self.remove_conversions)
+
+    def _held_bytes(self, conversion) -> int:
+        if isinstance(conversion, SharedAudio):
+            return conversion.nbytes
+        if self.budget is None or not self._removed(conversion):
+            return 0
+        try:
+            return os.path.getsize(conversion)
+        except OSError:
+            return 0
+
+    def _converted(self, item: _BatchFile, conversion):
+        # Preprocessing of the file has finished, with the conversion it made, if any
+        item.conversion = conversion
+        item.nbytes = self._held_bytes(conversion)
+        if self._removed(conversion) and not isinstance(conversion, SharedAudio):
+            with self._pins_lock:
+                self.pins[os.path.abspath(item.source)][1] = conversion
+        if self.budget is not None:
+            self.budget.converted(item.nbytes)
+
+    def _on_preprocessed(self, item: _BatchFile, preprocessed):
+        conversion, cached, key = preprocessed
+        if cached is not None:
+            self._converted(item, None)
+            self._finish(item, LabelledChordSequence(id=item.source, sequence=cached))
+            return
+        self._converted(item, conversion)
+        self._submit(self.pool._extractor_pool, _consume, (conversion or item.source,),
+                     {'source': item.source, 'remove_path': isinstance(conversion, SharedAudio),
+                      'stop_on_error': self.stop_on_error, 'result_key': key},
+                     item, partial(self._finish, item), partial(self._on_error, item, 'extracting chords from'),
+                     _Dispatcher.EXTRACTION)
+
+    def _on_preprocess_error(self, item: _BatchFile, e: BaseException):
+        self._converted(item, None)
+        self._on_error(item, 'preprocessing', e)
+
+    def _on_error(self, item: _BatchFile, stage_name: str, e: BaseException):
+        if self.stop_on_error:
+            # Released as for any other file, as submitting the next file may be waiting for the slot
+            self._finish(item, _Fatal(e))
+            return
+        _log.error('Error has been encountered with {} {}.'.format(stage_name, item.source))
+        _log.error(e)
+        self._finish(item, self.pool._failure(item.source, e))
+
+    def _pin(self, item: _BatchFile):
+        with self._pins_lock:
+            self.pins.setdefault(os.path.abspath(item.source), [0, None])[0] += 1
+        item.pinned = True
+
+    def _release_conversion(self, item: _BatchFile):
+        if not item.pinned:
+            return
+        if isinstance(item.conversion, SharedAudio):
+            # The file's own, and normally freed by the extraction process already, which releasing again allows for
+            self.extractor._discard_conversion(item.conversion)
+        key = os.path.abspath(item.source)
+        with self._pins_lock:
+            entry = self.pins[key]
+            entry[0] -= 1
+            if entry[0]:
+                return
+            del self.pins[key]
+        if entry[1] is not None:
+            self.extractor._discard_conversion(entry[1])
+
+    def _finish(self, item: _BatchFile, res: Union[LabelledChordSequence, _Fatal]):
+        # Release whatever the file holds and pass on its result, which is an error if the release fails
+        try:
+            self._release_conversion(item)
+        except Exception as e:
+            _log.error('Error has been encountered with removing the conversion of {}.'.format(item.source))
+            _log.error(e)
+            if not isinstance(res, _Fatal):
+                res = self.pool._failure(item.source, e)
+        finally:
+            if item.holds_slot:
+                if self.budget is not None:
+                    self.budget.release(item.nbytes)
+                else:
+                    self.conversion_slots.release()
+        self.done.put((res, item.timings))
+
+    def _deliver(self, res: LabelledChordSequence, timings) -> Iterator[LabelledChordSequence]:
+        duplicates = ()
+        if self.dedup is not None:
+            # Later copies of a finished original are extracted from again, or found in the extractor's result cache
+            self.dedup.forget(res.id)
+            duplicates = self.duplicates.pop(res.id, ())
+        if timings is None:
+            yield res
+        else:
+            # The time until the generator is resumed is spent by the caller handling the result
+            yielded = time.perf_counter()
+            try:
+                yield res
+            finally:
+                timings['callback'] = time.perf_counter() - yielded
+                self.metrics.record(self._file_metrics(res, timings))
+        for file in duplicates:
+            yield res._replace(id=file)
+
+    @staticmethod
+    def _file_metrics(res: LabelledChordSequence, timings) -> FileMetrics:
+        submitted = timings.pop('_submitted')
+        audio_seconds = timings.pop('audio_seconds', None)
+        try:
+            size = os.path.getsize(res.id)
+        except (OSError, TypeError):
+            size = None
+        total = time.perf_counter() - submitted - timings['callback']
+        return FileMetrics(id=res.id, stages=timings, total_seconds=total, audio_seconds=audio_seconds, bytes=size,
+                           ok=res.sequence is not None)
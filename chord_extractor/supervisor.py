@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+# Chord Extractor
+# Copyright (C) 2021-22  Oliver Holloway
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+A process pool that survives its tasks: each task has a time limit, and a worker that exceeds it or dies (e.g. from a
+segfault in a native library) is killed and replaced without affecting the other workers, with the task retried a
+bounded number of times.
+"""
+
+from collections import deque
+from multiprocessing.connection import wait
+from typing import Callable, List, Optional
+import logging
+import multiprocessing as mp
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+
+class WorkerFailure(Exception):
+    """
+    A task whose worker process timed out or died on every attempt.
+
+    :param kind: 'timeout' or 'crash'
+    :param message: Description of the failure
+    :param attempts: Number of times the task was attempted
+    """
+
+    def __init__(self, kind: str, message: str, attempts: int):
+        super().__init__(message)
+        self.kind = kind
+        self.attempts = attempts
+
+
+def _worker(conn, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        fn, args, kwds = task
+        try:
+            res = ('ok', fn(*args, **kwds))
+        except Exception as e:
+            res = ('error', e)
+        try:
+            conn.send(res)
+        except Exception as e:
+            # The result or exception could not be pickled
+            conn.send(('error', RuntimeError('{}: {}'.format(type(e).__name__, e))))
+
+
+class _Task:
+    __slots__ = ('fn', 'args', 'kwds', 'callback', 'error_callback', 'attempts')
+
+    def __init__(self, fn, args, kwds, callback, error_callback):
+        self.fn = fn
+        self.args = args
+        self.kwds = kwds
+        self.callback = callback
+        self.error_callback = error_callback
+        self.attempts = 0
+
+
+class _Worker:
+    def __init__(self, ctx, initializer, initargs):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker, args=(child, initializer, initargs), daemon=True)
+        self.process.start()
+        child.close()
+        self.task: Optional[_Task] = None
+        self.deadline = None
+        self.completed = 0
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+
+class SupervisedPool:
+    """
+    Process pool with the apply_async interface of multiprocessing.Pool, in which each task runs under a time limit.
+    A worker that exceeds it, or that dies while running a task, is killed and replaced, and the task is retried on a
+    fresh worker up to max_retries times before its error_callback is called with a WorkerFailure. Exceptions raised
+    by a task are passed to its error_callback as usual, without retrying. Callbacks are called from a single
+    supervising thread, so should return quickly.
+
+    :param processes: Number of worker processes
+    :param initializer: Called with initargs in each worker process when it starts
+    :param initargs: Arguments for initializer
+    :param maxtasksperchild: If given, workers are replaced after this many tasks
+    :param task_timeout: Seconds a task may run for before its worker is killed, or None for no limit
+    :param max_retries: Number of times a task whose worker timed out or died is retried
+    """
+
+    def __init__(self,
+                 processes: int = 1,
+                 initializer: Optional[Callable] = None,
+                 initargs: tuple = (),
+                 maxtasksperchild: Optional[int] = None,
+                 task_timeout: Optional[float] = None,
+                 max_retries: int = 0):
+        self._ctx = mp.get_context()
+        self._initializer = initializer
+        self._initargs = initargs
+        self._maxtasksperchild = maxtasksperchild
+        self.task_timeout = task_timeout
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._wake_recv, self._wake_send = self._ctx.Pipe(duplex=False)
+        # Whether a wake is in the pipe and not yet drained, so that there is never more than one
+        self._woken = False
+        self._closing = False
+        self._terminated = False
+        self._workers = [self._start_worker() for _ in range(processes)]
+        self._thread = threading.Thread(target=self._supervise, daemon=True)
+        self._thread.start()
+
+    def _start_worker(self) -> _Worker:
+        return _Worker(self._ctx, self._initializer, self._initargs)
+
+    def _wake(self):
+        # Called without the lock held, as a send blocking on a full pipe would otherwise stop the supervising thread
+        # from taking the lock to drain it
+        with self._lock:
+            if self._woken:
+                return
+            self._woken = True
+        self._wake_send.send(None)
+
+    def apply_async(self, fn: Callable, args: tuple = (), kwds: Optional[dict] = None,
+                    callback: Optional[Callable] = None, error_callback: Optional[Callable] = None):
+        """Submit a task, as multiprocessing.Pool.apply_async does (the result object is not supported)."""
+        with self._lock:
+            if self._closing:
+                raise ValueError('Pool not running')
+            self._pending.append(_Task(fn, args, kwds or {}, callback, error_callback))
+        self._wake()
+
+    def close(self):
+        """Stop accepting tasks, letting the workers exit once those submitted have finished."""
+        with self._lock:
+            self._closing = True
+        self._wake()
+
+    def terminate(self):
+        """Kill the workers immediately, abandoning any tasks submitted."""
+        with self._lock:
+            self._closing = True
+            self._terminated = True
+        self._wake()
+
+    def join(self):
+        """Wait for the supervising thread to exit, after close or terminate."""
+        self._thread.join()
+
+    def _finish(self, task: _Task, ok: bool, value):
+        fn = task.callback if ok else task.error_callback
+        if fn is None:
+            return
+        try:
+            fn(value)
+        except Exception as e:
+            _log.exception(e)
+
+    def _replace(self, worker: _Worker, kind: str, message: str):
+        # Kill the worker and start another in its place, then retry or fail its task
+        task = worker.task
+        worker.kill()
+        self._workers[self._workers.index(worker)] = self._start_worker()
+        task.attempts += 1
+        if task.attempts <= self.max_retries:
+            _log.warning('{}, retrying ({} of {})'.format(message, task.attempts, self.max_retries))
+            with self._lock:
+                self._pending.appendleft(task)
+        else:
+            _log.error(message)
+            self._finish(task, False, WorkerFailure(kind, message, task.attempts))
+
+    def _describe(self, task: _Task) -> str:
+        return '{}{}'.format(getattr(task.fn, '__name__', task.fn), task.args)
+
+    def _supervise(self):
+        while True:
+            busy = self._assign()
+            if busy is None:
+                break
+            ready = self._wait(busy)
+            for worker in busy:
+                self._check(worker, ready)
+        for worker in self._workers:
+            if self._terminated:
+                worker.kill()
+            else:
+                worker.stop()
+
+    def _assign(self) -> Optional[List[_Worker]]:
+        # Hand pending tasks to idle workers, returning the workers with tasks, or None once the pool should stop
+        with self._lock:
+            if self._terminated:
+                return None
+            idle = [w for w in self._workers if w.task is None]
+            assigned = []
+            while idle and self._pending:
+                worker, task = idle.pop(), self._pending.popleft()
+                worker.task = task
+                assigned.append(worker)
+        unsent = []
+        for worker in assigned:
+            worker.deadline = time.monotonic() + self.task_timeout if self.task_timeout else None
+            try:
+                worker.conn.send((worker.task.fn, worker.task.args, worker.task.kwds))
+            except Exception as e:
+                # The task itself could not be pickled
+                unsent.append((worker.task, e))
+                worker.task = None
+        for task, e in unsent:
+            self._finish(task, False, e)
+        with self._lock:
+            busy = [w for w in self._workers if w.task is not None]
+            if self._closing and not busy and not self._pending:
+                return None
+        return busy
+
+    def _wait(self, busy: List[_Worker]) -> list:
+        # Wait for a result, a worker to die, the earliest deadline or a wake
+        deadlines = [w.deadline for w in busy if w.deadline is not None]
+        timeout = max(0., min(deadlines) - time.monotonic()) if deadlines else None
+        ready = wait([self._wake_recv] + [w.conn for w in busy] + [w.process.sentinel for w in busy], timeout)
+        if self._wake_recv in ready:
+            while self._wake_recv.poll():
+                self._wake_recv.recv()
+            # Cleared only once drained, so a wake skipped in the meantime was for a change made before this, which
+            # _assign sees next
+            with self._lock:
+                self._woken = False
+        return ready
+
+    def _check(self, worker: _Worker, ready: list):
+        if worker.conn in ready:
+            self._receive(worker)
+        elif worker.process.sentinel in ready:
+            worker.process.join(1)
+            self._replace(worker, 'crash', 'Worker died (exit code {}) running {}'.format(
+                worker.process.exitcode if worker.process.exitcode is not None else 'unknown',
+                self._describe(worker.task)))
+        elif worker.deadline is not None and time.monotonic() >= worker.deadline:
+            self._replace(worker, 'timeout', 'Timed out after {}s running {}'.format(
+                self.task_timeout, self._describe(worker.task)))
+
+    def _receive(self, worker: _Worker):
+        try:
+            status, value = worker.conn.recv()
+        except (EOFError, OSError):
+            self._replace(worker, 'crash', 'Worker died running {}'.format(self._describe(worker.task)))
+            return
+        task, worker.task = worker.task, None
+        worker.completed += 1
+        self._finish(task, status == 'ok', value)
+        if self._maxtasksperchild and worker.completed >= self._maxtasksperchild:
+            worker.stop()
+            self._workers[self._workers.index(worker)] = self._start_worker()
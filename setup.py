@@ -24,7 +24,10 @@ setuptools.setup(
     ],
     python_requires='>=3.8,<3.12',
     install_requires=[
-        'librosa', 'vamp'
+        'librosa', 'vamp', 'soundfile>=0.11', 'soxr>=0.3'
     ],
-    package_data={'chord_extractor': ['_lib/nnls-chroma.so']}
+    package_data={'chord_extractor': ['_lib/nnls-chroma.so']},
+    entry_points={
+        'console_scripts': ['chord-extractor=chord_extractor.cli:main'],
+    }
 )
\ No newline at end of file
@@ -1,9 +1,27 @@
-from chord_extractor import clear_conversion_cache, LabelledChordSequence
-from chord_extractor.extractors import Chordino
+from chord_extractor import clear_conversion_cache, LabelledChordSequence, ResultCache, ConversionCache, \
+    ExtractorPool, AudioCache, ChordSequence, save_sequences, load_sequences, MetricsCollector, JsonLinesSink, \
+    PrometheusTextfileSink, SQLiteJobQueue, DistributedWorker, AsyncExtractorPool, Overloaded, Audio
+from chord_extractor.aio import close_shared_pool, shared_pool
+from chord_extractor.memory import SharedAudio
+from chord_extractor.supervisor import SupervisedPool
+from chord_extractor import ChordExtractor, ChordChange
+from chord_extractor.extractors import Chordino, ChromaNormalization, DecodeBackend, Resampler
 import os
 from os.path import abspath, join, realpath, isfile
 from timeit import default_timer
 import json
+import shutil
+import pickle
+import asyncio
+import gc
+import weakref
+import pytest
+import signal
+import threading
+import time
+import subprocess
+import sys
+import numpy as np
 
 sample_file_dir = abspath(join(realpath(__file__), '../data'))
 out_dir = abspath(join(realpath(__file__), '../out'))
@@ -61,3 +79,622 @@ def test_extract():
             c.extract(s)
     end = default_timer()
     print(end - start)
+
+
+def test_result_cache(tmp_path, monkeypatch):
+    from chord_extractor import base, pool
+    cache = ResultCache(str(tmp_path / 'results.sqlite'))
+    c = Chordino(result_cache=cache)
+    files = [s for s in sample_files if s.endswith(('.ogg', '.mp3'))]
+    # A miss hashes the file once, for both the lookup and storing the result
+    hashed = []
+    digest = base.file_digest
+    monkeypatch.setattr(base, 'file_digest', lambda f: hashed.append(f) or digest(f))
+    c.extract(files[1], end=5)
+    pool._init_worker(c)
+    assert pool._extract(files[1]).sequence
+    assert hashed == files[1:2] * 2
+    monkeypatch.undo()
+    cache.invalidate()
+    first = c.extract(files[0])
+    assert c.extract(files[0]) == first
+    res = c.extract_many(files, num_extractors=2)
+    assert len(res) == len(files)
+    assert cache.stats().hits == 2
+    assert Chordino(roll_on=2, result_cache=cache).identity() != c.identity()
+    assert cache.invalidate(files[0]) == 1
+    assert cache.stats().entries == len(files) - 1
+
+    # The size kept for eviction follows replacements, evictions and removals
+    limited = ResultCache(str(tmp_path / 'limited.sqlite'), max_size_bytes=100)
+    changes = [ChordChange(chord='C{}'.format(i), timestamp=float(i)) for i in range(20)]
+    for i in range(10):
+        limited.put(str(i), 'id', changes[:2 * i + 1])
+    limited.put('9', 'id', changes[:1])
+    stats = limited.stats()
+    assert 0 < stats.size_bytes <= 100 and stats.entries < 10
+    assert stats.size_bytes == limited._connection().execute('SELECT SUM(size) FROM results').fetchone()[0]
+    assert limited.get('9', 'id') == changes[:1]
+    limited.invalidate(identity='id')
+    assert limited.stats() == (1, 0, 0, 0)
+
+
+def test_conversion_cache(tmp_path):
+    def copy(source, dest):
+        if 'error' in source:
+            return False
+        shutil.copyfile(source, dest)
+        return True
+
+    midis = sorted(s for s in sample_files if s.endswith('.mid') and 'error' not in s)[:3]
+    size = max(os.path.getsize(m) for m in midis)
+    cache = ConversionCache(str(tmp_path / 'conversions'), max_size_bytes=2 * size)
+    first = cache.fetch(midis[0], 'copy', copy)
+    assert cache.fetch(midis[0], 'copy', copy) == first
+    assert cache.fetch(midis[0], 'other', copy) != first
+    assert cache.fetch(join(sample_file_dir, '3error_not_really_a_midi.mid'), 'copy', copy) is None
+    for m in midis:
+        cache.fetch(m, 'copy', copy)
+    stats = cache.stats()
+    assert stats.hits == 2
+    assert stats.size_bytes <= 2 * size
+    assert not [f for f in os.listdir(cache.directory) if f.endswith('.tmp')]
+    cache.clear()
+    assert cache.stats().entries == 0
+    cache.remove(first)
+
+    # Conversions shared by files of a batch are only removed once every one has been extracted from
+    cache = ConversionCache(str(tmp_path / 'unlimited'))
+    os.makedirs(str(tmp_path / 'copy'))
+    copies = [midis[0], shutil.copy(midis[0], str(tmp_path / 'copy'))]
+    res = Chordino(conversion_cache=cache).extract_many(copies * 2, num_extractors=2, num_preprocessors=2)
+    assert len(res) == 4 and all(r.sequence for r in res)
+    assert cache.stats().entries == 0
+
+    # A run in another process sharing the cache removes a conversion this one has made but not yet read
+    c = Chordino(conversion_cache=cache)
+    conversion = c.preprocess(midis[1])
+    code = ('from chord_extractor import ConversionCache\n'
+            'from chord_extractor.extractors import Chordino\n'
+            'res = Chordino(conversion_cache=ConversionCache({!r})).extract_many([{!r}], max_files_in_cache=1)\n'
+            'assert res[0].sequence').format(cache.directory, midis[1])
+    subprocess.run([sys.executable, '-c', code], check=True, timeout=300)
+    assert not os.path.exists(conversion)
+    res = c._consume(conversion, source=midis[1], remove_path=True)
+    assert res.error is None and res.sequence
+    assert not os.path.exists(conversion)
+
+
+def test_iter_extract_many():
+    c = Chordino()
+    files = (s for s in sample_files)
+    ids = [r.id for r in c.iter_extract_many(files, num_extractors=2, num_preprocessors=2, max_in_flight=3)]
+    assert sorted(ids) == sorted(sample_files)
+
+
+def _record_submissions(monkeypatch):
+    # Record the function and file of each task a batch submits to its processes
+    from chord_extractor import pool
+    submitted = []
+    submit = pool._Batch._submit
+
+    def recording(self, processes, fn, args, *rest):
+        submitted.append((fn, args[0]))
+        submit(self, processes, fn, args, *rest)
+
+    monkeypatch.setattr(pool._Batch, '_submit', recording)
+    return submitted
+
+
+def test_needs_preprocessing(monkeypatch):
+    from chord_extractor import pool
+    from chord_extractor.extractors.chordino import _ChordinoSweep, _ChordinoFeatures, _ChordinoSpan
+    submitted = _record_submissions(monkeypatch)
+    audio = [s for s in sample_files if s.endswith(('.ogg', '.mp3'))]
+    midis = sorted(s for s in sample_files if s.endswith('.mid') and 'error' not in s)[:2]
+    c = Chordino()
+    for extractor in (c, _ChordinoSweep(c, [{}]), _ChordinoFeatures(c, ('chroma',), ChromaNormalization.NONE),
+                      _ChordinoSpan(c, 0, 10)):
+        assert not any(extractor.needs_preprocessing(f) for f in audio)
+        assert all(extractor.needs_preprocessing(m) for m in midis)
+    assert all(Chordino(decode_in_preprocessing=True).needs_preprocessing(f) for f in audio)
+    res = c.extract_many(audio + midis, num_extractors=2)
+    assert all(r.sequence for r in res)
+    assert sorted(f for fn, f in submitted if fn is pool._preprocess) == midis
+
+
+def test_conversion_backpressure(monkeypatch):
+    from chord_extractor import pool
+    submitted = _record_submissions(monkeypatch)
+    held, peak, lock = [0], [0], threading.Lock()
+    converted, finish = pool._Batch._converted, pool._Batch._finish
+
+    def counting_converted(self, item, conversion):
+        if conversion:
+            with lock:
+                held[0] += 1
+                peak[0] = max(peak[0], held[0])
+        converted(self, item, conversion)
+
+    def counting_finish(self, item, res):
+        if item.conversion:
+            with lock:
+                held[0] -= 1
+        finish(self, item, res)
+
+    monkeypatch.setattr(pool._Batch, '_converted', counting_converted)
+    monkeypatch.setattr(pool._Batch, '_finish', counting_finish)
+    audio = [s for s in sample_files if s.endswith(('.ogg', '.mp3'))]
+    midis = [s for s in sample_files if s.endswith('.mid') and 'error' not in s]
+    res = Chordino().extract_many(midis + audio, num_extractors=1, num_preprocessors=3, max_files_in_cache=2)
+    assert len(res) == len(midis) + len(audio) and all(r.sequence for r in res)
+    # Audio goes straight to extraction, while midi waits for a slot for its conversion
+    assert sorted(f for fn, f in submitted if fn is pool._extract) == sorted(audio)
+    assert sorted(f for fn, f in submitted if fn is pool._preprocess) == sorted(midis)
+    assert 0 < peak[0] <= 2 and held[0] == 0
+
+
+def test_extractor_pool():
+    files = [s for s in sample_files if 'error' not in s][:4]
+    with ExtractorPool(Chordino(), num_extractors=2, num_preprocessors=2, max_tasks_per_worker=2) as pool:
+        for batch in (files[:2], files[2:]):
+            res = pool.extract_many(batch)
+            assert sorted(r.id for r in res) == sorted(batch)
+            assert all(r.sequence for r in res)
+        assert pool.extract(files[0])
+
+
+def test_audio_cache(tmp_path):
+    cache = AudioCache(str(tmp_path / 'decoded'))
+    file = [s for s in sample_files if s.endswith('.ogg')][0]
+    expected = Chordino().extract(file)
+    assert Chordino(audio_cache=cache).extract(file) == expected
+    assert Chordino(roll_on=2, audio_cache=cache).extract(file)
+    assert Chordino(audio_cache=cache).extract(file) == expected
+    assert cache.stats().hits == 2
+    assert cache.stats().entries == 1
+
+
+def test_extract_sweep():
+    from chord_extractor.extractors.chordino import _ChordinoSweep
+    c = Chordino()
+    file = [s for s in sample_files if s.endswith('.ogg')][0]
+    param_sets = [{}, {'roll_on': 2, 'spectral_whitening': 0.5}]
+    res = c.extract_sweep(file, param_sets)
+    assert res[0] == c.extract(file)
+    assert res[1] == Chordino(roll_on=2, spectral_whitening=0.5).extract(file)
+    files = [s for s in sample_files if s.endswith(('.ogg', '.mp3', '.mid'))][:3]
+    many = c.extract_sweep_many(files, param_sets, num_extractors=2)
+    assert len(many) == 2
+    assert [len(m) for m in many] == [3, 3]
+    assert _ChordinoSweep(c, param_sets).estimate_cost(file) == 2 * c.estimate_cost(file)
+
+
+def test_extract_stream():
+    file = [s for s in sample_files if s.endswith('.ogg')][0]
+    expected = Chordino().extract(file)
+    assert list(Chordino().extract_stream(file)) == expected
+    assert Chordino(streaming=True).extract(file) == expected
+
+
+def test_decode_backend():
+    file = [s for s in sample_files if s.endswith('.ogg')][0]
+    expected = Chordino().extract(file)
+    assert Chordino(decoder=DecodeBackend.SOUNDFILE).extract(file) == expected
+    assert Chordino(decoder=DecodeBackend.SOUNDFILE, streaming=True).extract(file) == expected
+    fast = Chordino(decoder=DecodeBackend.SOUNDFILE, resampler=Resampler.QQ).extract(file)
+    assert [c.chord for c in fast] == [c.chord for c in expected]
+    assert Chordino(decoder=DecodeBackend.SOUNDFILE, sample_rate=None).extract(file)
+    assert Chordino(sample_rate=None).identity() != Chordino().identity()
+    assert Chordino(streaming=True).identity() != Chordino().identity()
+
+
+def test_stream_ffmpeg(tmp_path, monkeypatch):
+    from chord_extractor.decoders import stream_ffmpeg
+    # An ffmpeg writing far more warnings than a pipe holds before its output, then failing
+    ffmpeg = tmp_path / 'ffmpeg'
+    ffmpeg.write_text('#!{}\nimport sys\nsys.stderr.write("warning\\n" * 100000)\nsys.stderr.flush()\n'
+                      'sys.stdout.buffer.write(bytes(4000))\nsys.exit(1)\n'.format(sys.executable))
+    ffmpeg.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(tmp_path, os.environ['PATH']))
+    rate, blocks = stream_ffmpeg('any.mp3', 22050, block_frames=500)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        list(blocks)
+    assert e.value.stderr.startswith(b'warning')
+
+
+def test_midi_in_memory(tmp_path):
+    cache = ConversionCache(str(tmp_path / 'conversions'))
+    c = Chordino(midi_in_memory=True, conversion_cache=cache)
+    files = [s for s in sample_files if s.endswith('.mid') and 'error' not in s][:3] + \
+        [s for s in sample_files if s.endswith('not_really_a_midi.mid')]
+    res = {r.id: r.sequence for r in c.extract_many(files, num_extractors=2)}
+    assert len(res) == 4
+    assert res[files[-1]] is None
+    assert all(res[f] for f in files[:-1])
+    assert cache.stats().entries == 0
+
+
+def test_compact_results(tmp_path):
+    files = [s for s in sample_files if s.endswith(('.ogg', '.mp3'))] + \
+        [s for s in sample_files if s.endswith('just_a_txt.txt')]
+    expected = {r.id: r.sequence for r in Chordino().extract_many(files)}
+    res = Chordino(compact_results=True).extract_many(files, num_extractors=2)
+    assert all(isinstance(r.sequence, ChordSequence) for r in res if r.sequence is not None)
+    assert {r.id: r.sequence for r in res} == expected
+    seq = next(r.sequence for r in res if r.sequence is not None)
+    assert pickle.loads(pickle.dumps(seq)) == seq
+    assert seq[1:3] == list(seq)[1:3]
+    save_sequences(str(tmp_path / 'res.npz'), res)
+    assert load_sequences(str(tmp_path / 'res.npz')) == res
+
+
+def test_metrics(tmp_path):
+    files = [s for s in sample_files if s.endswith(('.ogg', '.mid'))][:3]
+    metrics = MetricsCollector([JsonLinesSink(str(tmp_path / 'events.jsonl')),
+                                PrometheusTextfileSink(str(tmp_path / 'metrics.prom'))])
+    res = Chordino().extract_many(files, num_extractors=2, metrics=metrics, callback=lambda r: None)
+    metrics.close()
+    assert metrics.files == len(res) == 3
+    assert metrics.throughput() > 0
+    with open(str(tmp_path / 'events.jsonl')) as f:
+        events = [json.loads(line) for line in f]
+    assert sorted(e['id'] for e in events) == sorted(files)
+    for e in events:
+        assert {'queue_wait', 'callback'} <= set(e['stages'])
+        if e['ok']:
+            assert {'decode', 'plugin', 'postprocess'} <= set(e['stages'])
+            assert e['audio_seconds'] > 0
+    with open(str(tmp_path / 'metrics.prom')) as f:
+        prom = f.read()
+    assert 'chord_extractor_files_total 3' in prom
+    assert 'chord_extractor_stage_seconds_count{stage="plugin"}' in prom
+
+
+def test_import_time(tmp_path):
+    # Importing the package should not import the heavy audio dependencies or touch the file system, so that the
+    # command line and worker processes start quickly
+    code = 'import sys, chord_extractor.extractors; ' \
+           'print(",".join(m for m in ("librosa", "vamp", "soundfile", "pkg_resources") if m in sys.modules))'
+    env = dict(os.environ, EXTRACTOR_TEMP_FILE_PATH=str(tmp_path / 'tmp'))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True, text=True,
+                            check=True)
+    assert result.stdout.strip() == ''
+    assert not os.path.exists(str(tmp_path / 'tmp'))
+    # Cumulative import time of the package in microseconds, as reported by -X importtime
+    cumulative = [int(line.split('|')[1]) for line in result.stderr.splitlines()
+                  if line.rstrip().endswith('| chord_extractor.extractors')]
+    assert cumulative[0] < 1000000
+    # The package itself resolves its exports on first use, and the extractors leave out the pools and asyncio
+    heavy = ('numpy', 'sqlite3', 'asyncio', 'chord_extractor.cache', 'chord_extractor.pool',
+             'chord_extractor.distributed', 'chord_extractor.aio')
+    for module, absent in (('chord_extractor', heavy), ('chord_extractor.extractors', heavy[2:3] + heavy[4:])):
+        code = 'import sys, {}; print(",".join(m for m in {!r} if m in sys.modules))'.format(module, absent)
+        result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        assert result.stdout.strip() == ''
+    import chord_extractor
+    assert chord_extractor.ExtractorPool.__module__ == 'chord_extractor.pool'
+    assert set(chord_extractor.__all__) <= set(dir(chord_extractor))
+
+
+def test_cli(tmp_path):
+    from chord_extractor.cli import main
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    for f in [s for s in sample_files if s.endswith(('.ogg', '.mp3'))]:
+        shutil.copy(f, str(inputs))
+    (inputs / 'notes.txt').write_text('not audio')
+    output = str(tmp_path / 'out.jsonl')
+    assert main([str(inputs), '-o', output, '-j', '2']) == 0
+    with open(output) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2
+    assert all(line['chords'] for line in lines)
+    # A second run finds everything in the journal and extracts nothing
+    assert main([str(inputs / '*.ogg'), '-o', output]) == 0
+    with open(output) as f:
+        assert len(f.readlines()) == 2
+    with open(output + '.journal') as f:
+        assert len(f.readlines()) == 2
+
+
+class _FaultyExtractor(ChordExtractor):
+    def extract(self, file):
+        name = os.path.basename(file)
+        if name.startswith('hang'):
+            time.sleep(60)
+        elif name.startswith('crash'):
+            os.kill(os.getpid(), signal.SIGKILL)
+        elif name.startswith('bad'):
+            raise ValueError('Bad file')
+        elif name.startswith('slow'):
+            time.sleep(1)
+        return [ChordChange(chord='C', timestamp=0.)]
+
+
+class _ConvertingExtractor(_FaultyExtractor):
+    def preprocess(self, path):
+        return path + '.converted'
+
+
+class _UnremovableExtractor(_ConvertingExtractor):
+    def _discard_conversion(self, path):
+        raise PermissionError('Cannot remove {}'.format(path))
+
+
+def test_fault_isolation(tmp_path):
+    quarantine = str(tmp_path / 'quarantine.txt')
+    files = ['a.wav', 'hang.wav', 'crash.wav', 'bad.wav', 'b.wav']
+    start = default_timer()
+    res = {r.id: r for r in _FaultyExtractor().extract_many(files, num_extractors=2, task_timeout=1, max_retries=1,
+                                                            quarantine_file=quarantine)}
+    assert default_timer() - start < 30
+    assert res['a.wav'].sequence and res['b.wav'].sequence
+    assert res['hang.wav'].error.kind == 'timeout' and res['hang.wav'].error.attempts == 2
+    assert res['crash.wav'].error.kind == 'crash'
+    assert res['bad.wav'].error.kind == 'error' and res['bad.wav'].sequence is None
+    with open(quarantine) as f:
+        assert sorted(f.read().split()) == ['crash.wav', 'hang.wav']
+    res = {r.id: r for r in _FaultyExtractor().extract_many(files, task_timeout=1, quarantine_file=quarantine)}
+    assert res['hang.wav'].error.kind == res['crash.wav'].error.kind == 'quarantined'
+    with pytest.raises(ValueError):
+        _FaultyExtractor().extract_many(['a.wav', 'bad.wav'], stop_on_error=True)
+    with pytest.raises(ValueError):
+        _FaultyExtractor().extract_many(['a.wav', 'bad.wav'], stop_on_error=True, task_timeout=5)
+    # Tasks submitted faster than a slow callback lets them be sent to the workers wait without blocking the pool
+    results = []
+    pool = SupervisedPool(processes=1, task_timeout=10)
+    pool.apply_async(abs, (1,), callback=lambda _: results.append(None) or time.sleep(1))
+    while not results:
+        time.sleep(0.01)
+    for _ in range(20000):
+        pool.apply_async(abs, (1,), callback=results.append)
+    pool.close()
+    pool.join()
+    assert len(results) == 20001
+    # The failing file's conversion slot is released, so the files after it can still be submitted
+    for kwargs in ({'max_files_in_cache': 1}, {'max_bytes_in_cache': 1}, {'max_files_in_cache': 1, 'task_timeout': 5}):
+        with pytest.raises(ValueError):
+            _ConvertingExtractor().extract_many(['bad.wav', 'a.wav', 'b.wav'], stop_on_error=True, **kwargs)
+    # Errors cleaning up after a file are its result, rather than stopping results being delivered
+    for kwargs in ({}, {'task_timeout': 5}, {'balance_workers': True}):
+        res = _UnremovableExtractor().extract_many(['a.wav', 'b.wav', 'c.wav'], max_files_in_cache=1, **kwargs)
+        assert len(res) == 3 and all(r.error.kind == 'error' and 'Cannot remove' in r.error.message for r in res)
+
+
+def test_distributed(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / 'jobs.sqlite'), max_attempts=2)
+    assert queue.put(['a.wav', 'b.wav', 'bad.wav', 'a.wav']) == 3
+    # A worker that claims a file then dies, so its lease expires and the file goes back on the queue
+    dead = queue.claim('dead', lease_seconds=0)
+    assert [j.file for j in dead] == ['a.wav']
+    assert DistributedWorker(_FaultyExtractor(), queue, num_extractors=2, poll_interval=0.1).run() == 3
+    assert not queue.complete('dead', dead[0], LabelledChordSequence(id='a.wav', sequence=[]))
+    res = {r.id: r for r in queue.iter_results()}
+    assert res['a.wav'].sequence == res['b.wav'].sequence == [ChordChange(chord='C', timestamp=0.)]
+    assert res['bad.wav'].sequence is None and res['bad.wav'].error.kind == 'error'
+    assert queue.counts() == {}
+    queue.put(['c.wav'])
+    queue.claim('dead', lease_seconds=0)
+    queue.claim('dead', lease_seconds=0)
+    assert queue.requeue_expired() == 1
+    res = list(queue.iter_results(wait=False))
+    assert res[0].error.kind == 'lease_expired' and res[0].error.attempts == 2
+
+
+class _DecodingExtractor(_FaultyExtractor):
+    def preprocess(self, path):
+        return Audio(np.zeros(10, dtype=np.float32) if path.startswith('bad') else np.ones(10, dtype=np.float32), 1)
+
+    def extract(self, file):
+        if not file.samples.any():
+            raise ValueError('Bad file')
+        return [ChordChange(chord='C', timestamp=0.)]
+
+
+def test_async():
+    async def run():
+        c = _FaultyExtractor()
+        assert await c.aextract('a.wav') == [ChordChange(chord='C', timestamp=0.)]
+        with pytest.raises(ValueError):
+            await c.aextract('bad.wav')
+        res = {r.id: r async for r in c.aextract_many(['a.wav', 'b.wav', 'bad.wav'])}
+        assert res['a.wav'].sequence and res['b.wav'].sequence and res['bad.wav'].error.kind == 'error'
+        close_shared_pool(c)
+        # Audio decoded in preprocessing is freed whether or not extraction succeeds
+        c = _DecodingExtractor()
+        blocks = set(os.listdir('/dev/shm'))
+        for _ in range(3):
+            with pytest.raises(ValueError):
+                await c.aextract('bad.wav')
+        assert set(os.listdir('/dev/shm')) <= blocks
+        # The shared pool of an extractor is closed once the extractor is garbage collected
+        pool = shared_pool(c)
+        collected = weakref.ref(c)
+        del c
+        # The last failure, whose traceback holds the extractor, is kept by the event loop and the pool's result
+        # thread until they next run
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            gc.collect()
+            if collected() is None:
+                break
+        with pytest.raises(RuntimeError):
+            pool._extractor_executor.submit(abs, 1)
+        async with AsyncExtractorPool(_FaultyExtractor(), num_extractors=1, max_concurrency=1, max_queued=1) as pool:
+            first = asyncio.ensure_future(pool.extract('slow.wav'))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(pool.extract('a.wav'))
+            await asyncio.sleep(0)
+            assert pool.queued == 1
+            with pytest.raises(Overloaded):
+                await pool.extract('b.wav')
+            second.cancel()
+            assert await first == [ChordChange(chord='C', timestamp=0.)]
+            with pytest.raises(asyncio.CancelledError):
+                await second
+            assert pool.queued == 0
+            assert await pool.extract('b.wav')
+
+    asyncio.run(run())
+
+
+class _CostedExtractor(_FaultyExtractor):
+    def estimate_cost(self, path):
+        return float(os.path.splitext(path)[0][-1])
+
+
+def test_scheduling():
+    res = _CostedExtractor().extract_many(['f1.wav', 'f3.wav', 'f2.wav'], num_extractors=1, longest_first=True)
+    assert [r.id for r in res] == ['f3.wav', 'f2.wav', 'f1.wav']
+    assert all(Chordino().estimate_cost(s) > 0 for s in sample_files if 'error' not in s)
+    files = [s for s in sample_files if 'error' not in s][:6] + [s for s in sample_files if 'error' in s]
+    expected = {r.id: r.sequence for r in Chordino().extract_many(files, num_extractors=2)}
+    res = Chordino().extract_many(files, num_extractors=2, num_preprocessors=1, max_files_in_cache=1,
+                                  longest_first=True, balance_workers=True)
+    assert {r.id: r.sequence for r in res} == expected
+
+
+class _CountingExtractor(ChordExtractor):
+    def __init__(self, log):
+        super().__init__()
+        self.log = log
+
+    def extract(self, file):
+        with open(self.log, 'a') as f:
+            f.write(file + '\n')
+        with open(file) as f:
+            return [ChordChange(chord=max(f.read()), timestamp=0.)]
+
+
+def test_deduplicate(tmp_path):
+    # c and d only differ in the middle, so need hashing in full to tell apart
+    contents = {'a1': 'A', 'a2': 'A', 'b': 'B', 'c': 'A' * 100000 + 'C' + 'A' * 99999,
+                'd': 'A' * 100000 + 'D' + 'A' * 99999}
+    for name, content in contents.items():
+        (tmp_path / name).write_text(content)
+    files = [str(tmp_path / n) for n in ['a1', 'a2', 'b', 'c', 'd', 'a1', 'c']]
+    log = str(tmp_path / 'log')
+    for max_in_flight in (None, 1):
+        if os.path.exists(log):
+            os.remove(log)
+        extractor = _CountingExtractor(log)
+        if max_in_flight == 1:
+            # Each original has finished before its copies are reached, so these come from the result cache
+            extractor.result_cache = ResultCache(str(tmp_path / 'results.sqlite'))
+        res = list(extractor.iter_extract_many(files, max_in_flight=max_in_flight, deduplicate=True))
+        assert sorted(r.id for r in res) == sorted(files)
+        assert all(r.sequence[0].chord == max(contents[os.path.basename(r.id)]) for r in res)
+        with open(log) as f:
+            assert sorted(f.read().split()) == [str(tmp_path / n) for n in ['a1', 'b', 'c', 'd']]
+    # Without a result cache, nothing is kept for copies coming after their original has finished
+    os.remove(log)
+    res = list(_CountingExtractor(log).iter_extract_many(files[:3], max_in_flight=1, deduplicate=True))
+    assert sorted(r.id for r in res) == sorted(files[:3])
+    with open(log) as f:
+        assert f.read().split() == files[:3]
+
+
+def test_reuse_plugins():
+    from chord_extractor.extractors import chordino
+
+    class _Unresettable:
+        def reset(self):
+            raise RuntimeError('Cannot reset')
+
+        def unload(self):
+            pass
+
+    files = [s for s in sample_files if s.endswith(('.ogg', '.mp3'))]
+    expected = [Chordino(reuse_plugins=False).extract(f) for f in files]
+    c = Chordino()
+    assert [c.extract(f) for f in files] == expected
+    settings = ('nnls-chroma:chordino', 22050, tuple(sorted(c._params.items())), None)
+    assert len(chordino._idle_plugins[settings]) == 1
+    chordino._idle_plugins[settings] = [(_Unresettable(), 2048, 16384)]
+    assert c.extract(files[0]) == expected[0]
+    assert not isinstance(chordino._idle_plugins[settings][0][0], _Unresettable)
+
+
+def test_extract_features(tmp_path):
+    files = [s for s in sample_files if s.endswith(('.ogg', '.mp3'))]
+    c = Chordino()
+    res = c.extract_features(files[0], ['chroma', 'basschroma', 'harmonicchange', 'tuning'])
+    assert res.chords == c.extract(files[0])
+    assert res.features['chroma'].shape == res.features['basschroma'].shape == (len(res.times), 12)
+    assert res.features['harmonicchange'].shape == (len(res.times), 1)
+    assert res.features['tuning'].shape == (1, 1)
+    assert (res.times[1:] > res.times[:-1]).all()
+    with pytest.raises(ValueError):
+        c.extract_features(files[0], ['chords'])
+
+    many = Chordino(compact_results=True).extract_features_many(files, ['chroma'], num_extractors=2)
+    assert sorted(r.id for r in many) == sorted(files)
+    for r in many:
+        assert isinstance(r.sequence.chords, ChordSequence)
+        assert list(r.sequence.features) == ['chroma']
+        if r.id == files[0]:
+            assert r.sequence.chords == res.chords
+            assert (r.sequence.features['chroma'] == res.features['chroma']).all()
+
+    # Saved and loaded with the feature arrays, alongside results of only chords
+    many.append(LabelledChordSequence('chords', c.extract(files[0]), None))
+    many.append(LabelledChordSequence(files[0], res, None))
+    save_sequences(str(tmp_path / 'res.npz'), many)
+    loaded = load_sequences(str(tmp_path / 'res.npz'))
+    assert [r.id for r in loaded] == [r.id for r in many]
+    assert loaded[-2].sequence == res.chords
+    for r, saved in zip(loaded[:-2] + loaded[-1:], many[:-2] + many[-1:]):
+        assert r.sequence.chords == saved.sequence.chords
+        assert (r.sequence.times == saved.sequence.times).all()
+        assert list(r.sequence.features) == list(saved.sequence.features)
+        assert all((r.sequence.features[k] == v).all() for k, v in saved.sequence.features.items())
+    with pytest.raises(TypeError):
+        save_sequences(str(tmp_path / 'res.npz'), [LabelledChordSequence('chords', {'C': 0.1}, None)])
+
+
+def test_decode_in_preprocessing(tmp_path):
+    audio = Audio(np.arange(10, dtype=np.float32), 22050)
+    shared = SharedAudio.share(audio)
+    assert shared.nbytes == 40
+    assert shared.apply(lambda a: (a.samples.sum(), a.sample_rate)) == (45, 22050)
+    shared.release()
+    shared.release()
+    with pytest.raises(FileNotFoundError):
+        shared.apply(len)
+
+    cache = ConversionCache(str(tmp_path / 'conversions'))
+    files = [s for s in sample_files if s.endswith(('.ogg', '.mp3'))] + \
+        [s for s in sample_files if s.endswith('.mid') and 'error' not in s][:2] + \
+        [s for s in sample_files if s.endswith('not_really_a_midi.mid')]
+    expected = {r.id: r.sequence for r in Chordino().extract_many(files, num_extractors=2)}
+    c = Chordino(decode_in_preprocessing=True, conversion_cache=cache)
+    # A budget smaller than any decoded file, so that conversions wait for each to be extracted from
+    res = c.extract_many(files, num_extractors=2, num_preprocessors=2, max_bytes_in_cache=1)
+    assert {r.id: r.sequence for r in res} == expected
+    assert cache.stats().entries == 0
+
+
+def test_extract_span():
+    from chord_extractor.extractors.chordino import _ChordinoSpan
+    f = [s for s in sample_files if s.endswith('.ogg')][0]
+    c = Chordino()
+    full = c.extract(f)
+    span = c.extract(f, start=60, end=90)
+    assert span[0].timestamp == 60 and all(60 <= ch.timestamp < 90 for ch in span)
+    # Close to the same span of the whole file, though smoothing can move changes a little
+    assert len(span) == pytest.approx(len([ch for ch in full if 60 <= ch.timestamp < 90]), abs=2)
+    assert c.extract(f, end=10) == c.extract(f, start=0, end=10)
+
+    windowed = c.extract_windowed(f, window=60, num_extractors=2)
+    assert len(windowed) == pytest.approx(len(full), abs=4)
+    assert windowed[-1].timestamp == pytest.approx(full[-1].timestamp, abs=0.1)
+
+    res = c.extract_span_many([s for s in sample_files if s.endswith(('.ogg', '.mp3'))], end=10, num_extractors=2)
+    assert len(res) == 2 and all(r.sequence and r.sequence[-1].timestamp < 10 for r in res)
+
+    # Decoding in preprocessing only decodes the window around the span
+    decoding = Chordino(decode_in_preprocessing=True)
+    res = decoding.extract_span_many([f], start=60, end=90)
+    assert res[0].sequence == span
+    assert _ChordinoSpan(decoding, 60, 90).estimate_cost(f) == 30 + 2 * decoding.span_margin